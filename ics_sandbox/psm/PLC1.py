@@ -24,12 +24,17 @@
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
 # import all your libraries here
+import os
+
 import psm
-import time
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
 
 # global variables
-client = None
+runtime = None
 P101 = "IX0.0"
 P102 = "IX0.1"
 # MV101 = "IX0.2"
@@ -40,49 +45,50 @@ LIT101 = "IW1"
 
 
 def hardware_init():
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC1", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
     # tell the simulation PLC connected
-    client.write_coil(65001, True)
+    runtime.announce()
     psm.start()
     # set sim, plc state
-    client.write_coil(0, False)
+    runtime.set("P101", False)
     psm.set_var(P101, False)
-
-    client.write_coil(1, False)
+    runtime.set("P102", False)
     psm.set_var(P102, False)
+    runtime.flush()
 
 
 def update_inputs():
-    global client
-    lit101 = client.read_holding_registers(1, 1).registers[0]
+    values = runtime.read()
+    lit101 = values["LIT101"]
     psm.set_var(LIT101, lit101)
-    print(f"lit101:  {lit101}")
+    runtime.log.info("lit101", f"lit101:  {lit101}")
 
     if 0.3 * containerMax <= lit101 <= 0.8 * containerMax:
-        print(f"LIT101 {lit101} normal: Open P101,P102")
-        client.write_coil(0, True)
+        runtime.log.info("state", f"LIT101 {lit101} normal: Open P101,P102")
+        runtime.set("P101", True)
         psm.set_var(P101, True)
-        client.write_coil(1, True)
+        runtime.set("P102", True)
         psm.set_var(P102, True)
     elif lit101 < 0.3 * containerMax:
-        print(f"LIT101 {lit101} TOO LOW : Close P101,P102")
-        client.write_coil(0, False)
-        client.write_coil(1, False)
+        runtime.log.info("state", f"LIT101 {lit101} TOO LOW : Close P101,P102")
+        runtime.set("P101", False)
+        runtime.set("P102", False)
         psm.set_var(P101, False)
         psm.set_var(P102, False)
     # max 80 %
     elif lit101 > 0.8 * containerMax:
         # TODO: control reservoir input per cycle
-        print(f"LIT101 {lit101} TOO HIGH : Close MV101")
-        # client.write_coil(2, False)
+        runtime.log.info("state", f"LIT101 {lit101} TOO HIGH : Close MV101")
+        # runtime.set("MV101", False)
         # psm.set_var(MV101, False)
+    runtime.flush()
 
     # set flowrate
-    fit201 = client.read_holding_registers(0, 1).registers[0]
+    fit201 = values["FIT201"]
     psm.set_var(FIT201, fit201)
-    print(f"fit201:  {fit201}")
+    runtime.log.info("fit201", f"fit201:  {fit201}")
     pass
 
 
@@ -92,8 +98,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while not psm.should_quit():
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
     psm.stop()
@@ -24,23 +24,31 @@
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
 # import all your libraries here
+import os
+
 import psm
-import time
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
+
 # global variables
+runtime = None
 MV201 = "IX0.4"
 
 
 def hardware_init():
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC2", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
     # tell the simulation PLC connected
-    client.write_coil(65002, True)
+    runtime.announce()
     psm.start()
     # set sim, plc state
     psm.set_var(MV201, True)
-    client.write_coil(4, True)
+    runtime.set("MV201", True)
+    runtime.flush()
 
 
 def update_inputs():
@@ -54,8 +62,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while not psm.should_quit():
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
     psm.stop()
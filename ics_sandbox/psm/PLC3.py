@@ -24,12 +24,17 @@
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
 # import all your libraries here
+import os
+
 import psm
-import time
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
 
 # global variables
-client = None
+runtime = None
 P301 = "IX0.5"
 P302 = "IX0.6"
 MV302 = "IX0.7"
@@ -40,52 +45,54 @@ containerMax = 10000
 
 def hardware_init():
     # Insert your hardware initialization code in here
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC3", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
     # tell the simulation PLC connected
-    client.write_coil(65003, True)
+    runtime.announce()
     psm.start()
     # set sim, plc state
-    client.write_coil(5, False)
+    runtime.set("P301", False)
     psm.set_var(P301, False)
-    client.write_coil(6, False)
+    runtime.set("P302", False)
     psm.set_var(P302, False)
-    client.write_coil(7, False)
+    runtime.set("MV302", False)
     psm.set_var(MV302, False)
+    runtime.flush()
 
 
 def update_inputs():
-    global client
-    lit301 = client.read_holding_registers(2, 1).registers[0]
+    values = runtime.read()
+    lit301 = values["LIT301"]
     psm.set_var(LIT301, lit301)
-    fit301 = client.read_holding_registers(3, 1).registers[0]
+    fit301 = values["FIT301"]
     psm.set_var(FIT301, fit301)
-    print(f"lit301:  {lit301}")
+    runtime.log.info("lit301", f"lit301:  {lit301}")
     if 0.3 * containerMax <= lit301 <= 0.8 * containerMax:
-        print(f"LIT301 {lit301} normal: Open P301, P302, MV302")
-        client.write_coil(5, True)
+        runtime.log.info("state", f"LIT301 {lit301} normal: Open P301, P302, MV302")
+        runtime.set("P301", True)
         psm.set_var(P301, True)
-        client.write_coil(6, True)
+        runtime.set("P302", True)
         psm.set_var(P302, True)
-        client.write_coil(7, True)
+        runtime.set("MV302", True)
         psm.set_var(MV302, True)
     # min 20 %
     elif lit301 < 0.3 * containerMax:
-        print(f"LI3101 {lit301} TOO LOW : Close P301, P302, MV302")
-        client.write_coil(5, False)
+        runtime.log.info("state", f"LI3101 {lit301} TOO LOW : Close P301, P302, MV302")
+        runtime.set("P301", False)
         psm.set_var(P301, False)
-        client.write_coil(6, False)
+        runtime.set("P302", False)
         psm.set_var(P302, False)
-        client.write_coil(7, False)
+        runtime.set("MV302", False)
         psm.set_var(MV302, False)
     # max 80 %
     elif lit301 > 0.8 * containerMax:
         # TODO: define what to do when too much water
         # write to P101,P102,MV201 to be off ?
-        print(f"LIT301 {lit301} TOO HIGH : BIG WARNING")
-        # client.write_coil(7, False)
+        runtime.log.info("state", f"LIT301 {lit301} TOO HIGH : BIG WARNING")
+        # runtime.set("MV302", False)
         # psm.set_var(MV302, False)
+    runtime.flush()
     pass
 
 
@@ -96,8 +103,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while not psm.should_quit():
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
     psm.stop()
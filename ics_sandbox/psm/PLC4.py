@@ -23,11 +23,15 @@
 # output (%QX0.0) is true, PSM will display "QX0.0 is true" on OpenPLC's
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
-import time
-
 # import all your libraries here
+import os
+
 import psm
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
 
 # global variables
 P401 = "IX1.0"  # -> coil 8
@@ -35,48 +39,49 @@ P402 = "IX1.1"  # -> coil 9
 LIT401 = "IW4"
 containerMax = 10000
 FIT401 = "IW5"
-client = None
+runtime = None
 
 
 def hardware_init():
     # Insert your hardware initialization code in here
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC4", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
     # tell the simulation PLC connected
-    client.write_coil(65004, True)
+    runtime.announce()
     psm.start()
     # set sim, plc state
-    client.write_coil(9, False)
+    runtime.set("P402", False)
     psm.set_var(P401, False)
-    client.write_coil(8, False)
+    runtime.set("P401", False)
     psm.set_var(P402, False)
+    runtime.flush()
 
 
 def update_inputs():
     # place here your code to update inputs
-    global client
-    lit401 = client.read_holding_registers(4, 1).registers[0]
+    values = runtime.read()
+    lit401 = values["LIT401"]
     psm.set_var(LIT401, lit401)
-    fit401 = client.read_holding_registers(5, 1).registers[0]
+    fit401 = values["FIT401"]
     psm.set_var(FIT401, fit401)
-    print(f"FIT401:  {fit401}")
+    runtime.log.info("fit401", f"FIT401:  {fit401}")
     if lit401 >= 0.5 * containerMax:
-        print(f"LIT401 {lit401} High enough : Open P401, P402")
-        print(f"turn on: P401.P402 -> {lit401}")
-        client.write_coil(8, True)
+        runtime.log.info("state", f"LIT401 {lit401} High enough : Open P401, P402")
+        runtime.set("P401", True)
         psm.set_var(P401, True)
-        client.write_coil(9, True)
+        runtime.set("P402", True)
         psm.set_var(P402, True)
     # min 20 %
     elif lit401 <= 0.2 * containerMax:
-        print(f"LIT401 {lit401} TOO LOW : Close P401, P402")
-        client.write_coil(8, False)
+        runtime.log.info("state", f"LIT401 {lit401} TOO LOW : Close P401, P402")
+        runtime.set("P401", False)
         psm.set_var(P401, False)
-        client.write_coil(9, False)
+        runtime.set("P402", False)
         psm.set_var(P402, False)
     else:
-        print(f"LIT401: {lit401}")
+        runtime.log.info("lit401", f"LIT401: {lit401}")
+    runtime.flush()
     pass
 
 
@@ -86,8 +91,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while (not psm.should_quit()):
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
     psm.stop()
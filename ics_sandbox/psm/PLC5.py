@@ -23,11 +23,15 @@
 # output (%QX0.0) is true, PSM will display "QX0.0 is true" on OpenPLC's
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
-import time
-
 # import all your libraries here
+import os
+
 import psm
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
 
 # global variables
 MV501 = "IX1.2"
@@ -38,44 +42,46 @@ P502 = "IX1.5"
 FIT501 = "IW6"
 FIT502 = "IW7"
 FIT503 = "IW8"
-client = None
+runtime = None
 
 
 def hardware_init():
     # Insert your hardware initialization code in here
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC5", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
     # tell the simulation PLC connected
-    client.write_coil(65005, True)
+    runtime.announce()
     psm.start()
     # set sim, plc state
-    client.write_coil(10, True)
+    runtime.set("MV501", True)
     psm.set_var(MV501, True)
-    client.write_coil(11, False)
+    runtime.set("MV503", False)
     psm.set_var(MV503, False)
-    client.write_coil(12, False)
+    runtime.set("P501", False)
     psm.set_var(P501, False)
-    client.write_coil(13, False)
+    runtime.set("P502", False)
     psm.set_var(P502, False)
+    runtime.flush()
 
 
 def update_inputs():
-    global client
-    fit501 = client.read_holding_registers(6, 1).registers[0]
+    values = runtime.read()
+    fit501 = values["FIT501"]
     psm.set_var(FIT501, fit501)
-    print(f"Water through Filter-501:  {fit501}")
-    fit502 = client.read_holding_registers(7, 1).registers[0]
+    runtime.log.info("fit501", f"Water through Filter-501:  {fit501}")
+    fit502 = values["FIT502"]
     psm.set_var(FIT502, fit502)
-    print(f"Water through MV-501:  {fit502}")
+    runtime.log.info("fit502", f"Water through MV-501:  {fit502}")
 
-    client.write_coil(12, True)
+    runtime.set("P501", True)
     psm.set_var(P501, True)
-    client.write_coil(13, True)
+    runtime.set("P502", True)
     psm.set_var(P502, True)
-    client.write_coil(10, True)
+    runtime.set("MV501", True)
     psm.set_var(MV501, True)
     # DO NOT TOUCH MV503 -> if open, make in infinite loop with pump
+    runtime.flush()
     pass
 
 
@@ -85,8 +91,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while (not psm.should_quit()):
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
-    psm.stop()
\ No newline at end of file
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
+    psm.stop()
@@ -23,11 +23,15 @@
 # output (%QX0.0) is true, PSM will display "QX0.0 is true" on OpenPLC's
 # dashboard. Feel free to reuse this skeleton to write whatever you want.
 
-import time
-
 # import all your libraries here
+import os
+
 import psm
-from pymodbus.client.sync import ModbusTcpClient
+from psm_runtime import PsmRuntime
+
+# simulator config the register map is generated from, the one of the repository unless PSM_CONFIG gives its path
+CONFIG = os.environ.get("PSM_CONFIG", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "sim",
+                                                   "physic_simulation", "test.yml"))
 
 # global variables
 P601 = "IX1.6"
@@ -36,43 +40,43 @@ T601ContainerMax = 10000
 T603ContainerMax = 10000
 LS601 = "IW9"
 LS603 = "IW10"
-client = None
+runtime = None
 
 
 def hardware_init():
     # Insert your hardware initialization code in here
-    global client
-    client = ModbusTcpClient('172.18.0.10', 12345)
-    print(f"connected to simulation: {client.connect()}")
-    client.write_coil(65006, True)
+    global runtime
+    runtime = PsmRuntime(CONFIG, "PLC6", None, None, printer=print)
+    print(f"connected to simulation: {runtime.connect()}")
+    runtime.announce()
     psm.start()
-    client.write_coil(14, False)
+    runtime.set("P601", False)
     psm.set_var(P601, False)
-    client.write_coil(15, False)
+    runtime.set("P603", False)
     psm.set_var(P603, False)
+    runtime.flush()
 
 
 def update_inputs():
     # place here your code to update inputs
-    global client
-    ls601 = client.read_holding_registers(9, 1).registers[0]
+    values = runtime.read()
+    ls601 = values["LS601"]
     psm.set_var(LS601, ls601)
-    print(f"ls601:  {ls601}")
-    ls603 = client.read_holding_registers(10, 1).registers[0]
+    runtime.log.info("ls601", f"ls601:  {ls601}")
+    ls603 = values["LS603"]
     psm.set_var(LS603, ls603)
-    print(f"ls603:  {ls603}")
+    runtime.log.info("ls603", f"ls603:  {ls603}")
     # min 20 %
     if ls601 <= 0.2 * T601ContainerMax:
-        print(f"LS601 {ls601} TOO LOW : Close P601")
-        client.write_coil(14, False)
+        runtime.log.info("state", f"LS601 {ls601} TOO LOW : Close P601")
+        runtime.set("P601", False)
         psm.set_var(P601, False)
     # max 80 %
     elif ls601 >= 0.8 * T601ContainerMax:
-        print(f"LS601 {ls601} High enough : Open P601")
-        print(f"turn on: P601 -> {ls601}")
-        client.write_coil(14, True)
+        runtime.log.info("state", f"LS601 {ls601} High enough : Open P601")
+        runtime.set("P601", True)
         psm.set_var(P601, True)
-
+    runtime.flush()
 
 
 def update_outputs():
@@ -82,8 +86,5 @@ def update_outputs():
 
 if __name__ == "__main__":
     hardware_init()
-    while not psm.should_quit():
-        update_inputs()
-        update_outputs()
-        time.sleep(0.2)  # You can adjust the psm cycle time here
+    runtime.run(update_inputs, update_outputs, psm.should_quit)  # runtime.period is the psm cycle time
     psm.stop()
@@ -0,0 +1,265 @@
+# Shared runtime of the psm scripts.
+#
+# The register map of a PLC is generated from the simulator YAML config (`settings`, `sensors` and `plcs`
+# sections), so each cycle a script does one block read of all its registers and one multi-coil write of all its
+# actuators instead of one modbus request per value. The client reconnects automatically, the loop runs at a fixed
+# rate and the logs of each key are printed at most once per `log_period`.
+# With `lockstep` in the settings, `run` follows the simulation cycle counter instead of its own clock and
+# acknowledges each consumed cycle, so the simulation advances as soon as all PLCs are done.
+#
+#     runtime = PsmRuntime(CONFIG, "PLC1")   # host and port from the settings
+#     runtime.connect()
+#     values = runtime.read()          # {"LIT101": 1000, "FIT201": 10}
+#     runtime.set("P101", True)
+#     runtime.flush()                  # one write_coils for P101, P102...
+
+import time
+
+import yaml
+
+# maximal number of registers in one read request
+_MAX_READ_REGISTERS = 125
+# maximal number of coils in one write request
+_MAX_WRITE_COILS = 1968
+# time between two reads of the lockstep cycle register, in seconds
+_LOCKSTEP_POLL = 0.002
+
+
+class _RawLoader(yaml.SafeLoader):
+    """YAML loader which doesn't need the simulator classes, tagged mappings are loaded as dict"""
+    pass
+
+
+def _construct_tagged_mapping(loader, tag_suffix, node):
+    fields = loader.construct_mapping(node, deep=True)
+    fields['tag'] = tag_suffix
+    return fields
+
+
+_RawLoader.add_multi_constructor('!', _construct_tagged_mapping)
+
+
+def parse_location(location: str) -> tuple[str, int]:
+    """Convert a sensor location (i.e X1, W25) to a tuple ('X', 1), ('W', 25)"""
+    return location[0], int(location[1:])
+
+
+def blocks(addresses: list[int], max_count: int) -> list[tuple[int, int]]:
+    """Group addresses into contiguous (start, count) blocks of at most `max_count` addresses"""
+    result = []
+    for address in sorted(set(addresses)):
+        if result and address == result[-1][0] + result[-1][1] and result[-1][1] < max_count:
+            result[-1] = (result[-1][0], result[-1][1] + 1)
+        else:
+            result.append((address, 1))
+    return result
+
+
+def read_blocks(addresses: list[int], max_count: int) -> list[tuple[int, int]]:
+    """Group addresses into (start, count) blocks covering the gaps between them, as reading a few unused
+    registers is cheaper than one more round trip"""
+    result = []
+    for address in sorted(set(addresses)):
+        if result and address - result[-1][0] < max_count:
+            result[-1] = (result[-1][0], address - result[-1][0] + 1)
+        else:
+            result.append((address, 1))
+    return result
+
+
+class RateLimitedLog(object):
+    """Print messages at most once per `period` seconds for each key"""
+
+    def __init__(self, period: float = 5.0, printer=print):
+        """
+        :param period: minimal time in seconds between two messages with the same key
+        :param printer: function used to output the messages
+        """
+        self.period = period
+        self.printer = printer
+        self.last_print = {}
+        self.suppressed = {}
+
+    def info(self, key: str, message: str) -> None:
+        now = time.monotonic()
+        if now - self.last_print.get(key, -self.period) >= self.period:
+            suppressed = self.suppressed.pop(key, 0)
+            self.printer(message if suppressed == 0 else f"{message} ({suppressed} similar messages suppressed)")
+            self.last_print[key] = now
+        else:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+
+
+class PsmRuntime(object):
+    """Batched and reconnecting modbus access of one PLC to the simulation"""
+
+    def __init__(self, path_to_yaml_config: str, plc_label: str, host: str = None, port: int = None,
+                 period: float = 0.2, log_period: float = 5.0, printer=print):
+        """
+        :param path_to_yaml_config: simulator YAML config file
+        :param plc_label: label of the PLC in the `plcs` section
+        :param host: address of the simulation, default is `host_address` of the settings
+        :param port: modbus port of the simulation, default is the PLC endpoint of the settings
+        :param period: cycle time of `run` in seconds
+        :param log_period: minimal time in seconds between two logs with the same key
+        :param printer: function used to output the logs
+        """
+        with open(path_to_yaml_config, 'r') as stream:
+            config = yaml.load(stream, Loader=_RawLoader)
+        settings = config['settings']
+        plcs = config['plcs']
+        plc_index, plc = next((index, plc) for index, plc in enumerate(plcs) if plc['label'] == plc_label)
+        sensors = {sensor['label']: sensor for sensor in config['sensors']}
+
+        self.label = plc_label
+        self.host = host or settings.get('host_address', '172.18.0.10')
+        self.port = port or settings.get('port', 12345)
+        self.request_kwargs = {}
+        modbus_mode = settings.get('modbus_mode', 'shared')
+        if modbus_mode == 'unit_id':
+            self.request_kwargs['unit'] = plc.get('unit_id') or plc_index + 1
+        elif modbus_mode == 'port' and port is None:
+            self.port = plc.get('port') or self.port + plc_index + 1
+        self.connection_established_coil = plc.get('connection_established_coil', 65535)
+        self.lockstep = settings.get('lockstep', False)
+        self.lockstep_register = settings.get('lockstep_register', 65000)
+        self.ack_register = plc.get('ack_register') or self.lockstep_register + plc_index + 1
+        self.last_cycle = None
+        self.period = period
+        self.log = RateLimitedLog(log_period, printer)
+
+        self.registers = {}
+        self.coils = {}
+        for sensor_label in plc.get('controlled_sensors_label') or []:
+            area, address = parse_location(sensors[sensor_label]['location'])
+            if area == 'W':
+                self.registers[sensor_label] = address
+            else:
+                self.coils[sensor_label] = address
+        self.read_requests = read_blocks(list(self.registers.values()), _MAX_READ_REGISTERS)
+        self.values = {label: 0 for label in self.registers}
+        self.staged = {}
+
+        # imported here so the in-process psm harness can provide its own client
+        from pymodbus.client.sync import ModbusTcpClient
+        self.client = ModbusTcpClient(self.host, self.port)
+        self.connected = False
+
+    def connect(self) -> bool:
+        """Open the connection to the simulation if it is not already open"""
+        if not self.connected or not self.client.is_socket_open():
+            self.connected = bool(self.client.connect())
+        return self.connected
+
+    def disconnect(self, error) -> None:
+        """Close the connection after an error, it is opened again by the next request"""
+        self.log.info('connection', f"{self.label}: modbus error {error}, reconnecting")
+        self.client.close()
+        self.connected = False
+
+    def announce(self) -> bool:
+        """Set the connection established coil, telling the simulation this PLC is connected"""
+        return self.write_coils({self.connection_established_coil: True})
+
+    def read(self) -> dict:
+        """
+        Read all the registers of the PLC sensors, one request per contiguous block
+        :return: dict of register values, key is the sensor label, the last known value is kept on error
+        """
+        if not self.connect():
+            return self.values
+        words = {}
+        try:
+            for start, count in self.read_requests:
+                response = self.client.read_holding_registers(start, count, **self.request_kwargs)
+                if response.isError():
+                    raise IOError(response)
+                words.update(zip(range(start, start + count), response.registers))
+        except Exception as error:
+            self.disconnect(error)
+        for label, address in self.registers.items():
+            if address in words:
+                self.values[label] = words[address]
+        return self.values
+
+    def set(self, sensor_label: str, value: bool) -> None:
+        """Stage the state of an actuator, written by the next `flush`"""
+        self.staged[self.coils[sensor_label]] = bool(value)
+
+    def flush(self) -> bool:
+        """Write the staged actuators states, one request per contiguous block of coils"""
+        staged, self.staged = self.staged, {}
+        return self.write_coils(staged)
+
+    def write_coils(self, coils: dict[int, bool]) -> bool:
+        if not coils or not self.connect():
+            return False
+        try:
+            for start, count in blocks(list(coils), _MAX_WRITE_COILS):
+                response = self.client.write_coils(start, [coils[start + offset] for offset in range(count)],
+                                                   **self.request_kwargs)
+                if response.isError():
+                    raise IOError(response)
+        except Exception as error:
+            self.disconnect(error)
+            return False
+        return True
+
+    def wait_cycle(self, timeout: float):
+        """
+        Poll the lockstep cycle register until the simulation publishes a cycle not consumed yet
+        :param timeout: maximal waiting time in seconds
+        :return: the new cycle counter, None on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while self.connect():
+            try:
+                response = self.client.read_holding_registers(self.lockstep_register, 1, **self.request_kwargs)
+                if response.isError():
+                    raise IOError(response)
+                if response.registers[0] != self.last_cycle:
+                    return response.registers[0]
+            except Exception as error:
+                self.disconnect(error)
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(_LOCKSTEP_POLL)
+        return None
+
+    def acknowledge(self, cycle: int) -> bool:
+        """Tell the simulation this PLC consumed `cycle`"""
+        self.last_cycle = cycle
+        if not self.connect():
+            return False
+        try:
+            response = self.client.write_register(self.ack_register, cycle, **self.request_kwargs)
+            if response.isError():
+                raise IOError(response)
+        except Exception as error:
+            self.disconnect(error)
+            return False
+        return True
+
+    def run(self, update_inputs, update_outputs, should_quit) -> None:
+        """
+        Call `update_inputs` and `update_outputs` every `period` seconds until `should_quit` returns True,
+        the time spent in the updates is deduced from the sleep and a late cycle doesn't make the next ones faster.
+        In lockstep mode, call them once per simulation cycle instead, `period` is then the maximal waiting time
+        """
+        next_cycle = time.monotonic()
+        while not should_quit():
+            if self.lockstep:
+                cycle = self.wait_cycle(self.period)
+                update_inputs()
+                update_outputs()
+                if cycle is not None:
+                    self.acknowledge(cycle)
+                continue
+            update_inputs()
+            update_outputs()
+            next_cycle += self.period
+            delay = next_cycle - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_cycle = time.monotonic()
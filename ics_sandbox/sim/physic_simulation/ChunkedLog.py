@@ -0,0 +1,253 @@
+import bisect
+import contextlib
+import csv
+import glob
+import io
+import logging
+import os
+import queue
+import threading
+import zlib
+from enum import Enum
+
+log = logging.getLogger('phy_sim')
+CHUNK_EXTENSION = '.zlib'
+INDEX_EXTENSION = '.idx'
+
+
+class Allowed_log_format(Enum):
+    csv = 'csv'
+    chunked = 'chunked'
+
+
+def part_path(prefix: str, part: int, extension: str) -> str:
+    return f"{prefix}.{part:04d}{extension}"
+
+
+def part_paths(prefix: str, extension: str) -> list[str]:
+    """Return the existing files of a chunked log with `extension`, in order"""
+    return sorted(glob.glob(f"{glob.escape(prefix)}.[0-9][0-9][0-9][0-9]{extension}"))
+
+
+class ChunkedLogWriter(object):
+    """Simulation log written as zlib compressed chunks of csv rows, with a sidecar index per file.
+    Rows are buffered until `chunk_size` bytes, each chunk is compressed and written by a background thread, and a
+    new file is started once a file reaches `max_file_size` bytes.
+    The index file starts with the csv header (a `cycle` column followed by the log columns), then one line per chunk:
+    first timestamp_ns, last timestamp_ns, first cycle, last cycle, offset, compressed length and number of rows"""
+
+    def __init__(self, prefix: str, field_names: list[str], cycle, chunk_size: int = 1 << 20,
+                 max_file_size: int = 1 << 30, compression_level: int = 6):
+        """
+        :param prefix: path of the log files without extension, files are `prefix`.0000.zlib/.idx, `prefix`.0001...
+        :param field_names: columns of the log
+        :param cycle: function returning the current simulation cycle
+        :param chunk_size: uncompressed size in bytes of a chunk
+        :param max_file_size: size in bytes after which the log rolls over to a new file
+        :param compression_level: zlib compression level
+        """
+        self.prefix = prefix
+        self.field_names = ['cycle'] + list(field_names)
+        self.cycle = cycle
+        self.chunk_size = chunk_size
+        self.max_file_size = max_file_size
+        self.compression_level = compression_level
+        self.part = -1
+        self.data_file = None
+        self.index_file = None
+        for path in part_paths(prefix, CHUNK_EXTENSION) + part_paths(prefix, INDEX_EXTENSION):
+            # files of a previous run
+            os.remove(path)
+        self.new_buffer()
+        # chunks waiting for the compression thread, bounded so that a slow disk slows the simulation down
+        self.chunks = queue.Queue(maxsize=8)
+        self.thread = threading.Thread(target=self.compress_chunks, name='log-compression', daemon=True)
+        self.thread.start()
+
+    def new_buffer(self) -> None:
+        self.buffer = io.StringIO()
+        self.writer = csv.DictWriter(self.buffer, fieldnames=self.field_names)
+        self.rows = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.first_cycle = None
+        self.last_cycle = None
+
+    def writeheader(self) -> None:
+        """The header is written in each index file"""
+        pass
+
+    def writerow(self, row: dict) -> None:
+        cycle = self.cycle()
+        timestamp = row.get('timestamp_ns')
+        if self.rows == 0:
+            self.first_timestamp = timestamp
+            self.first_cycle = cycle
+        self.last_timestamp = timestamp
+        self.last_cycle = cycle
+        self.writer.writerow(dict(row, cycle=cycle))
+        self.rows += 1
+        if self.buffer.tell() >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Send the buffered rows to the compression thread"""
+        if self.rows == 0:
+            return
+        self.chunks.put((self.buffer.getvalue(), self.first_timestamp, self.last_timestamp, self.first_cycle,
+                         self.last_cycle, self.rows))
+        self.new_buffer()
+
+    def open_part(self) -> None:
+        """Close the current file and start the next one"""
+        self.close_part()
+        self.part += 1
+        self.data_file = open(part_path(self.prefix, self.part, CHUNK_EXTENSION), 'wb')
+        self.index_file = open(part_path(self.prefix, self.part, INDEX_EXTENSION), 'w', newline='')
+        self.index_file.write(','.join(self.field_names) + '\n')
+        log.info(f"Log file {part_path(self.prefix, self.part, CHUNK_EXTENSION)} opened")
+
+    def close_part(self) -> None:
+        if self.data_file is not None:
+            self.data_file.close()
+            self.index_file.close()
+
+    def compress_chunks(self) -> None:
+        """Compress and write the chunks, until the None sent by `close`"""
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            text, first_timestamp, last_timestamp, first_cycle, last_cycle, rows = chunk
+            try:
+                data = zlib.compress(text.encode(), self.compression_level)
+                if self.data_file is None or self.data_file.tell() >= self.max_file_size:
+                    self.open_part()
+                offset = self.data_file.tell()
+                self.data_file.write(data)
+                self.data_file.flush()
+                # the chunk is on disk before it is indexed, so that readers of a running log can use the index
+                self.index_file.write(f"{first_timestamp},{last_timestamp},{first_cycle},{last_cycle},{offset},"
+                                      f"{len(data)},{rows}\n")
+                self.index_file.flush()
+            except OSError as error:
+                log.error(f"Log chunk of cycles {first_cycle}-{last_cycle} not written: {error}")
+        self.close_part()
+
+    def close(self) -> None:
+        """Write the last rows and wait for the compression thread"""
+        self.flush()
+        self.chunks.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+@contextlib.contextmanager
+def open_log(settings: dict, field_names: list[str], cycle, prefix: str = 'simulation_log'):
+    """
+    Open the simulation log in the `log_format` of the settings, the header is written
+    :param settings: simulation settings, `log_format`, `log_chunk_size` and `log_max_file_size` are read
+    :param field_names: columns of the log
+    :param cycle: function returning the current simulation cycle, logged in chunked logs
+    :param prefix: path of the log without extension
+    :return: csv writer or ChunkedLogWriter
+    """
+    log_format = settings.get('log_format', Allowed_log_format.csv.value)
+    if log_format not in [e.value for e in Allowed_log_format]:
+        raise ValueError(f'Log format {log_format} is not allowed.')
+    if log_format == Allowed_log_format.chunked.value:
+        with ChunkedLogWriter(prefix, field_names, cycle, settings.get('log_chunk_size', 1 << 20),
+                              settings.get('log_max_file_size', 1 << 30)) as writer:
+            yield writer
+    else:
+        with open(f"{prefix}.csv", 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=field_names)
+            writer.writeheader()
+            yield writer
+
+
+def chunked_log_prefix(path: str):
+    """Return the prefix of a chunked log from its prefix or the path of one of its files, None if `path` isn't a
+    chunked log"""
+    root, extension = os.path.splitext(path)
+    if extension in (CHUNK_EXTENSION, INDEX_EXTENSION):
+        prefix, part = os.path.splitext(root)
+        if part[1:].isdigit():
+            return prefix
+    if part_paths(path, INDEX_EXTENSION):
+        return path
+    return None
+
+
+class ChunkedLogReader(object):
+    """Read the rows of a time or cycle range of a chunked log, only the chunks covering the range are read"""
+
+    def __init__(self, path: str):
+        """
+        :param path: prefix of the log or path of one of its files
+        """
+        self.prefix = chunked_log_prefix(path)
+        if self.prefix is None:
+            raise FileNotFoundError(f"{path} is not a chunked log")
+        self.header = None
+        # (data file path, first timestamp, last timestamp, first cycle, last cycle, offset, length, rows)
+        self.chunks = []
+        for index_path in part_paths(self.prefix, INDEX_EXTENSION):
+            data_path = index_path[:-len(INDEX_EXTENSION)] + CHUNK_EXTENSION
+            with open(index_path, 'r') as index_file:
+                self.header = index_file.readline().rstrip('\r\n').split(',')
+                for line in index_file:
+                    fields = line.rstrip('\r\n').split(',')
+                    if len(fields) == 7:
+                        self.chunks.append((data_path,) + tuple(int(field) for field in fields))
+        self.last_timestamps = [chunk[2] for chunk in self.chunks]
+        self.last_cycles = [chunk[4] for chunk in self.chunks]
+
+    def select_chunks(self, start_ns: int = None, end_ns: int = None, start_cycle: int = None,
+                      end_cycle: int = None) -> list[tuple]:
+        """Return the chunks which may hold rows of the range, found by bisection in the index"""
+        first = 0
+        if start_ns is not None:
+            first = max(first, bisect.bisect_left(self.last_timestamps, start_ns))
+        if start_cycle is not None:
+            first = max(first, bisect.bisect_left(self.last_cycles, start_cycle))
+        chunks = []
+        for chunk in self.chunks[first:]:
+            if (end_ns is not None and chunk[1] > end_ns) or (end_cycle is not None and chunk[3] > end_cycle):
+                break
+            chunks.append(chunk)
+        return chunks
+
+    def rows(self, start_ns: int = None, end_ns: int = None, start_cycle: int = None, end_cycle: int = None):
+        """
+        Generate the rows of the range, as lists of strings in the order of `header`, bounds are included
+        :param start_ns, end_ns: range of timestamp_ns
+        :param start_cycle, end_cycle: range of cycles
+        """
+        timestamp_index = self.header.index('timestamp_ns') if self.header else None
+        data_file = None
+        try:
+            for chunk in self.select_chunks(start_ns, end_ns, start_cycle, end_cycle):
+                data_path, offset, length = chunk[0], chunk[5], chunk[6]
+                if data_file is None or data_file.name != data_path:
+                    if data_file is not None:
+                        data_file.close()
+                    data_file = open(data_path, 'rb')
+                data_file.seek(offset)
+                text = zlib.decompress(data_file.read(length)).decode()
+                for row in csv.reader(io.StringIO(text)):
+                    timestamp, cycle = int(row[timestamp_index]), int(row[0])
+                    if (start_ns is not None and timestamp < start_ns) \
+                            or (start_cycle is not None and cycle < start_cycle):
+                        continue
+                    if (end_ns is not None and timestamp > end_ns) or (end_cycle is not None and cycle > end_cycle):
+                        return
+                    yield row
+        finally:
+            if data_file is not None:
+                data_file.close()
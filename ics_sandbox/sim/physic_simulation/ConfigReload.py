@@ -0,0 +1,183 @@
+import logging
+import os
+import time
+
+import yaml
+
+log = logging.getLogger('phy_sim')
+# key of the yaml tag in the raw config objects
+TAG_KEY = '!'
+# settings read once when the simulation is built, changing them needs a restart
+restart_settings = ('host_address', 'port', 'modbus_mode', 'record_traffic', 'headless', 'lockstep',
+                    'lockstep_register', 'engine', 'physics', 'pipe_resistance', 'quality_model',
+                    'fixed_point_resolution', 'log_format', 'log_chunk_size', 'log_max_file_size',
+                    'history_cycles', 'history_port', 'history_host')
+# PLC fields applied while running, the others change the modbus servers or the in-process programs
+reloadable_plc_fields = ('controlled_sensors_label', 'update_period')
+
+
+class RawLoader(yaml.SafeLoader):
+    """Loader building plain dicts for the tagged objects (devices, sensors, plcs, fluids), the tag is stored under
+    `TAG_KEY`, so that two configs can be compared field by field"""
+    pass
+
+
+def construct_tagged(loader: RawLoader, tag_suffix: str, node: yaml.Node):
+    if isinstance(node, yaml.MappingNode):
+        fields = loader.construct_mapping(node, deep=True)
+    elif isinstance(node, yaml.SequenceNode):
+        fields = {'value': loader.construct_sequence(node, deep=True)}
+    else:
+        fields = {'value': loader.construct_scalar(node)}
+    fields[TAG_KEY] = tag_suffix
+    return fields
+
+
+RawLoader.add_multi_constructor('!', construct_tagged)
+
+
+def by_label(items: list) -> dict:
+    """Index the raw devices, sensors or plcs of a config by label"""
+    return {item.get('label'): item for item in items or []}
+
+
+def changed_fields(old: dict, new: dict) -> list[str]:
+    """Return the fields which differ between two raw objects"""
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def missing_references(config: dict) -> list[str]:
+    """Return the labels used in the connections, sensors and plcs of `config` which aren't defined"""
+    device_labels = {device.label for device in config.get('devices') or []}
+    sensor_labels = {sensor.label for sensor in config.get('sensors') or []}
+    missing = []
+    for device_label, connections in (config.get('connections') or {}).items():
+        used = [device_label] + list(connections.get('inputs') or []) + list(connections.get('outputs') or []) \
+            + list(connections.get('input_devices_expr') or {}) + list(connections.get('output_devices_expr') or {})
+        missing += [f"device {label}" for label in used if label not in device_labels]
+    for sensor in config.get('sensors') or []:
+        if sensor.device_to_monitor_label not in device_labels:
+            missing.append(f"device {sensor.device_to_monitor_label} of sensor {sensor.label}")
+    for plc in config.get('plcs') or []:
+        missing += [f"sensor {label} of PLC {plc.label}" for label in plc.controlled_sensors_label or []
+                    if label not in sensor_labels]
+    return missing
+
+
+class ConfigDiff(object):
+    """Difference between the running config and a new version of the config file"""
+
+    def __init__(self, old: dict, new: dict):
+        """
+        :param old: raw config of the running plant
+        :param new: raw config read from the file
+
+        :attr settings: dict of changed settings, key is the setting, value is the new value (None if removed)
+        :attr devices, sensors, plcs: dict with 'added', 'removed' lists of labels and 'changed', dict of label
+            to the list of changed fields
+        :attr connections: True if the connections or the expressions changed
+        :attr symbols: True if the symbols changed
+        """
+        old_settings, new_settings = old.get('settings') or {}, new.get('settings') or {}
+        self.settings = {key: new_settings.get(key) for key in changed_fields(old_settings, new_settings)}
+        self.devices = self.diff_section(old.get('devices'), new.get('devices'))
+        self.sensors = self.diff_section(old.get('sensors'), new.get('sensors'))
+        self.plcs = self.diff_section(old.get('plcs'), new.get('plcs'))
+        self.connections = (old.get('connections') or {}) != (new.get('connections') or {})
+        self.symbols = (old.get('symbols') or {}) != (new.get('symbols') or {})
+
+    @staticmethod
+    def diff_section(old_items: list, new_items: list) -> dict:
+        old_items, new_items = by_label(old_items), by_label(new_items)
+        changed = {}
+        added = [label for label in new_items if label not in old_items]
+        removed = [label for label in old_items if label not in new_items]
+        for label in new_items.keys() & old_items.keys():
+            fields = changed_fields(old_items[label], new_items[label])
+            if TAG_KEY in fields:
+                # another kind of object under the same label
+                added.append(label)
+                removed.append(label)
+            elif fields:
+                changed[label] = fields
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    def topology_changed(self) -> bool:
+        """True if the connections between devices must be built again"""
+        return bool(self.devices['added'] or self.devices['removed'] or self.connections or self.symbols)
+
+    def sensors_changed(self) -> bool:
+        return any(self.sensors.values())
+
+    def restart_reasons(self) -> list[str]:
+        """Return the changes which can't be applied to the running simulation"""
+        reasons = [f"setting {key}" for key in self.settings if key in restart_settings]
+        if self.plcs['added'] or self.plcs['removed']:
+            reasons.append(f"PLCs added or removed {sorted(self.plcs['added'] + self.plcs['removed'])}")
+        for label, fields in self.plcs['changed'].items():
+            reasons += [f"PLC {label} {field}" for field in fields if field not in reloadable_plc_fields]
+        return reasons
+
+    def empty(self) -> bool:
+        return not (self.settings or self.topology_changed() or self.devices['changed'] or self.sensors_changed()
+                    or self.plcs['changed'])
+
+    def __str__(self):
+        parts = [f"settings {sorted(self.settings)}"] if self.settings else []
+        for name in ('devices', 'sensors', 'plcs'):
+            section = getattr(self, name)
+            for change in ('added', 'removed'):
+                if section[change]:
+                    parts.append(f"{name} {change} {sorted(section[change])}")
+            if section['changed']:
+                parts.append(f"{name} changed {section['changed']}")
+        if self.connections:
+            parts.append("connections")
+        if self.symbols:
+            parts.append("symbols")
+        return ', '.join(parts)
+
+
+class ConfigWatcher(object):
+    """Poll the modification time of the yaml config file and compare its new versions with the running config"""
+
+    def __init__(self, path_to_yaml_config: str, poll_period: float = 1):
+        """
+        :param path_to_yaml_config: path of the config file of the running simulation
+        :param poll_period: minimal wall clock time in seconds between two checks of the file
+        """
+        self.path_to_yaml_config = path_to_yaml_config
+        self.poll_period = poll_period
+        self.next_poll = time.monotonic() + poll_period
+        self.mtime_ns = os.stat(path_to_yaml_config).st_mtime_ns
+        with open(path_to_yaml_config, 'r') as stream:
+            self.raw_config = yaml.load(stream, Loader=RawLoader)
+
+    def poll(self):
+        """
+        Check whether the config file changed since the last accepted version
+        :return: (ConfigDiff, config, raw config) of the new version, config is parsed with the simulation loader,
+        None if the file didn't change or can't be parsed
+        """
+        now = time.monotonic()
+        if now < self.next_poll:
+            return None
+        self.next_poll = now + self.poll_period
+        try:
+            mtime_ns = os.stat(self.path_to_yaml_config).st_mtime_ns
+            if mtime_ns == self.mtime_ns:
+                return None
+            self.mtime_ns = mtime_ns
+            with open(self.path_to_yaml_config, 'r') as stream:
+                text = stream.read()
+            raw_config = yaml.load(text, Loader=RawLoader)
+            config = yaml.load(text, Loader=yaml.Loader)
+        except Exception as error:
+            # the file may be in the middle of a save, it is read again at its next modification
+            log.error(f"Config {self.path_to_yaml_config} not reloaded: {error}")
+            return None
+        return ConfigDiff(self.raw_config, raw_config), config, raw_config
+
+    def accept(self, raw_config: dict) -> None:
+        """Set the raw config the next versions are compared with"""
+        self.raw_config = raw_config
@@ -1,18 +1,85 @@
+import itertools
 import logging
-import uuid
 from abc import abstractmethod
+from collections.abc import Mapping
+from types import MappingProxyType
 from typing import Union
 
+import numpy as np
 import sympy.core.evalf as sp_evalf
-import sympy.parsing.mathematica as mp
-import sympy.parsing.sympy_parser as sp
 import yaml
 
+from Expression import FlowExpression, runtime_attributes
 from Fluid import Fluid
 from utils import Allowed_math_type
 
 log = logging.getLogger('phy_sim')
 allowed_device_types = ['pump', 'valve', 'filter', 'tank', 'reservoir', 'vessel']
+# read-only empty dict shared by the devices until they get their first connection, expression or symbol
+_EMPTY = MappingProxyType({})
+# unique ids given at creation, `build_device_graph` replaces them by dense ids
+_device_ids = itertools.count()
+
+
+class SymbolScope(dict):
+    """Symbols of one device for sympy/wolfram expressions: the device's own symbols (accepted_volume, ...) are
+    stored here, the other names are looked up in the symbol table shared by all the devices"""
+    __slots__ = ('shared',)
+
+    def __init__(self, shared: dict):
+        """
+        :param shared: symbol table of the plant, config symbols and devices by label
+        """
+        super(SymbolScope, self).__init__()
+        self.shared = shared
+
+    def __missing__(self, key):
+        return self.shared[key]
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.shared
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def subs(self, expr):
+        """Substitute the free symbols of the sympy `expr` known in this scope"""
+        return expr.subs({symbol: self[symbol.name] for symbol in expr.free_symbols if symbol.name in self})
+
+
+def per_step(per_cycle: Union[int, float], per_second: Union[int, float, None], dt: float, cycle_time: float):
+    """
+    Convert a quantity given per cycle or per second to the quantity of one simulation step
+    :param per_cycle: quantity per cycle of `cycle_time` seconds, used if `per_second` is None
+    :param per_second: quantity per second
+    :param dt: duration of a simulation step in seconds
+    :param cycle_time: duration of the cycles of `per_cycle` quantities in seconds (`sim_speed`)
+    """
+    if per_second is not None:
+        return per_second * dt
+    if dt == cycle_time:
+        return per_cycle
+    return per_cycle * dt / cycle_time
+
+
+def to_units(value: Union[int, float], volume_unit: Union[float, None]) -> Union[int, float]:
+    """
+    Convert a volume to a whole number of `volume_unit`, infinite and unconverted (None unit) volumes are kept
+    :param value: volume in the configuration unit
+    :param volume_unit: volume of one unit, `fixed_point_resolution`
+    """
+    if volume_unit is None or value == float('inf'):
+        return value
+    return int(round(value / volume_unit))
+
+
+def split_volume(volume: int, parts: int, offset: int = 0) -> list[int]:
+    """
+    Split an integer `volume` in `parts` shares, the remainder is given unit by unit from the share `offset`
+    :return: shares, their sum is `volume`
+    """
+    share, remainder = divmod(volume, parts)
+    return [share + ((index - offset) % parts < remainder) for index in range(parts)]
 
 
 class InvalidDevice(Exception):
@@ -28,6 +95,9 @@ class Device(yaml.YAMLObject):
     """
     Base class for all devices
     """
+    __slots__ = ('uid', 'device_type', 'label', 'input_devices', 'output_devices', 'fluid', 'current_flow_rate',
+                 'active', 'state', 'math_parser', 'output_devices_expr', 'input_devices_expr', 'symbol_dict',
+                 'precision', 'volume_unit', 'split_offset')
 
     def __init__(self, device_type=None, fluid=None, label='', state=None):
         """
@@ -43,25 +113,32 @@ class Device(yaml.YAMLObject):
         :attr active: active state of device
         :attr state: state of device
         :attr math_parser: str. type of math parser used
-        :attr output_devices_expr: dict of output devices expressions, key is label, value is the math expression
-        :attr input_devices_expr: dict of input devices expressions, key is label, value is the math expression
-        :attr symbol_dict: dict of symbols, key is label used in yaml/math expression, value is the variable that can be modified
+        :attr output_devices_expr: dict of output devices expressions, key is label, value is the FlowExpression
+        :attr input_devices_expr: dict of input devices expressions, key is label, value is the FlowExpression
+        :attr symbol_dict: dict of symbols, key is label used in yaml/math expression, value is the variable that can be modified,
+            the symbols shared by all devices are looked up in the plant symbol table
         :attr precision: number of digits rounded
+        :attr volume_unit: volume of one unit with the fixed point volumes, volumes are then integers, None for float
+            volumes
+        :attr split_offset: first device getting the remainder of the next split, it moves on at each split so that
+            the remainders are spread over the devices
         """
-        self.uid = str(uuid.uuid4())[:8]
+        self.uid = next(_device_ids)
         self.device_type = device_type
         self.label = label
-        self.input_devices = {}
-        self.output_devices = {}
+        self.input_devices = _EMPTY
+        self.output_devices = _EMPTY
         self.fluid = fluid
         self.current_flow_rate = 0
         self.active = False
         self.state = state
         self.math_parser = None
-        self.output_devices_expr = {}
-        self.input_devices_expr = {}
-        self.symbol_dict = {}
+        self.output_devices_expr = _EMPTY
+        self.input_devices_expr = _EMPTY
+        self.symbol_dict = _EMPTY
         self.precision = 10
+        self.volume_unit = None
+        self.split_offset = 0
 
         if (not self.device_type) or (self.device_type not in allowed_device_types):
             raise InvalidDevice(f"{self.device_type} in not a valid device type")
@@ -77,6 +154,8 @@ class Device(yaml.YAMLObject):
         """Add the connected `device` to our input_devices and add this device to the connected device's outputs
         """
         if device.uid not in self.input_devices:
+            if not isinstance(self.input_devices, dict):
+                self.input_devices = dict(self.input_devices)
             self.input_devices[device.uid] = device
             device.add_output(self)
             log.info(f"{self}: Added input <- {device}")
@@ -85,25 +164,96 @@ class Device(yaml.YAMLObject):
         """Add the connected device to our outputs and add this device to connected device's input_devices
         """
         if device.uid not in self.output_devices:
+            if not isinstance(self.output_devices, dict):
+                self.output_devices = dict(self.output_devices)
             self.output_devices[device.uid] = device
             device.add_input(self)
             log.info(f"{self}: Added output -> {device}")
 
     def add_symbol(self, label: str, value) -> None:
         """Add a symbol to the symbol dict used for sympy"""
-        self.symbol_dict.update({label: value})
+        self.add_symbols({label: value})
         log.debug(f"Added Label: {label} -> {value} in symbols")
 
+    def add_symbols(self, symbols: dict) -> None:
+        """Add symbols to the symbol dict used for sympy"""
+        if self.symbol_dict is _EMPTY:
+            self.symbol_dict = {}
+        self.symbol_dict.update(symbols)
+
+    def set_symbol_table(self, symbol_table: dict) -> None:
+        """Resolve the symbols this device doesn't define in `symbol_table`, shared by all the devices"""
+        symbol_dict = SymbolScope(symbol_table)
+        symbol_dict.update(self.symbol_dict)
+        self.symbol_dict = symbol_dict
+        # dependencies of the expressions are resolved in the new table
+        self.bind_expressions()
+
+    def bind_expressions(self) -> None:
+        """Extract the dependencies of the expressions again and drop their cached value"""
+        for expr in list(self.output_devices_expr.values()) + list(self.input_devices_expr.values()):
+            expr.bind(self.symbol_dict, self.math_parser)
+
     def add_to_device_expr(self, label: str, value) -> None:
         """Add expression to an output to a device"""
-        self.output_devices_expr.update({label: value})
+        if self.output_devices_expr is _EMPTY:
+            self.output_devices_expr = {}
+        self.output_devices_expr[label] = value if isinstance(value, FlowExpression) else FlowExpression(value)
         log.debug(f"Added Expression: push to {label} amount of {value} fluid")
 
     def add_from_device_expr(self, label: str, value) -> None:
         """Add expression to an input from a device"""
-        self.input_devices_expr.update({label: value})
+        if self.input_devices_expr is _EMPTY:
+            self.input_devices_expr = {}
+        self.input_devices_expr[label] = value if isinstance(value, FlowExpression) else FlowExpression(value)
         log.debug(f"Added Expression: pull from {label} amount of {value} fluid")
 
+    def set_time_step(self, dt: float, cycle_time: float) -> None:
+        """Convert the rates of the device to quantities per simulation step, override this for devices with rates
+        :param dt: duration of a simulation step in seconds
+        :param cycle_time: duration of the cycles of per cycle quantities in seconds (`sim_speed`)
+        """
+        pass
+
+    def set_volume_unit(self, volume_unit: float) -> None:
+        """Store the volumes of the device as integer numbers of `volume_unit`, call it before `set_time_step`,
+        override this for devices holding volumes"""
+        self.volume_unit = volume_unit
+
+    def update_parameters(self, device: 'Device', fields: list[str]) -> None:
+        """
+        Copy the configuration `fields` of `device`, the same device built from a new version of the config,
+        the runtime state (state, volume, fluid) is kept, call `set_time_step` afterwards
+        """
+        for field in fields:
+            if field not in runtime_attributes and field != 'label' and hasattr(device, field):
+                setattr(self, field, getattr(device, field))
+        log.info(f"{self}: Updated {fields}")
+
+    def disconnect(self) -> None:
+        """Remove the connections, expressions and symbols of the device"""
+        self.input_devices = _EMPTY
+        self.output_devices = _EMPTY
+        self.output_devices_expr = _EMPTY
+        self.input_devices_expr = _EMPTY
+        self.symbol_dict = _EMPTY
+
+    def split(self, volume: int, parts: int) -> list[int]:
+        """Split an integer `volume` between `parts` devices, the remainders go to each device in turn"""
+        shares = split_volume(volume, parts, self.split_offset % parts)
+        self.split_offset += volume % parts
+        return shares
+
+    @property
+    def ph(self) -> float:
+        """pH of the fluid held by, or flowing through, the device"""
+        return self.fluid.read_property('ph') if self.fluid is not None else 0
+
+    @property
+    def chlorine(self) -> float:
+        """Free chlorine concentration of the fluid held by, or flowing through, the device"""
+        return self.fluid.read_property('chlorine') if self.fluid is not None else 0
+
     def reset_current_flow_rate(self) -> None:
         """Reset the current flow rate of the device"""
         self.current_flow_rate = 0
@@ -166,39 +316,41 @@ class Device(yaml.YAMLObject):
         Generic input fluid function:
         proportional: determine the number of output devices, then call each device with the same amount of volume
         sympy/wolfram: decided by the yaml configuration
+        :return: volume accepted by the output devices
         """
+        output_devices = self.output_devices.values()
         open_device_number = 0
-        for o in self.output_devices:
+        for output_device in output_devices:
             # TODO: There might be a bug here, should be active
-            if self.output_devices[o].state or self.output_devices[o].state is None:
+            if output_device.state or output_device.state is None:
                 open_device_number += 1
         # When no tank can take the input of fluid
         if open_device_number == 0:
             log.error(f"device {self} has no device to output fluid")
             return 0
-        if self.math_parser == Allowed_math_type.proportional.value:
-            for o in self.output_devices:
+        accepted_volume = 0
+        if self.volume_unit is not None:
+            # integer volumes, the remainder goes to the first open devices
+            shares = iter(self.split(volume, open_device_number))
+            for output_device in output_devices:
+                if output_device.state or output_device.state is None:
+                    accepted_volume += output_device.input(fluid, next(shares))
+        elif self.math_parser == Allowed_math_type.proportional.value:
+            for output_device in output_devices:
                 # Send the fluid on to all outputs equally
                 # log.debug(
-                #     f"Device {self} call input of output_device {self.output_devices[o]} with volume {volume / open_device_number}")
-                self.output_devices[o].input(fluid, volume / open_device_number)
+                #     f"Device {self} call input of output_device {output_device} with volume {volume / open_device_number}")
+                accepted_volume += output_device.input(fluid, volume / open_device_number)
         else:
-            self.symbol_dict['accepted_volume'] = volume
-            self.symbol_dict['open_output_devices_number'] = open_device_number
-
-            if self.math_parser == Allowed_math_type.sympy.value:
-                for devices_label, expr in self.output_devices_expr.items():
-                    # log.debug(f"Device {self} call input of output_device {self.symbol_dict[devices_label]} "
-                    #           f"with volume {sp_evalf.N(sp.parse_expr(expr, local_dict=self.symbol_dict), self.precision)}")
-                    self.symbol_dict[devices_label] \
-                        .input(fluid, sp_evalf.N(sp.parse_expr(expr, local_dict=self.symbol_dict), self.precision))
-
-            elif self.math_parser == Allowed_math_type.wolfram.value:
-                for devices_label, expr in self.output_devices_expr.items():
-                    # log.debug(f"Device {self} call input of output_device {self.symbol_dict[devices_label]} "
-                    #           f"with volume {sp_evalf.N(mp.mathematica(expr).subs(self.symbol_dict), self.precision)}")
-                    self.symbol_dict[devices_label] \
-                        .input(fluid, sp_evalf.N(mp.mathematica(expr).subs(self.symbol_dict), self.precision))
+            self.add_symbols({'accepted_volume': volume, 'open_output_devices_number': open_device_number})
+
+            # expressions are computed again only when their dependencies changed
+            for devices_label, expr in self.output_devices_expr.items():
+                # log.debug(f"Device {self} call input of output_device {self.symbol_dict[devices_label]} "
+                #           f"with volume {expr.evaluate(self.symbol_dict, self.math_parser, self.precision)}")
+                accepted_volume += self.symbol_dict[devices_label] \
+                    .input(fluid, expr.evaluate(self.symbol_dict, self.math_parser, self.precision))
+        return accepted_volume
 
     def output_fluid(self, volume: Union[int, float]) -> Union[int, None]:
         """
@@ -206,61 +358,154 @@ class Device(yaml.YAMLObject):
         proportional: determine the number of input devices, then call each device with the same amount of volume
         sympy/wolfram: decided by the yaml configuration
         """
+        input_devices = self.input_devices.values()
         open_device_number = 0
-        for o in self.input_devices:
+        for input_device in input_devices:
             # TODO: There might be a bug here, should be active
-            if self.input_devices[o].state or self.input_devices[o].state is None:
+            if input_device.state or input_device.state is None:
                 open_device_number += 1
         # When no tank can take the input of fluid
         if open_device_number == 0:
             log.error(f"device {self} has no device to get input fluid")
             return 0
-        if self.math_parser == Allowed_math_type.proportional.value:
-            for o in self.input_devices:
+        if self.volume_unit is not None:
+            shares = iter(self.split(volume, open_device_number))
+            for input_device in input_devices:
+                if input_device.state or input_device.state is None:
+                    input_device.output(self, next(shares))
+        elif self.math_parser == Allowed_math_type.proportional.value:
+            for input_device in input_devices:
                 # Request the fluid from all inputs devices equally
                 # log.debug(
-                #     f"Device {self} call output of input device {self.input_devices[o]} with volume {volume / open_device_number}")
-                self.input_devices[o].output(self, sp_evalf.N(volume / open_device_number, self.precision))
+                #     f"Device {self} call output of input device {input_device} with volume {volume / open_device_number}")
+                input_device.output(self, sp_evalf.N(volume / open_device_number, self.precision))
         else:
-            self.symbol_dict['requested_volume'] = volume
-            self.symbol_dict['open_input_devices_number'] = open_device_number
-            if self.math_parser == Allowed_math_type.sympy.value:
-                for devices_label, expr in self.input_devices_expr.items():
-                    # log.debug(f"Device {self} call output of input device {self.symbol_dict[devices_label]} "
-                    #           f"with volume {sp_evalf.N(sp.parse_expr(expr, local_dict=self.symbol_dict), self.precision)}")
-                    self.symbol_dict[devices_label] \
-                        .output(self, sp_evalf.N(sp.parse_expr(expr, local_dict=self.symbol_dict), self.precision))
-            elif self.math_parser == Allowed_math_type.wolfram.value:
-                for devices_label, expr in self.input_devices_expr.items():
-                    # log.debug(f"Device {self} call output of input device {self.symbol_dict[devices_label]} "
-                    #           f"with volume {sp_evalf.N(mp.mathematica(expr).subs(self.symbol_dict), self.precision)}")
-                    self.symbol_dict[devices_label] \
-                        .output(self, sp_evalf.N(mp.mathematica(expr).subs(self.symbol_dict), self.precision))
+            self.add_symbols({'requested_volume': volume, 'open_input_devices_number': open_device_number})
+            for devices_label, expr in self.input_devices_expr.items():
+                # log.debug(f"Device {self} call output of input device {self.symbol_dict[devices_label]} "
+                #           f"with volume {expr.evaluate(self.symbol_dict, self.math_parser, self.precision)}")
+                self.symbol_dict[devices_label] \
+                    .output(self, expr.evaluate(self.symbol_dict, self.math_parser, self.precision))
 
     def __repr__(self):
         return f"Device: {self.uid} || {self.device_type} || {self.label}"
 
 
+class DeviceGraph(object):
+    """Connections between devices as compressed sparse rows of dense device ids: the neighbours of the device
+    `uid` are `indices[indptr[uid]:indptr[uid + 1]]`, the same rows of the neighbour lists hold the device objects.
+    The devices `input_devices` and `output_devices` are read-only views over it"""
+
+    def __init__(self, devices: list[Device]):
+        """
+        :param devices: connected devices, their uid must be their index in the list
+        """
+        self.devices = list(devices)
+        self.input_indptr, self.input_indices = self.compress([device.input_devices for device in self.devices])
+        self.output_indptr, self.output_indices = self.compress([device.output_devices for device in self.devices])
+        self.input_neighbours = [self.devices[uid] for uid in self.input_indices.tolist()]
+        self.output_neighbours = [self.devices[uid] for uid in self.output_indices.tolist()]
+
+    @staticmethod
+    def compress(neighbours: list) -> tuple[np.ndarray, np.ndarray]:
+        """Return the (indptr, indices) arrays of the neighbours of each device, in connection order"""
+        indptr = np.zeros(len(neighbours) + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum([len(row) for row in neighbours])
+        indices = np.fromiter((device.uid for row in neighbours for device in row.values()), dtype=np.int32,
+                              count=int(indptr[-1]))
+        return indptr, indices
+
+    def input_view(self, uid: int) -> 'AdjacencyView':
+        return AdjacencyView(self.input_indices, self.input_neighbours,
+                             int(self.input_indptr[uid]), int(self.input_indptr[uid + 1]))
+
+    def output_view(self, uid: int) -> 'AdjacencyView':
+        return AdjacencyView(self.output_indices, self.output_neighbours,
+                             int(self.output_indptr[uid]), int(self.output_indptr[uid + 1]))
+
+
+class AdjacencyView(Mapping):
+    """Read-only dict of the input or output devices of a device, key is uid, value is the device object"""
+    __slots__ = ('indices', 'neighbours', 'start', 'stop')
+
+    def __init__(self, indices: np.ndarray, neighbours: list[Device], start: int, stop: int):
+        """
+        :param indices: neighbour ids of all devices
+        :param neighbours: neighbour objects of all devices
+        :param start: first row of the device in `indices` and `neighbours`
+        :param stop: last row + 1 of the device
+        """
+        self.indices = indices
+        self.neighbours = neighbours
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, uid: int) -> Device:
+        for device in self.values():
+            if device.uid == uid:
+                return device
+        raise KeyError(uid)
+
+    def __contains__(self, uid) -> bool:
+        return any(device.uid == uid for device in self.values())
+
+    def __iter__(self):
+        return iter(self.indices[self.start:self.stop].tolist())
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def values(self) -> list[Device]:
+        return self.neighbours[self.start:self.stop]
+
+    def items(self) -> list[tuple[int, Device]]:
+        return [(device.uid, device) for device in self.values()]
+
+
+def build_device_graph(devices: list[Device]) -> DeviceGraph:
+    """Give the devices dense ids in list order and replace their connection dicts by views over a `DeviceGraph`"""
+    for uid, device in enumerate(devices):
+        device.uid = uid
+    graph = DeviceGraph(devices)
+    for device in devices:
+        device.input_devices = graph.input_view(device.uid)
+        device.output_devices = graph.output_view(device.uid)
+    return graph
+
+
 class Pump(Device):
+    __slots__ = ('volume_per_cycle', 'volume_per_second', 'volume_per_step', 'head', 'resistance')
     yaml_tag = u'!pump'
     yaml_loader = yaml.Loader
 
-    def __init__(self, device_type='pump', state='off', volume_per_cycle: Union[int, float] = 1, **kwargs):
+    def __init__(self, device_type='pump', state='off', volume_per_cycle: Union[int, float] = 1,
+                 volume_per_second: Union[int, float] = None, head: float = 10, resistance: float = None, **kwargs):
         """
         Constructor
         :param device_type: type of device (pump)
         :param state: state of device (on, off)
         :param volume_per_cycle: volume of fluid to pump each cycle
+        :param volume_per_second: volume of fluid to pump each second, replaces `volume_per_cycle`
+        :param head: shutoff head of the pump, used by the hydraulic physics
+        :param resistance: head loss coefficient of the pump, used by the hydraulic physics
         """
         state = bool(['off', 'on'].index(state))
         self.volume_per_cycle = volume_per_cycle
+        self.volume_per_second = volume_per_second
+        self.volume_per_step = volume_per_cycle
+        self.head = head
+        self.resistance = resistance
         super(Pump, self).__init__(device_type=device_type, state=state, **kwargs)
 
+    def set_time_step(self, dt: float, cycle_time: float) -> None:
+        self.volume_per_step = to_units(per_step(self.volume_per_cycle, self.volume_per_second, dt, cycle_time),
+                                        self.volume_unit)
+
     def worker(self):
         """Manipulate the fluid just as this device would in the real world
         """
         if self.state:
-            self.output_fluid(self.volume_per_cycle)
+            self.output_fluid(self.volume_per_step)
 
     def input(self, fluid: Fluid, volume: Union[int, float] = 1) -> Union[int, float]:
         """Receive the fluid, add it to output devices equally
@@ -269,9 +514,9 @@ class Pump(Device):
         """
         if self.state:
             self.fluid = fluid
-            self.current_flow_rate += volume
-            self.input_fluid(fluid, volume)
-            return volume
+            accepted_volume = self.input_fluid(fluid, volume)
+            self.current_flow_rate += accepted_volume
+            return accepted_volume
         else:
             return 0
 
@@ -281,7 +526,7 @@ class Pump(Device):
         :param volume: volume of fluid
         """
         if self.state:
-            if self.current_flow_rate + volume >= self.volume_per_cycle:
+            if self.current_flow_rate + volume >= self.volume_per_step:
                 log.warning(f"EXCEED {self} volume_per_cycle")
             self.output_fluid(volume)
             return volume
@@ -300,16 +545,19 @@ class Pump(Device):
 
 
 class Valve(Device):
+    __slots__ = ('resistance',)
     yaml_tag = u'!valve'
     yaml_loader = yaml.Loader
 
-    def __init__(self, device_type='valve', state='closed', **kwargs):
+    def __init__(self, device_type='valve', state='closed', resistance: float = None, **kwargs):
         """
         Constructor
         :param device_type: type of device (valve)
         :param state: state of device (closed, open)
+        :param resistance: head loss coefficient of the open valve, used by the hydraulic physics
         """
         state = bool(['closed', 'open'].index(state))
+        self.resistance = resistance
         super(Valve, self).__init__(device_type=device_type, state=state, **kwargs)
 
     def open(self):
@@ -341,18 +589,28 @@ class Valve(Device):
             Normally used when pump's push fluid through.
         """
         if self.state:
-            self.current_flow_rate += volume
-            self.input_fluid(fluid, volume)
-            return volume
+            accepted_volume = self.input_fluid(fluid, volume)
+            self.current_flow_rate += accepted_volume
+            return accepted_volume
         else:
             return 0
 
 
 class Filter(Device):
+    __slots__ = ('removal', 'resistance')
     yaml_tag = u'!filter'
     yaml_loader = yaml.Loader
 
-    def __init__(self, device_type='filter', **kwargs):
+    def __init__(self, device_type='filter', removal: dict = None, resistance: float = None, **kwargs):
+        """
+        Constructor
+        :param device_type: type of device (filter)
+        :param removal: dict of fluid property (chlorine, salinity) to the fraction the filter removes,
+        applied with the `quality_model`
+        :param resistance: head loss coefficient of the filter, used by the hydraulic physics
+        """
+        self.removal = removal
+        self.resistance = resistance
         super(Filter, self).__init__(device_type=device_type, **kwargs)
 
     def worker(self):
@@ -363,50 +621,74 @@ class Filter(Device):
         return volume
 
     def input(self, fluid: Fluid, volume: Union[int, float] = 1):
-        self.current_flow_rate += volume
-        self.input_fluid(fluid, volume)
-        return volume
+        if self.fluid is not None and self.fluid.quality_store is not None:
+            # the filtered fluid is mixed with the filter's and passed on, so it is treated one cycle later
+            accepted_volume = self.input_fluid(self.fluid, volume)
+            self.fluid.quality_store.transfer(self.fluid, fluid, accepted_volume)
+        else:
+            accepted_volume = self.input_fluid(fluid, volume)
+        self.current_flow_rate += accepted_volume
+        return accepted_volume
 
 
 class Tank(Device):
     """Infinite volume tank!"""
+    __slots__ = ('volume', 'max_volume', 'elevation', 'area')
     yaml_tag = u'!tank'
     yaml_loader = yaml.Loader
 
     def __init__(self, volume: Union[int, float] = 0, max_volume: float = float('inf'), device_type: str = 'tank',
-                 state: bool = True, **kwargs):
+                 state: bool = True, elevation: float = 0, area: float = None, **kwargs):
         """
         Constructor
         :param volume: initial volume of fluid in the tank
         :param max_volume: maximum volume of fluid in the tank
+        :param elevation: elevation of the bottom of the tank, used by the hydraulic physics
+        :param area: section of the tank, the head is `elevation` + `volume` / `area`, default gives a level
+        between 0 and 1 (1 for infinite tanks)
         """
         self.volume = volume
         self.max_volume = max_volume
+        self.elevation = elevation
+        self.area = area if area is not None else (max_volume if 0 < max_volume < float('inf') else 1)
         super(Tank, self).__init__(device_type=device_type, state=state, **kwargs)
 
+    def update_parameters(self, device: 'Device', fields: list[str]) -> None:
+        super(Tank, self).update_parameters(device, fields)
+        if 'max_volume' in fields:
+            self.max_volume = to_units(self.max_volume, self.volume_unit)
+
+    def set_volume_unit(self, volume_unit: float) -> None:
+        if self.volume_unit is None:
+            self.volume = to_units(self.volume, volume_unit)
+            self.max_volume = to_units(self.max_volume, volume_unit)
+        super(Tank, self).set_volume_unit(volume_unit)
+
     def __increase_volume(self, volume: Union[int, float]):
         """Raise the tank's volume by `volume`
         :param volume: amount of volume to raise
         :return: amount of volume that was accepted
         """
-        self.volume += self.__check_increase_volume(volume)
-        return volume
+        accepted_volume = self.__check_increase_volume(volume)
+        self.volume += accepted_volume
+        return accepted_volume
 
     def __decrease_volume(self, volume: Union[int, float]):
         """Lower the tank's volume by `volume`
         If it cannot decrease the requested volume, self.volume doesn't change
         :param volume: amount of volume to lower
-        :return: amount of volume that can be lowered
+        :return: amount of volume that was lowered
         """
-        self.volume -= self.__check_decrease_volume(volume)
-        return volume
+        lowered_volume = self.__check_decrease_volume(volume)
+        self.volume -= lowered_volume
+        return lowered_volume
 
     def __check_increase_volume(self, volume: Union[int, float]):
         """See if the tank has enough space to store the received `volume` amount
         :param volume: amount of volume to raise
         :return: amount of volume that can be raised
         """
-        if self.volume == self.max_volume:
+        if self.volume >= self.max_volume:
             volume = 0
             log.warning(f"{self} full")
         elif self.volume + volume < self.max_volume:
@@ -438,10 +720,14 @@ class Tank(Device):
         self.fluid = new_context
 
     def input(self, fluid: Fluid, volume: Union[int, float] = 1):
-        """Receive `volume` amount of `fluid`"""
-        self.__update_fluid(fluid)
+        """Receive `volume` amount of `fluid`, mixed with the fluid of the tank with the `quality_model`"""
+        quality_store = self.fluid.quality_store if self.fluid is not None else None
+        if quality_store is None:
+            self.__update_fluid(fluid)
         accepted_volume = self.__increase_volume(volume)
-        self.current_flow_rate += volume
+        if quality_store is not None and accepted_volume:
+            quality_store.transfer(self.fluid, fluid, accepted_volume)
+        self.current_flow_rate += accepted_volume
         return accepted_volume
 
     # Tank output to only one device
@@ -452,7 +738,7 @@ class Tank(Device):
         """
         accepted_volume = to_device.input(self.fluid, self.__check_decrease_volume(volume))
         self.__decrease_volume(accepted_volume)
-        self.current_flow_rate -= volume
+        self.current_flow_rate -= accepted_volume
         return accepted_volume
 
     def worker(self):
@@ -462,31 +748,44 @@ class Tank(Device):
 
 class Reservoir(Tank):
     # TODO: fix the issue for self input (workaround -> add tank+pump+valve as the initial tank input)
+    __slots__ = ('input_per_cycle', 'input_per_second', 'input_per_step', 'input_fluid_source')
     yaml_tag = u'!reservoir'
     yaml_loader = yaml.Loader
 
     def __init__(self, device_type: str = 'reservoir', input_per_cycle: Union[int, float] = 0, self_input="no",
-                 **kwargs):
+                 input_per_second: Union[int, float] = None, **kwargs):
         """
         Constructor
         :param device_type: type of device (reservoir)
         :param input_per_cycle: amount of fluid to add per cycle
+        :param input_per_second: amount of fluid to add per second, replaces `input_per_cycle`
 
         """
         self.input_per_cycle = input_per_cycle
+        self.input_per_second = input_per_second
+        self.input_per_step = input_per_cycle
+        # fluid of the self input, with the initial properties of the reservoir fluid
+        self.input_fluid_source = None
         # if type(self_input) == bool:
         #     _inputs = self_input
         # else:
         #     _inputs = bool(['no', 'yes'].index(self_input))
         super(Reservoir, self).__init__(device_type=device_type, state=True, **kwargs)
 
+    def set_time_step(self, dt: float, cycle_time: float) -> None:
+        self.input_per_step = to_units(per_step(self.input_per_cycle, self.input_per_second, dt, cycle_time),
+                                       self.volume_unit)
+
     def worker(self):
         """Make sure that we don't run dry.
         """
-        self.volume += self.input_per_cycle
+        self.volume += self.input_per_step
+        if self.input_fluid_source is not None and self.input_per_step:
+            self.fluid.quality_store.transfer(self.fluid, self.input_fluid_source, self.input_per_step)
 
 
 class Vessel(Tank):
+    __slots__ = ()
     yaml_tag = u'!vessel'
     yaml_loader = yaml.Loader
 
@@ -506,12 +805,15 @@ class Vessel(Tank):
     def input(self, fluid: Fluid, volume: Union[int, float] = 1):
         """Receive `volume` amount of `fluid`
         :param volume: amount of volume to raise
-        :return: amount of volume that need to pass to the next device
+        :return: amount of volume stored or passed to the next devices
         """
         exceed_volume = self.increase_volume(volume)
-        self.current_flow_rate += exceed_volume
-        self.input_fluid(fluid, exceed_volume)
-        return exceed_volume
+        if self.fluid is not None and self.fluid.quality_store is not None and volume - exceed_volume:
+            self.fluid.quality_store.transfer(self.fluid, fluid, volume - exceed_volume)
+        passed_volume = self.input_fluid(fluid, exceed_volume) if exceed_volume else 0
+        self.current_flow_rate += passed_volume
+        # the exceed volume refused by the next devices is not accepted and stays upstream
+        return volume - exceed_volume + passed_volume
 
     # Tank output to only one device
     def output(self, to_device: 'Device', volume: Union[int, float] = 1):
@@ -0,0 +1,167 @@
+import builtins
+import io
+import keyword
+import logging
+import tokenize
+import types
+from enum import Enum
+
+import sympy.core.evalf as sp_evalf
+import sympy.parsing.mathematica as mp
+import sympy.parsing.sympy_parser as sp
+
+from utils import Allowed_math_type
+
+log = logging.getLogger('phy_sim')
+# symbols set by the device evaluating the expression, on each call
+flow_symbols = ('accepted_volume', 'requested_volume')
+state_symbols = ('open_output_devices_number', 'open_input_devices_number')
+# device attributes changed while the simulation runs, the other ones are read from the configuration
+runtime_attributes = frozenset({'state', 'active', 'volume', 'current_flow_rate', 'fluid', 'ph', 'chlorine'})
+# names available in sympy expressions, as in `sympy_parser.parse_expr`, built once
+_sympy_globals = None
+
+
+class Dependency(Enum):
+    """What an expression depends on, from the least to the most frequently changing"""
+    constant = 0
+    state = 1
+    flow = 2
+
+
+def sympy_globals() -> dict:
+    """Return the global names of sympy expressions, built on the first call"""
+    global _sympy_globals
+    if _sympy_globals is None:
+        _sympy_globals = {}
+        exec('from sympy import *', _sympy_globals)
+        for name, obj in vars(builtins).items():
+            if isinstance(obj, types.BuiltinFunctionType):
+                _sympy_globals[name] = obj
+        _sympy_globals['max'] = _sympy_globals['Max']
+        _sympy_globals['min'] = _sympy_globals['Min']
+    return _sympy_globals
+
+
+class FlowExpression(object):
+    """Math expression giving the volume exchanged with a connected device.
+    The expression is parsed once, its dependencies (symbols, `label.attribute` of devices, accepted/requested volume)
+    are extracted and the result is kept until the value of one of them changes"""
+    __slots__ = ('source', 'math_parser', 'code', 'dependencies', 'dependency', 'volatile', 'key', 'value',
+                 'evaluations')
+
+    def __init__(self, source: str):
+        """
+        :param source: expression, written for the math parser of the device
+
+        :attr dependencies: list of (device, attribute), device is None for the symbols of the device's scope
+        :attr dependency: Dependency, constant, state or flow
+        :attr volatile: True when the value can't be cached (chained attributes, calls of device attributes)
+        :attr key: values of the dependencies of the cached value
+        :attr evaluations: number of times the expression was computed
+        """
+        self.source = str(source)
+        self.math_parser = None
+        self.code = None
+        self.dependencies = []
+        self.dependency = None
+        self.volatile = False
+        self.key = None
+        self.value = None
+        self.evaluations = 0
+
+    def bind(self, scope: dict, math_parser: str) -> None:
+        """
+        Parse the expression and extract its dependencies
+        :param scope: symbols of the device, including the symbol table shared by the devices
+        :param math_parser: Allowed_math_type value
+        """
+        # Device imports this module
+        from Device import Device
+
+        self.math_parser = math_parser
+        self.key = None
+        self.volatile = False
+        if math_parser == Allowed_math_type.wolfram.value:
+            self.code = mp.mathematica(self.source)
+            names = [(symbol.name, None, False) for symbol in self.code.free_symbols]
+        else:
+            # compiled on the first evaluation, once the device defined its own symbols
+            self.code = None
+            names = self.python_names()
+        dependencies = []
+        dependency = Dependency.constant
+        for name, attribute, volatile in names:
+            self.volatile |= volatile
+            if name in flow_symbols:
+                dependencies.append((None, name))
+                dependency = Dependency.flow
+            elif name in state_symbols:
+                dependencies.append((None, name))
+                if dependency == Dependency.constant:
+                    dependency = Dependency.state
+            elif name in scope and isinstance(scope[name], Device):
+                if (attribute is None or attribute in runtime_attributes) and dependency == Dependency.constant:
+                    dependency = Dependency.state
+                dependencies.append((scope[name], attribute))
+            elif name in scope:
+                # config symbols don't change while the simulation runs
+                dependencies.append((None, name))
+        self.dependencies = dependencies
+        self.dependency = dependency
+        log.debug(f"Expression {self.source}: {dependency.name}, depends on {dependencies}")
+
+    def python_names(self) -> list:
+        """Return the (name, attribute, volatile) of the names used in a sympy expression, attribute is None when the
+        name isn't followed by an attribute access, volatile when the attribute is called or has attributes read"""
+        tokens = [token for token in tokenize.generate_tokens(io.StringIO(self.source).readline)
+                  if token.type in (tokenize.NAME, tokenize.OP)]
+        names = []
+        for index, token in enumerate(tokens):
+            if token.type != tokenize.NAME or keyword.iskeyword(token.string):
+                continue
+            if index > 0 and tokens[index - 1].string == '.':
+                continue
+            following = [t.string for t in tokens[index + 1:index + 4]] + ['', '', '']
+            if following[0] == '.':
+                names.append((token.string, following[1], following[2] in ('.', '(')))
+            else:
+                names.append((token.string, None, False))
+        return names
+
+    def dependency_values(self, scope: dict) -> tuple:
+        """Return the current value of each dependency"""
+        return tuple(scope[name] if device is None else (device if name is None else getattr(device, name))
+                     for device, name in self.dependencies)
+
+    def evaluate(self, scope: dict, math_parser: str, precision: int):
+        """
+        Return the value of the expression, computed again only when its dependencies changed
+        :param scope: symbols of the device
+        :param math_parser: Allowed_math_type value
+        :param precision: number of digits of the result
+        """
+        if self.math_parser != math_parser:
+            self.bind(scope, math_parser)
+        key = None
+        if not self.volatile:
+            key = () if self.dependency == Dependency.constant else self.dependency_values(scope)
+            if key == self.key:
+                return self.value
+        if self.math_parser == Allowed_math_type.wolfram.value:
+            value = scope.subs(self.code) if hasattr(scope, 'subs') else self.code.subs(scope)
+        else:
+            if self.code is None:
+                self.code = compile(sp.stringify_expr(self.source, scope, sympy_globals(),
+                                                      sp.standard_transformations), '<string>', 'eval')
+            value = eval(self.code, sympy_globals(), scope)
+        self.value = sp_evalf.N(value, precision)
+        self.key = key
+        self.evaluations += 1
+        return self.value
+
+    def __str__(self):
+        return self.source
+
+    def __repr__(self):
+        return repr(self.source)
@@ -1,13 +1,15 @@
 import logging
+import math
 import random
 import uuid
 
+import numpy as np
 import yaml
 
 log = logging.getLogger('phy_sim')
 
 
-# TODO: multiple fluids not implemented correctly, especially in device part !
+# TODO: without the quality model, tanks take the properties of the last fluid they received
 
 class InvalidFluid(Exception):
     """Exception handler for bad fluid types
@@ -21,19 +23,38 @@ class Fluid(yaml.YAMLObject):
     """Base class for all fluids
     """
     allowed_fluid_types = ['water', 'chlorine']
-
-    def __init__(self, fluid_type=None, ph=None, temperature=None, salinity=None, pressure=None, flow_rate=None):
+    # quality store holding the properties of this fluid, None if the fluid is not mixed
+    quality_store = None
+    quality_index = None
+
+    def __init__(self, fluid_type=None, ph=None, temperature=None, salinity=None, pressure=None, flow_rate=None,
+                 chlorine=None):
+        """
+        :param fluid_type: type of fluid ('water', 'chlorine')
+        :param ph: pH of the fluid
+        :param temperature: temperature of the fluid
+        :param salinity: salinity of the fluid
+        :param chlorine: free chlorine concentration of the fluid in mg/L
+        """
         self.uid = str(uuid.uuid4())[:8]
         self.fluid_type = fluid_type
-        self.ph = ph  # For later use
-        self.temperature = temperature  # For later use
-        self.salinity = salinity  # For later use
+        self.ph = ph
+        self.temperature = temperature
+        self.salinity = salinity
+        self.chlorine = chlorine
         self.pressure = pressure  # For later use
         self.flow_rate = flow_rate  # For later use
 
         if (not fluid_type) or (fluid_type not in self.allowed_fluid_types):
             raise InvalidFluid(f"'{flow_rate}' in not a valid fluid type")
 
+    def read_property(self, name: str) -> float:
+        """Return the property `name` (ph, chlorine, temperature, salinity) of the fluid, mixed if the fluid is in a
+        quality store"""
+        if self.quality_store is not None:
+            return self.quality_store.read(self.quality_index, name)
+        return getattr(self, name) or 0
+
     def __repr__(self):
         return f"{self.uid} {self.fluid_type} "
         # f"pH: {self.ph} " \
@@ -54,7 +75,8 @@ class Water(Fluid):
 
     def __init__(self, **kwargs):
         super(Water, self).__init__(fluid_type='water', **kwargs)
-        self.ph = round(random.uniform(6.5, 8.0), 2)
+        if self.ph is None:
+            self.ph = round(random.uniform(6.5, 8.0), 2)
 
 
 class Chlorine(Fluid):
@@ -63,4 +85,112 @@ class Chlorine(Fluid):
 
     def __init__(self, **kwargs):
         super(Chlorine, self).__init__(fluid_type='chlorine', **kwargs)
-        self.ph = 5
+        if self.ph is None:
+            self.ph = 5
+        if self.chlorine is None:
+            self.chlorine = 1000
+
+
+class FluidQualityStore(object):
+    """Properties of the fluids of the simulation in a struct of arrays, one column per fluid.
+    Tanks record the volumes they receive during a cycle with `transfer`, `mix` then averages the properties of all
+    receiving fluids at once, weighted by volume, with the properties the sources had at the beginning of the cycle.
+    pH is mixed as hydronium concentration"""
+    properties = ['hydronium', 'chlorine', 'temperature', 'salinity']
+
+    def __init__(self, capacity: int = 256):
+        """
+        :param capacity: number of transfers recorded per cycle before the buffers grow
+        """
+        self.values = np.zeros((len(self.properties), 0))
+        # device holding each fluid, its volume weights the fluid in the mixes, None for sources and flows
+        self.holders = []
+        # fraction of each property removed from the fluids passing through filters, per fluid
+        self.removals = np.zeros((len(self.properties), 0))
+        self.transfer_count = 0
+        # transfers of the last mixed cycle, repeated by `advance`
+        self.last_transfer_count = 0
+        self.destinations = np.zeros(capacity, dtype=int)
+        self.sources = np.zeros(capacity, dtype=int)
+        self.volumes = np.zeros(capacity)
+
+    def add(self, fluid: Fluid, holder=None, removal: dict = None, bind: bool = True) -> int:
+        """
+        Add a column initialized with the properties of `fluid`
+        :param holder: device holding the fluid (tank), None for a source or a flow
+        :param removal: dict of property name to the fraction removed from the fluid received each cycle
+        :param bind: if true, `fluid` reads and mixes its properties in this store
+        :return: index of the column
+        """
+        ph = fluid.ph if fluid.ph is not None else 7
+        column = [10 ** -ph, fluid.chlorine or 0, fluid.temperature or 0, fluid.salinity or 0]
+        self.values = np.column_stack([self.values, column])
+        removals = np.zeros(len(self.properties))
+        for name, fraction in (removal or {}).items():
+            if name not in self.properties[1:]:
+                raise ValueError(f'{name} can not be removed, removable properties are {self.properties[1:]}.')
+            removals[self.properties.index(name)] = fraction
+        self.removals = np.column_stack([self.removals, removals])
+        self.holders.append(holder)
+        index = len(self.holders) - 1
+        if bind:
+            fluid.quality_store = self
+            fluid.quality_index = index
+        return index
+
+    def read(self, index: int, name: str) -> float:
+        """Return the property `name` of the fluid at `index`, `ph` is computed from the hydronium concentration"""
+        if name == 'ph':
+            return -math.log10(self.values[0, index])
+        return float(self.values[self.properties.index(name), index])
+
+    def transfer(self, destination: Fluid, source: Fluid, volume: float) -> None:
+        """Record that `volume` of `source` was added to `destination` during this cycle"""
+        if source is None or source.quality_index is None:
+            return
+        if self.transfer_count == len(self.volumes):
+            self.destinations = np.concatenate([self.destinations, np.zeros_like(self.destinations)])
+            self.sources = np.concatenate([self.sources, np.zeros_like(self.sources)])
+            self.volumes = np.concatenate([self.volumes, np.zeros_like(self.volumes)])
+        self.destinations[self.transfer_count] = destination.quality_index
+        self.sources[self.transfer_count] = source.quality_index
+        self.volumes[self.transfer_count] = volume
+        self.transfer_count += 1
+
+    def held_volumes(self) -> np.ndarray:
+        """Return the volume held by each fluid, 0 for sources and flows"""
+        return np.array([float(holder.volume) if holder is not None else 0 for holder in self.holders])
+
+    def mix(self, held_volumes: np.ndarray = None, clear: bool = True) -> None:
+        """
+        Mix the volumes transferred during the cycle into their destination
+        :param held_volumes: volume of each fluid at the end of the cycle, default is the volume of the holders
+        :param clear: if false, the transfers are kept to be mixed again in the next cycle
+        """
+        count = self.transfer_count
+        if clear:
+            self.last_transfer_count = count
+            self.transfer_count = 0
+        if count == 0:
+            return
+        if held_volumes is None:
+            held_volumes = self.held_volumes()
+        destinations = self.destinations[:count]
+        volumes = self.volumes[:count]
+        size = len(self.holders)
+        received = np.bincount(destinations, weights=volumes, minlength=size)
+        received_values = np.array([np.bincount(destinations, weights=values[self.sources[:count]] * volumes,
+                                                minlength=size) for values in self.values])
+        kept = np.maximum(held_volumes - received, 0)
+        total = kept + received
+        mixed = (received > 0) & (total > 0)
+        self.values[:, mixed] = (self.values[:, mixed] * kept[mixed] + received_values[:, mixed]) / total[mixed]
+        self.values[:, mixed] *= 1 - self.removals[:, mixed]
+
+    def advance(self, steps: int, start_volumes: np.ndarray, end_volumes: np.ndarray) -> None:
+        """Repeat the transfers of the last cycle during `steps` cycles in which the held volumes move linearly
+        from `start_volumes` to `end_volumes`, used when the simulation jumps over steady cycles"""
+        self.transfer_count = self.last_transfer_count
+        for step in range(1, steps + 1):
+            self.mix(start_volumes + (end_volumes - start_volumes) * step / steps, clear=False)
+        self.transfer_count = 0
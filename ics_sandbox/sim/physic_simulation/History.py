@@ -0,0 +1,183 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+log = logging.getLogger('phy_sim')
+# suffix of the columns holding the state of a device
+STATE_SUFFIX = '.state'
+
+
+class HistoryBuffer(object):
+    """Fixed size ring buffer of the last cycles of every sensor reading and device state, kept in memory.
+    Each column is a contiguous float64 array, so the rows of a time range of one column are served as one or two
+    views of the buffer (two when the range wraps around the end), without copy.
+    `guard` extra rows are allocated and never served, so that the rows being sent aren't overwritten by the
+    next cycles of the running simulation"""
+
+    def __init__(self, sensor_labels: list[str], device_labels: list[str], cycles: int, guard: int = None):
+        """
+        :param sensor_labels: labels of the sensors, one column each
+        :param device_labels: labels of the devices, one `label.state` column each
+        :param cycles: number of cycles served
+        :param guard: number of rows allocated in addition to `cycles`, default is a quarter of `cycles`
+        """
+        self.sensor_labels = list(sensor_labels)
+        self.device_labels = list(device_labels)
+        self.columns = self.sensor_labels + [label + STATE_SUFFIX for label in self.device_labels]
+        self.column_indexes = {label: index for index, label in enumerate(self.columns)}
+        self.cycles = max(1, int(cycles))
+        self.capacity = self.cycles + (max(1, self.cycles // 4) if guard is None else int(guard))
+        self.timestamps = np.zeros(self.capacity, dtype=np.int64)
+        self.cycle_numbers = np.zeros(self.capacity, dtype=np.int64)
+        self.values = np.full((len(self.columns), self.capacity), np.nan, dtype=np.float64)
+        self.row = np.full(len(self.columns), np.nan, dtype=np.float64)
+        # number of rows written since the start, the next row goes to `written % capacity`
+        self.written = 0
+        self.lock = threading.Lock()
+
+    def record(self, timestamp_ns: int, cycle: int, readings: dict, devices: dict) -> None:
+        """
+        Add a row, overwriting the oldest one once the buffer is full
+        :param timestamp_ns: timestamp of the row of the simulation log
+        :param cycle: simulation cycle
+        :param readings: sensor readings of the cycle, key is the sensor label, missing sensors are NaN
+        :param devices: dict of devices, key is the label, missing devices or states which aren't numbers are NaN
+        """
+        row = self.row
+        for index, label in enumerate(self.sensor_labels):
+            row[index] = as_float(readings.get(label))
+        offset = len(self.sensor_labels)
+        for index, label in enumerate(self.device_labels):
+            device = devices.get(label)
+            row[offset + index] = as_float(getattr(device, 'state', None))
+        slot = self.written % self.capacity
+        with self.lock:
+            self.timestamps[slot] = timestamp_ns
+            self.cycle_numbers[slot] = cycle
+            self.values[:, slot] = row
+            self.written += 1
+
+    def segments(self, start_ns: int = None, end_ns: int = None) -> tuple[int, list[slice]]:
+        """
+        Return the slots of the served rows between `start_ns` and `end_ns` (included), oldest first
+        :return: (number of rows written before the first one, list of at most two slices of the buffer)
+        """
+        with self.lock:
+            written = self.written
+        count = min(written, self.cycles)
+        first = written - count
+        parts = [(first % self.capacity, min(first % self.capacity + count, self.capacity))]
+        if parts[0][1] - parts[0][0] < count:
+            parts.append((0, count - (parts[0][1] - parts[0][0])))
+        # timestamps increase along the served rows, each part is searched by bisection
+        skipped = 0
+        segments = []
+        for begin, end in parts:
+            low = begin if start_ns is None else begin + int(np.searchsorted(self.timestamps[begin:end], start_ns))
+            high = end if end_ns is None else begin + int(np.searchsorted(self.timestamps[begin:end], end_ns, 'right'))
+            if high > low:
+                if not segments:
+                    skipped += low - begin
+                segments.append(slice(low, high))
+            elif not segments:
+                skipped += end - begin
+        return first + skipped, segments
+
+    def overwritten(self, first_row: int) -> bool:
+        """True if rows from the `first_row`-th one were overwritten since they were selected"""
+        return self.written - first_row > self.capacity
+
+    def query(self, label: str, start_ns: int = None, end_ns: int = None) -> tuple[int, list[memoryview]]:
+        """
+        Return the rows of a column in a time range as views of the buffer
+        :param label: sensor label, or `device label.state`
+        :param start_ns, end_ns: range of timestamp_ns, bounds included, all the served rows by default
+        :return: (first row, buffers), the buffers are the int64 timestamps of each segment followed by the float64
+        values of each segment, in native byte order
+        """
+        column = self.values[self.column_indexes[label]]
+        first_row, segments = self.segments(start_ns, end_ns)
+        views = [memoryview(self.timestamps[segment]) for segment in segments]
+        views += [memoryview(column[segment]) for segment in segments]
+        return first_row, views
+
+
+def as_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class HistoryRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /columns: json {"columns": [...], "cycles": served rows, "written": rows written since the start}
+    GET /history?label=LIT101&start_ns=...&end_ns=...: the n rows of the column in the range,
+        int64 timestamp_ns[n] then float64 value[n], native byte order, n in the `X-Rows` header
+    """
+
+    def do_GET(self):
+        history = self.server.history
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/columns':
+            body = json.dumps({'columns': history.columns, 'cycles': history.cycles,
+                               'written': history.written}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path != '/history':
+            self.send_error(404)
+            return
+        if query.get('label') not in history.column_indexes:
+            self.send_error(404, f"Unknown label {query.get('label')}")
+            return
+        try:
+            start_ns = int(query['start_ns']) if 'start_ns' in query else None
+            end_ns = int(query['end_ns']) if 'end_ns' in query else None
+        except ValueError:
+            self.send_error(400, 'start_ns and end_ns must be integers')
+            return
+        first_row, views = history.query(query['label'], start_ns, end_ns)
+        rows = sum(view.nbytes for view in views) // 16
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(rows * 16))
+        self.send_header('X-Rows', str(rows))
+        self.send_header('X-First-Row', str(first_row))
+        self.end_headers()
+        for view in views:
+            self.wfile.write(view)
+        if history.overwritten(first_row):
+            log.warning(f"History of {query['label']} overwritten while it was sent, the guard is too small")
+
+    def log_message(self, format, *args):
+        log.debug(f"History {self.address_string()} {format % args}")
+
+
+class HistoryServer(object):
+    """Local HTTP server of a HistoryBuffer, run in a daemon thread"""
+
+    def __init__(self, history: HistoryBuffer, port: int, host: str = '127.0.0.1'):
+        self.server = ThreadingHTTPServer((host, port), HistoryRequestHandler)
+        self.server.daemon_threads = True
+        self.server.history = history
+        self.thread = None
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self.server.serve_forever, name='history-server', daemon=True)
+        self.thread.start()
+        log.info(f"History served on http://{self.server.server_address[0]}:{self.server.server_address[1]}")
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread = None
+        self.server.server_close()
@@ -0,0 +1,242 @@
+import logging
+
+import numpy as np
+
+from Device import Device, Tank, Pump, Valve
+
+log = logging.getLogger('phy_sim')
+
+# smallest flow used to linearize the head losses, keeps the conductance of links without flow finite
+_MIN_FLOW = 1e-6
+
+
+class HydraulicNetwork(object):
+    """Pressure driven model of the plant, replacing the fixed volumes pushed and pulled by the devices.
+    Tanks are nodes of known head (elevation + level), pumps, valves and filters are links between a suction and a
+    discharge junction, and each connection is a pipe between two devices. Head losses are quadratic
+    (h = r * Q * |Q|) and pumps add h0 * (1 - (Q / Qmax)^2), Qmax being their nominal rate.
+    Each step solves the junction heads by Newton iterations, each one a conjugate gradient on the sparse nodal
+    equations, warm started from the previous step"""
+
+    def __init__(self, devices: dict[str, Device], pipe_resistance: float = 1e-4, tolerance: float = 1e-8,
+                 max_iterations: int = 50):
+        """
+        :param devices: dict of devices, key is label, value is the device object, connections must be built
+        :param pipe_resistance: head loss coefficient of the connections and of the devices without `resistance`
+        :param tolerance: relative change of the flows under which the Newton iterations stop
+        :param max_iterations: maximal number of Newton iterations per solve
+        """
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.tanks = [device for device in devices.values() if isinstance(device, Tank)]
+        # (suction, discharge) node of each device, the same node for tanks
+        ends = {}
+        for index, tank in enumerate(self.tanks):
+            ends[id(tank)] = (index, index)
+        node_count = len(self.tanks)
+        self.link_devices = []
+        link_from, link_to, resistances, heads = [], [], [], []
+        for device in devices.values():
+            if isinstance(device, Tank):
+                continue
+            ends[id(device)] = (node_count, node_count + 1)
+            link_from.append(node_count)
+            link_to.append(node_count + 1)
+            resistance = getattr(device, 'resistance', None)
+            resistances.append(pipe_resistance if resistance is None else resistance)
+            heads.append(device.head if isinstance(device, Pump) else 0)
+            self.link_devices.append(device)
+            node_count += 2
+        for device in devices.values():
+            for output_device in device.output_devices.values():
+                link_from.append(ends[id(device)][1])
+                link_to.append(ends[id(output_device)][0])
+                resistances.append(pipe_resistance)
+                heads.append(0)
+        self.node_count = node_count
+        self.link_from = np.array(link_from, dtype=int)
+        self.link_to = np.array(link_to, dtype=int)
+        self.resistances = np.array(resistances, dtype=float)
+        self.shutoff_heads = np.array(heads, dtype=float)
+        device_count = len(self.link_devices)
+        self.pumps = np.zeros(len(link_from), dtype=bool)
+        self.pumps[:device_count] = [isinstance(device, Pump) for device in self.link_devices]
+        self.elevations = np.array([tank.elevation for tank in self.tanks], dtype=float)
+        self.areas = np.array([tank.area for tank in self.tanks], dtype=float)
+        self.max_volumes = np.array([tank.max_volume for tank in self.tanks], dtype=float)
+        # solution of the previous step, warm start of the next one
+        self.heads = np.zeros(node_count)
+        self.flows = np.zeros(len(link_from))
+        log.info(f"Hydraulic network: {node_count} nodes, {len(link_from)} links")
+
+    def open_links(self) -> np.ndarray:
+        """Return the links which can carry a flow: pumps on and activated by their PLC (as for `Pump.worker`),
+        valves open (their state only, like `Valve.input`), filters and pipes"""
+        open_links = np.ones(len(self.flows), dtype=bool)
+        for index, device in enumerate(self.link_devices):
+            if isinstance(device, Pump):
+                open_links[index] = bool(device.active and device.state)
+            elif isinstance(device, Valve):
+                open_links[index] = bool(device.state)
+        return open_links
+
+    def connected_links(self, fixed: np.ndarray, open_links: np.ndarray) -> np.ndarray:
+        """Return the open links connected to a node of known head, the heads of the other parts of the network
+        are undetermined (the nodal equations are singular there) and they carry no flow"""
+        reached = fixed.copy()
+        while True:
+            ends_reached = open_links & (reached[self.link_from] | reached[self.link_to])
+            new_reached = reached.copy()
+            new_reached[self.link_from[ends_reached]] = True
+            new_reached[self.link_to[ends_reached]] = True
+            if (new_reached == reached).all():
+                return ends_reached
+            reached = new_reached
+
+    def laplacian_product(self, conductances: np.ndarray, values: np.ndarray) -> np.ndarray:
+        """Product of the weighted nodal matrix (incidence^T * diag(conductances) * incidence) by `values`"""
+        flows = conductances * (values[self.link_from] - values[self.link_to])
+        return np.bincount(self.link_from, weights=flows, minlength=self.node_count) \
+            - np.bincount(self.link_to, weights=flows, minlength=self.node_count)
+
+    def conjugate_gradient(self, conductances: np.ndarray, right_hand_side: np.ndarray, free: np.ndarray,
+                           start: np.ndarray) -> np.ndarray:
+        """
+        Solve the nodal equations of the `free` nodes by a Jacobi preconditioned conjugate gradient
+        :param conductances: linearized conductance of each link
+        :param right_hand_side: injection of each node, only the free nodes are used
+        :param free: mask of the nodes whose head is unknown
+        :param start: heads of all nodes, the free ones are the initial guess, the others are kept
+        :return: heads of all nodes
+        """
+        diagonal = np.bincount(self.link_from, weights=conductances, minlength=self.node_count) \
+            + np.bincount(self.link_to, weights=conductances, minlength=self.node_count)
+        # isolated junctions keep their head
+        diagonal = np.where(diagonal > 0, diagonal, 1)
+        heads = start.copy()
+        residual = np.where(free, right_hand_side - self.laplacian_product(conductances, heads), 0)
+        norm = np.linalg.norm(right_hand_side[free]) + 1e-12
+        preconditioned = residual / diagonal
+        direction = preconditioned.copy()
+        product = residual @ preconditioned
+        for _ in range(4 * int(free.sum()) + 10):
+            if np.linalg.norm(residual) <= 1e-10 * norm or not np.isfinite(product) or product == 0:
+                break
+            step_values = np.where(free, self.laplacian_product(conductances, direction), 0)
+            curvature = direction @ step_values
+            if not curvature > 0:
+                break
+            alpha = product / curvature
+            heads += alpha * direction
+            residual -= alpha * step_values
+            preconditioned = residual / diagonal
+            new_product = residual @ preconditioned
+            direction = preconditioned + new_product / product * direction
+            product = new_product
+        return heads
+
+    def solve(self, fixed_heads: np.ndarray, fixed: np.ndarray, open_links: np.ndarray,
+              max_flows: np.ndarray) -> np.ndarray:
+        """
+        Solve the flows of the network
+        :param fixed_heads: head of the nodes of known head
+        :param fixed: mask of the nodes of known head
+        :param open_links: mask of the links which can carry a flow, pumps are closed when they would run backwards
+        :param max_flows: nominal rate of each link per second, used by pumps
+        :return: flow of each link per second, positive from suction to discharge, 0 if the solve failed
+        """
+        open_links = self.connected_links(fixed, open_links)
+        pump_resistances = np.divide(self.shutoff_heads, max_flows ** 2, out=np.zeros_like(max_flows),
+                                     where=max_flows > 0)
+        resistances = self.resistances + pump_resistances
+        heads = np.where(fixed, fixed_heads, self.heads)
+        flows = np.where(open_links, self.flows, 0)
+        # the links without flow, or almost, start from a nominal rate, that of the pump or the largest pump one,
+        # the linearization at a null flow would predict a flow far above it and take many iterations to come back
+        nominal_flows = np.where(self.pumps, max_flows,
+                                 np.max(max_flows, where=open_links & self.pumps, initial=0) or 1)
+        starting = open_links & (np.abs(flows) < 1e-3 * nominal_flows)
+        flows[starting] = nominal_flows[starting]
+        for _ in range(self.max_iterations):
+            absolute_flows = np.maximum(np.abs(flows), _MIN_FLOW)
+            # Newton linearization of h = r * Q * |Q|: Q = g * (head difference + pump head) + c
+            conductances = np.where(open_links, 1 / (2 * resistances * absolute_flows), 0)
+            constants = np.where(open_links, resistances * flows * absolute_flows * conductances, 0)
+            sources = conductances * self.shutoff_heads * self.pumps + constants
+            right_hand_side = np.bincount(self.link_to, weights=sources, minlength=self.node_count) \
+                - np.bincount(self.link_from, weights=sources, minlength=self.node_count)
+            heads = self.conjugate_gradient(conductances, right_hand_side, ~fixed, heads)
+            new_flows = conductances * (heads[self.link_from] - heads[self.link_to]) + sources
+            # pumps have a check valve
+            backwards = self.pumps & open_links & (new_flows < 0)
+            if backwards.any():
+                # closing them may cut parts of the network from the nodes of known head
+                open_links = self.connected_links(fixed, open_links & ~backwards)
+                new_flows[~open_links] = 0
+                flows = new_flows
+                continue
+            change = np.max(np.abs(new_flows - flows), initial=0)
+            flows = new_flows
+            if change <= self.tolerance * (np.max(np.abs(flows), initial=0) + 1):
+                break
+        else:
+            log.warning(f"Hydraulic network: flows not converged after {self.max_iterations} iterations")
+        if not (np.isfinite(flows).all() and np.isfinite(heads).all()):
+            log.warning("Hydraulic network: solve failed, no flow during this step")
+            self.flows = np.zeros(len(self.flows))
+            return self.flows.copy()
+        self.heads = heads
+        self.flows = flows
+        return flows
+
+    def step(self, dt: float) -> None:
+        """
+        Move the fluid during `dt` seconds and set the flow rate of the devices (volume moved during the step).
+        The step is split when a tank gets full or empty, the tank then stops receiving or supplying fluid
+        """
+        open_links = self.open_links()
+        max_flows = np.zeros(len(self.flows))
+        for index, device in enumerate(self.link_devices):
+            if isinstance(device, Pump) and dt > 0:
+                max_flows[index] = device.volume_per_step / dt
+        open_links &= ~self.pumps | (max_flows > 0)
+        tank_count = len(self.tanks)
+        moved = np.zeros(len(self.flows))
+        volumes = np.array([float(tank.volume) for tank in self.tanks])
+        start_volumes = volumes.copy()
+        remaining = dt
+        for _ in range(tank_count + 1):
+            fixed = np.zeros(self.node_count, dtype=bool)
+            fixed[:tank_count] = True
+            fixed_heads = np.zeros(self.node_count)
+            fixed_heads[:tank_count] = self.elevations + volumes / self.areas
+            for _ in range(tank_count + 1):
+                flows = self.solve(fixed_heads, fixed, open_links, max_flows)
+                net_flows = (np.bincount(self.link_to, weights=flows, minlength=self.node_count)
+                             - np.bincount(self.link_from, weights=flows, minlength=self.node_count))[:tank_count]
+                # an empty tank can't supply and a full one can't receive, their head floats
+                blocked = fixed[:tank_count] & (((volumes <= 0) & (net_flows < 0))
+                                                | ((volumes >= self.max_volumes) & (net_flows > 0)))
+                if not blocked.any():
+                    break
+                fixed[:tank_count] &= ~blocked
+            with np.errstate(divide='ignore', invalid='ignore'):
+                times = np.where(net_flows < 0, volumes / -net_flows,
+                                 np.where(net_flows > 0, (self.max_volumes - volumes) / net_flows, np.inf))
+            times = np.where(fixed[:tank_count] & (times > 0), times, np.inf)
+            duration = min(remaining, np.min(times, initial=np.inf))
+            volumes += net_flows * duration
+            # the tanks reaching a limit are set exactly to it, rounding errors would split the step again
+            reached = times <= duration
+            volumes[reached & (net_flows < 0)] = 0
+            volumes[reached & (net_flows > 0)] = self.max_volumes[reached & (net_flows > 0)]
+            moved += flows * duration
+            remaining -= duration
+            if remaining <= 1e-12 * max(dt, 1):
+                break
+        volumes = np.clip(volumes, 0, np.maximum(self.max_volumes, start_volumes))
+        for tank, volume, start_volume in zip(self.tanks, volumes, start_volumes):
+            tank.volume = volume
+            tank.current_flow_rate += volume - start_volume
+        for device, volume in zip(self.link_devices, moved):
+            device.current_flow_rate += abs(volume)
@@ -0,0 +1,336 @@
+import logging
+import selectors
+import socket
+import threading
+from enum import Enum
+
+from pyModbusTCP.constants import EXP_GATEWAY_PATH_UNAVAILABLE
+from pyModbusTCP.server import ModbusServer, DataBank, DataHandler
+
+from ModbusTraffic import RecordingModbusServer, TrafficRecorder
+
+log = logging.getLogger('phy_sim')
+
+
+class Allowed_modbus_mode(Enum):
+    shared = 'shared'
+    unit_id = 'unit_id'
+    port = 'port'
+
+
+class NotifyingDataBank(DataBank):
+    """Data bank which calls its listeners each time a modbus client changes a coil or a holding register"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.listeners = []
+
+    def add_listener(self, listener) -> None:
+        """
+        :param listener: function called with (area, address, from_value, to_value), area is 'X' for coils
+        and 'W' for holding registers
+        """
+        self.listeners.append(listener)
+
+    def on_coils_change(self, address, from_value, to_value, srv_info):
+        for listener in self.listeners:
+            listener('X', address, from_value, to_value)
+
+    def on_holding_registers_change(self, address, from_value, to_value, srv_info):
+        for listener in self.listeners:
+            listener('W', address, from_value, to_value)
+
+
+class UnitDataHandler(DataHandler):
+    """Data handler which routes each request to the data bank of the PLC addressed by the MBAP unit id,
+    so every PLC gets an isolated address space behind a single listener"""
+
+    def __init__(self, data_banks: dict[int, DataBank]):
+        """
+        :param data_banks: dict of data banks, key is the unit id, value is the data bank of the PLC
+        """
+        super().__init__(data_bank=DataBank(virtual_mode=True))
+        self.data_handlers = {unit_id: DataHandler(data_bank) for unit_id, data_bank in data_banks.items()}
+
+    def __route(self, srv_info) -> DataHandler:
+        """Return the data handler of the unit addressed by the request, None if the unit is unknown"""
+        return self.data_handlers.get(srv_info.recv_frame.mbap.unit_id)
+
+    def read_coils(self, address, count, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.read_coils(address, count, srv_info)
+
+    def write_coils(self, address, bits_l, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.write_coils(address, bits_l, srv_info)
+
+    def read_d_inputs(self, address, count, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.read_d_inputs(address, count, srv_info)
+
+    def read_h_regs(self, address, count, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.read_h_regs(address, count, srv_info)
+
+    def write_h_regs(self, address, words_l, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.write_h_regs(address, words_l, srv_info)
+
+    def read_i_regs(self, address, count, srv_info):
+        data_handler = self.__route(srv_info)
+        if data_handler is None:
+            return DataHandler.Return(exp_code=EXP_GATEWAY_PATH_UNAVAILABLE)
+        return data_handler.read_i_regs(address, count, srv_info)
+
+
+class ModbusSession(object):
+    """TCP connection of a client to a server of a `ModbusIOLoop`, with its partially received request and its
+    partially sent responses"""
+    __slots__ = ('server', 'connection', 'received', 'to_send', 'session_data')
+
+    def __init__(self, server: ModbusServer, connection: socket.socket):
+        self.server = server
+        self.connection = connection
+        self.received = b''
+        self.to_send = b''
+        self.session_data = ModbusServer.SessionData()
+        self.session_data.client.address, self.session_data.client.port = connection.getpeername()[:2]
+
+
+class ModbusIOLoop(object):
+    """Single thread serving the listeners and the client connections of several modbus servers with a selector,
+    instead of an accept thread per server and a thread per connection"""
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.listeners = {}
+        self.thread = None
+        # written to wake the selector up when the listeners change
+        self.wake_up_reader, self.wake_up_writer = socket.socketpair()
+        self.wake_up_reader.setblocking(False)
+        self.selector.register(self.wake_up_reader, selectors.EVENT_READ, None)
+
+    def add(self, server: ModbusServer) -> None:
+        """Listen on the port of `server`, the loop thread is started with the first server"""
+        listener = socket.socket(socket.AF_INET6 if server.ipv6 else socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            listener.bind((server.host, server.port))
+            listener.listen()
+        except OSError as error:
+            listener.close()
+            raise ModbusServer.NetworkError(error)
+        listener.setblocking(False)
+        with self.lock:
+            self.listeners[server] = listener
+            self.selector.register(listener, selectors.EVENT_READ, server)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.serve, name='modbus-io', daemon=True)
+                self.thread.start()
+        self.wake_up_writer.send(b'\0')
+
+    def remove(self, server: ModbusServer) -> None:
+        """Close the listener and the connections of `server`, the loop thread stops with the last server"""
+        with self.lock:
+            listener = self.listeners.pop(server, None)
+            if listener is None:
+                return
+            self.selector.unregister(listener)
+            listener.close()
+            for key in list(self.selector.get_map().values()):
+                if isinstance(key.data, ModbusSession) and key.data.server is server:
+                    self.close_session(key.data)
+            thread = self.thread if not self.listeners else None
+            if thread is not None:
+                self.thread = None
+        self.wake_up_writer.send(b'\0')
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def serve(self) -> None:
+        while True:
+            with self.lock:
+                if not self.listeners:
+                    return
+            for key, mask in self.selector.select(timeout=1):
+                if key.data is None:
+                    self.wake_up_reader.recv(4096)
+                    continue
+                with self.lock:
+                    if key.fileobj.fileno() < 0:
+                        # closed by `remove` during this select
+                        continue
+                    if isinstance(key.data, ModbusSession):
+                        self.on_session_event(key.data, mask)
+                    else:
+                        self.accept(key.fileobj, key.data)
+
+    def accept(self, listener: socket.socket, server: ModbusServer) -> None:
+        try:
+            connection, _ = listener.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        session = ModbusSession(server, connection)
+        self.selector.register(connection, selectors.EVENT_READ, session)
+        log.debug(f"Port {server.port}: connection from {session.session_data.client}")
+
+    def on_session_event(self, session: ModbusSession, mask: int) -> None:
+        try:
+            if mask & selectors.EVENT_READ:
+                data = session.connection.recv(4096)
+                if not data:
+                    self.close_session(session)
+                    return
+                session.received += data
+                self.process_requests(session)
+            self.send(session)
+        except (ModbusServer.Error, OSError) as error:
+            log.debug(f"Port {session.server.port}: connection of {session.session_data.client} closed: {error}")
+            self.close_session(session)
+
+    def process_requests(self, session: ModbusSession) -> None:
+        """Process the complete requests received, like `ModbusServer.ModbusService.handle`"""
+        session_data = session.session_data
+        while len(session.received) >= 7:
+            # the MBAP length counts the unit id and the PDU
+            frame_length = 6 + int.from_bytes(session.received[4:6], 'big')
+            if len(session.received) < frame_length:
+                return
+            frame, session.received = session.received[:frame_length], session.received[frame_length:]
+            session_data.new_request()
+            session_data.request.mbap.raw = frame[:7]
+            session_data.request.pdu.raw = frame[7:]
+            session_data.set_response_mbap()
+            session.server._engine(session_data)
+            session.to_send += session_data.response.raw
+
+    def send(self, session: ModbusSession) -> None:
+        """Send what the socket accepts, the rest when it is writable again"""
+        if session.to_send:
+            try:
+                sent = session.connection.send(session.to_send)
+            except BlockingIOError:
+                sent = 0
+            session.to_send = session.to_send[sent:]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if session.to_send else 0)
+        if self.selector.get_key(session.connection).events != events:
+            self.selector.modify(session.connection, events, session)
+
+    def close_session(self, session: ModbusSession) -> None:
+        if session.connection.fileno() >= 0:
+            self.selector.unregister(session.connection)
+            session.connection.close()
+
+
+class LoopModbusServer(ModbusServer):
+    """Modbus server whose port is served by a shared `ModbusIOLoop`"""
+
+    def __init__(self, *args, io_loop: ModbusIOLoop = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.io_loop = io_loop
+
+    def start(self) -> None:
+        if not self.is_run:
+            self.io_loop.add(self)
+            self._evt_running.set()
+
+    def stop(self) -> None:
+        if self.is_run:
+            self._evt_running.clear()
+            self.io_loop.remove(self)
+
+
+class RecordingLoopModbusServer(RecordingModbusServer, LoopModbusServer):
+    pass
+
+
+def new_modbus_server(host: str, port: int, recorder: TrafficRecorder = None, io_loop: ModbusIOLoop = None,
+                      **kwargs) -> ModbusServer:
+    """Create a non blocking modbus server, recording its traffic if `recorder` is given, served by `io_loop` if
+    given, by its own threads otherwise"""
+    if io_loop is not None:
+        if recorder is None:
+            return LoopModbusServer(host, port, no_block=True, io_loop=io_loop, **kwargs)
+        return RecordingLoopModbusServer(host, port, no_block=True, recorder=recorder, io_loop=io_loop, **kwargs)
+    if recorder is None:
+        return ModbusServer(host, port, no_block=True, **kwargs)
+    return RecordingModbusServer(host, port, no_block=True, recorder=recorder, **kwargs)
+
+
+def plc_modbus_address(settings: dict, plc, index: int) -> tuple[int, int]:
+    """
+    Return the (port, unit id) at which the data bank of a PLC is served
+    :param settings: settings of the yaml config file
+    :param plc: PLC object, its `port` and `unit_id` are used when set
+    :param index: index of the PLC in the config, gives the default port or unit id
+    """
+    modbus_mode = settings.get('modbus_mode', Allowed_modbus_mode.shared.value)
+    if modbus_mode == Allowed_modbus_mode.unit_id.value:
+        return settings['port'], plc.unit_id if plc.unit_id is not None else index + 1
+    if modbus_mode == Allowed_modbus_mode.port.value:
+        return plc.port if plc.port is not None else settings['port'] + index + 1, 1
+    return settings['port'], 1
+
+
+def build_modbus_servers(settings: dict, plcs: dict, recorder: TrafficRecorder = None) -> list[ModbusServer]:
+    """
+    Create the data banks of the PLCs and the modbus servers exposing them
+    shared: one server and one data bank for all PLCs (default)
+    unit_id: one server, each PLC has its own data bank addressed by its `unit_id`
+    port: each PLC has its own data bank and its own server listening on its `port`, all the ports are served by
+    one `ModbusIOLoop` thread
+    :param settings: settings of the yaml config file
+    :param plcs: dict of PLCs, key is label, value is the PLC object
+    :param recorder: if given, the servers record every request and response with it
+    :return: list of modbus servers, not started
+    """
+    modbus_mode = settings.get('modbus_mode', Allowed_modbus_mode.shared.value)
+    if modbus_mode not in [e.value for e in Allowed_modbus_mode]:
+        raise ValueError(f'Modbus mode {modbus_mode} is not allowed.')
+
+    if modbus_mode == Allowed_modbus_mode.shared.value:
+        data_bank = NotifyingDataBank()
+        for plc in plcs.values():
+            plc.set_data_bank(data_bank)
+        return [new_modbus_server(settings['host_address'], settings['port'], recorder, data_bank=data_bank)]
+
+    if modbus_mode == Allowed_modbus_mode.unit_id.value:
+        data_banks = {}
+        for index, plc in enumerate(plcs.values()):
+            plc.unit_id = plc_modbus_address(settings, plc, index)[1]
+            if plc.unit_id in data_banks:
+                raise ValueError(f'PLC {plc.label} unit id {plc.unit_id} is already used.')
+            data_banks[plc.unit_id] = NotifyingDataBank()
+            plc.set_data_bank(data_banks[plc.unit_id])
+            log.info(f"{plc.label} served on port {settings['port']} unit id {plc.unit_id}")
+        return [new_modbus_server(settings['host_address'], settings['port'], recorder,
+                                  data_hdl=UnitDataHandler(data_banks))]
+
+    # the ports are served by one thread
+    io_loop = ModbusIOLoop()
+    servers = []
+    ports = set()
+    for index, plc in enumerate(plcs.values()):
+        plc.port = plc_modbus_address(settings, plc, index)[0]
+        if plc.port in ports:
+            raise ValueError(f'PLC {plc.label} port {plc.port} is already used.')
+        ports.add(plc.port)
+        plc.set_data_bank(NotifyingDataBank())
+        servers.append(new_modbus_server(settings['host_address'], plc.port, recorder, io_loop,
+                                         data_bank=plc.data_bank))
+        log.info(f"{plc.label} served on port {plc.port}")
+    return servers
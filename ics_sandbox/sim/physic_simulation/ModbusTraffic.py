@@ -0,0 +1,154 @@
+import logging
+import struct
+import threading
+
+from pyModbusTCP.server import ModbusServer
+
+log = logging.getLogger('phy_sim')
+
+# file header, followed by records of (cycle, port, unit id, request PDU length, response PDU length) + PDUs
+_MAGIC = b'MBTR\x01'
+_RECORD = struct.Struct('>IHBBB')
+
+_FUNCTION_NAMES = {1: 'read coils', 2: 'read discrete inputs', 3: 'read holding registers',
+                   4: 'read input registers', 5: 'write coil', 6: 'write register', 15: 'write coils',
+                   16: 'write registers', 23: 'write/read registers', 43: 'device identification'}
+
+
+class TrafficRecord(object):
+    """One modbus request processed by the simulation and the response it got"""
+
+    def __init__(self, cycle: int, port: int, unit_id: int, request: bytes, response: bytes):
+        self.cycle = cycle
+        self.port = port
+        self.unit_id = unit_id
+        self.request = request
+        self.response = response
+
+    def describe(self) -> str:
+        """Human readable function code and address range of the request"""
+        if not self.request:
+            return 'empty request'
+        function_code = self.request[0]
+        name = _FUNCTION_NAMES.get(function_code, f'function {function_code}')
+        if len(self.request) < 5 or function_code == 43:
+            return name
+        address, count = struct.unpack('>HH', self.request[1:5])
+        if function_code in [5, 6]:
+            return f'{name} {address}'
+        return f'{name} {address}..{address + count - 1}'
+
+
+def decode_values(response: bytes) -> list:
+    """Return the coils or registers carried by a read response, the raw PDU for other responses"""
+    if len(response) >= 2 and response[0] in [1, 2]:
+        bits = response[2:2 + response[1]]
+        return [bool(byte >> bit & 1) for byte in bits for bit in range(8)]
+    if len(response) >= 2 and response[0] in [3, 4, 23]:
+        return list(struct.unpack(f'>{response[1] // 2}H', response[2:2 + response[1]]))
+    return list(response)
+
+
+def read_traffic(path_to_traffic: str):
+    """Iterate over the records of a modbus traffic file"""
+    with open(path_to_traffic, 'rb') as traffic_file:
+        if traffic_file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f'{path_to_traffic} is not a modbus traffic file.')
+        while True:
+            header = traffic_file.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            cycle, port, unit_id, request_length, response_length = _RECORD.unpack(header)
+            request = traffic_file.read(request_length)
+            response = traffic_file.read(response_length)
+            if len(response) < response_length:
+                # last record truncated by a crash of the simulation
+                return
+            yield TrafficRecord(cycle, port, unit_id, request, response)
+
+
+class TrafficRecorder(object):
+    """Write every modbus request and response processed by the servers to a binary file,
+    tagged with the simulation cycle at which they were processed. The file holds one run: the cycles restart at 0
+    at each start of the simulation, so it is overwritten"""
+
+    def __init__(self, path_to_traffic: str, current_cycle):
+        """
+        :param path_to_traffic: path of the binary file, overwritten
+        :param current_cycle: function returning the current simulation cycle
+        """
+        self.path_to_traffic = path_to_traffic
+        self.current_cycle = current_cycle
+        self.lock = threading.Lock()
+        self.traffic_file = open(path_to_traffic, 'wb')
+        self.traffic_file.write(_MAGIC)
+        self.record_count = 0
+
+    def record(self, port: int, unit_id: int, request: bytes, response: bytes) -> None:
+        header = _RECORD.pack(self.current_cycle() & 0xFFFFFFFF, port, unit_id, len(request), len(response))
+        with self.lock:
+            self.traffic_file.write(header + request + response)
+            self.record_count += 1
+
+    def close(self) -> None:
+        with self.lock:
+            if not self.traffic_file.closed:
+                self.traffic_file.close()
+                log.info(f"{self.record_count} modbus requests recorded in {self.path_to_traffic}")
+
+
+class RecordingModbusServer(ModbusServer):
+    """Modbus server which gives every processed request and its response to a `TrafficRecorder`"""
+
+    def __init__(self, *args, recorder: TrafficRecorder = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.recorder = recorder
+
+    def _engine(self, session_data):
+        super()._engine(session_data)
+        self.recorder.record(self.port, session_data.request.mbap.unit_id, session_data.request.pdu.raw,
+                             session_data.response.pdu.raw)
+
+
+class TrafficReplay(object):
+    """Feed a recorded modbus traffic to servers which are not started, cycle by cycle,
+    and compare the responses with the recorded ones"""
+
+    def __init__(self, path_to_traffic: str, servers: list[ModbusServer]):
+        """
+        :param path_to_traffic: path to a file written by `TrafficRecorder`
+        :param servers: modbus servers of the simulation, records are routed by port
+        """
+        self.path_to_traffic = path_to_traffic
+        self.servers = {server.port: server for server in servers}
+        self.records = read_traffic(path_to_traffic)
+        self.next_record = next(self.records, None)
+        self.record_count = 0
+        self.mismatches = []
+
+    def finished(self) -> bool:
+        return self.next_record is None
+
+    def apply(self, cycle: int) -> None:
+        """Process the records of the cycles up to `cycle`, in the recorded order"""
+        while self.next_record is not None and self.next_record.cycle <= cycle:
+            record = self.next_record
+            self.next_record = next(self.records, None)
+            self.record_count += 1
+            server = self.servers.get(record.port)
+            if server is None:
+                # a single server replays a recording made with another port
+                server = next(iter(self.servers.values()))
+            session_data = ModbusServer.SessionData()
+            session_data.request.mbap.unit_id = record.unit_id
+            session_data.request.pdu.raw = record.request
+            server._engine(session_data)
+            if session_data.response.pdu.raw != record.response:
+                self.mismatches.append((record, session_data.response.pdu.raw))
+                log.warning(f"Cycle {record.cycle} unit {record.unit_id} {record.describe()}: "
+                            f"recorded {decode_values(record.response)} "
+                            f"replayed {decode_values(session_data.response.pdu.raw)}")
+
+    def report(self) -> None:
+        log.warning(f"Replayed {self.record_count} modbus requests of {self.path_to_traffic}, "
+                    f"{len(self.mismatches)} responses differ")
@@ -1,5 +1,5 @@
+import itertools
 import logging
-import uuid
 from abc import abstractmethod
 
 import yaml
@@ -13,6 +13,26 @@ log.setLevel(logging.WARN)
 
 _16BITS = 65535
 _ZERO = 0
+# unique ids given at creation, `build_simulation` replaces them by dense ids
+_plc_ids = itertools.count()
+
+
+def encode_register(label: str, value, multiplier) -> int:
+    """
+    Convert a sensor value to a 16 bits holding register value
+    :param label: label of the sensor, for logging
+    :param value: value read by the sensor
+    :param multiplier: multiplier of the sensor value
+    :return: value * multiplier truncated and clamped between 0 and 65535
+    """
+    register_value = int(value * multiplier)
+    if register_value > _16BITS:
+        log.error(f"{label} has a value greater than 65535, {register_value}")
+        register_value = _16BITS
+    elif register_value < _ZERO:
+        log.error(f"{label} has a negative value, {register_value}")
+        register_value = _ZERO
+    return register_value
 
 
 class InvalidPLC(Exception):
@@ -25,23 +45,42 @@ class InvalidPLC(Exception):
 
 class Base_PLC(yaml.YAMLObject):
     """Abstract PLC"""
+    __slots__ = ('precision', 'uid', 'label', 'state', 'controlled_sensors_label', 'data_bank',
+                 'connection_established_coil', 'controlled_sensors', 'unit_id', 'port', 'program', 'st_programs',
+                 'psm_script', 'psm_harness', 'ack_register', 'update_period')
 
-    def __init__(self, label='', connection_established_coil=65535, state=None, controlled_sensors_label=None):
+    def __init__(self, label='', connection_established_coil=65535, state=None, controlled_sensors_label=None,
+                 unit_id=None, port=None, program=None, psm_script=None, ack_register=None,
+                 update_period=None):
         """
         Constructor
         :param label: label of the PLC
         :param connection_established_coil: coil to set to True when the PLC is connected to the server
         :param state: initial state of the PLC
         :param controlled_sensors_label: list of sensors label to control
+        :param unit_id: modbus unit id of the PLC data bank, only used in 'unit_id' modbus mode
+        :param port: port of the PLC modbus server, only used in 'port' modbus mode
+        :param program: path to a Structured Text file executed in the simulator instead of an OpenPLC container
+        :param psm_script: path to a psm python script executed in the simulator instead of an OpenPLC container
+        :param ack_register: holding register where the PLC acknowledges the consumed cycle in lockstep mode
+        :param update_period: time in milliseconds between two exchanges with the data bank, default is every cycle
         """
         self.precision = 10
-        self.uid = str(uuid.uuid4())[:8]
+        self.uid = next(_plc_ids)
         self.label = label
         self.state = state
         self.controlled_sensors_label = controlled_sensors_label
         self.data_bank = None
         self.connection_established_coil = connection_established_coil
         self.controlled_sensors = {}
+        self.unit_id = unit_id
+        self.port = port
+        self.program = program
+        self.st_programs = []
+        self.psm_script = psm_script
+        self.psm_harness = None
+        self.ack_register = ack_register
+        self.update_period = update_period
 
         log.info(f"{self}: Initialized")
 
@@ -60,9 +99,14 @@ class Base_PLC(yaml.YAMLObject):
     def set_data_bank(self, data_bank: DataBank) -> None:
         """Set the databank"""
         self.data_bank = data_bank
+        for st_program in self.st_programs:
+            st_program.set_data_bank(data_bank)
+        if self.psm_harness is not None:
+            self.psm_harness.set_data_bank(data_bank)
 
 
 class PLC(Base_PLC):
+    __slots__ = ()
     yaml_tag = u'!plc'
     yaml_loader = yaml.Loader
 
@@ -73,8 +117,21 @@ class PLC(Base_PLC):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+    def in_process(self) -> bool:
+        """Return True if the PLC logic runs inside the simulator"""
+        return bool(self.st_programs) or self.psm_harness is not None
+
+    def check_acknowledged(self, cycle: int) -> bool:
+        """Verify that the PLC acknowledged the simulation `cycle` (16 bits counter) in lockstep mode"""
+        if self.in_process():
+            return True
+        ack = self.data_bank.get_holding_registers(self.ack_register, 1)
+        return ack is not None and ack[0] == cycle & _16BITS
+
     def check_connected(self) -> bool:
         """Verify that the OpenPLC plc is connected to the server"""
+        if self.st_programs:
+            return True
         coil_state = self.data_bank.get_coils(self.connection_established_coil, 1)
         if coil_state is not None and coil_state[0]:
             return True
@@ -107,12 +164,15 @@ class PLC(Base_PLC):
             # if volume,flow_rate -> write only
             elif type(sensor) == VolumeSensor or type(sensor) == FlowRateSensor:
                 if "W" == sensor.location_tuple[0]:
-                    sensor_value = int(sensor.read_sensor() * sensor.multiplier)
-                    if sensor_value > _16BITS:
-                        log.error(f"{sensor.label} has a value greater than 65535, {sensor_value}")
-                        sensor_value = _16BITS
-                    elif sensor_value < _ZERO:
-                        log.error(f"{sensor.label} has a negative value, {sensor_value}")
-                        sensor_value = _ZERO
+                    sensor_value = encode_register(sensor.label, sensor.read_sensor(), sensor.multiplier)
                     self.data_bank.set_holding_registers(sensor.location_tuple[1], [sensor_value])
                     log.debug(f"{sensor.label} at location {sensor.location} has a value of {sensor_value}")
+
+    def actuation_pending(self) -> bool:
+        """Return True if the next `worker` call would activate or deactivate a device, without doing it"""
+        for sensor in self.controlled_sensors.values():
+            if type(sensor) == StateSensor and "X" == sensor.location_tuple[0] and sensor.active:
+                coil_data = self.data_bank.get_coils(sensor.location_tuple[1], 1)
+                if coil_data is not None and bool(coil_data[0]) != bool(sensor.device_to_monitor.active):
+                    return True
+        return False
@@ -0,0 +1,160 @@
+import importlib.util
+import logging
+import os
+import sys
+import types
+from contextlib import contextmanager
+
+from pyModbusTCP.server import DataBank
+
+log = logging.getLogger('phy_sim')
+
+_PYMODBUS_MODULES = ['pymodbus', 'pymodbus.client', 'pymodbus.client.sync']
+
+
+class PsmModule(types.ModuleType):
+    """Stand-in of the OpenPLC `psm` module, the PLC locations are kept in a dict"""
+
+    def __init__(self, name: str = 'psm'):
+        super().__init__(name)
+        self.variables = {}
+        self.running = False
+
+    def start(self) -> None:
+        self.running = True
+
+    def stop(self) -> None:
+        self.running = False
+
+    def should_quit(self) -> bool:
+        return False
+
+    def get_var(self, location: str):
+        """Read an OpenPLC location (i.e QX0.0)"""
+        return self.variables.get(location)
+
+    def set_var(self, location: str, value) -> None:
+        """Write an OpenPLC location (i.e IX0.0)"""
+        self.variables[location] = value
+
+
+class LoopbackResponse(object):
+    """Response of the loopback client, with the attributes used from pymodbus responses"""
+
+    def __init__(self, registers: list = None, bits: list = None, error: bool = False):
+        self.registers = registers or []
+        self.bits = bits or []
+        self.error = error
+
+    def isError(self) -> bool:
+        return self.error
+
+
+class LoopbackModbusClient(object):
+    """In-memory stand-in of pymodbus `ModbusTcpClient` bound directly to a simulator data bank
+    Subclasses created by `loopback_client_class` set the data bank"""
+    data_bank = None
+
+    def __init__(self, host: str = 'localhost', port: int = 502, **kwargs):
+        self.host = host
+        self.port = port
+
+    def connect(self) -> bool:
+        return True
+
+    def close(self) -> None:
+        pass
+
+    def is_socket_open(self) -> bool:
+        return True
+
+    def read_coils(self, address: int, count: int = 1, **kwargs) -> LoopbackResponse:
+        bits = self.data_bank.get_coils(address, count)
+        return LoopbackResponse(bits=bits, error=bits is None)
+
+    def read_holding_registers(self, address: int, count: int = 1, **kwargs) -> LoopbackResponse:
+        registers = self.data_bank.get_holding_registers(address, count)
+        return LoopbackResponse(registers=registers, error=registers is None)
+
+    def write_coil(self, address: int, value: bool, **kwargs) -> LoopbackResponse:
+        return LoopbackResponse(error=self.data_bank.set_coils(address, [value]) is None)
+
+    def write_coils(self, address: int, values: list, **kwargs) -> LoopbackResponse:
+        return LoopbackResponse(error=self.data_bank.set_coils(address, values) is None)
+
+    def write_register(self, address: int, value: int, **kwargs) -> LoopbackResponse:
+        return LoopbackResponse(error=self.data_bank.set_holding_registers(address, [value]) is None)
+
+    def write_registers(self, address: int, values: list, **kwargs) -> LoopbackResponse:
+        return LoopbackResponse(error=self.data_bank.set_holding_registers(address, values) is None)
+
+
+def loopback_client_class(data_bank: DataBank) -> type:
+    """Return a `ModbusTcpClient` stand-in class bound to `data_bank`"""
+    return type('ModbusTcpClient', (LoopbackModbusClient,), {'data_bank': data_bank})
+
+
+class PsmScript(object):
+    """A psm/PLC*.py control script loaded in-process, with the psm module and the pymodbus client replaced
+    by stand-ins bound to the simulator data bank"""
+
+    def __init__(self, path_to_script: str, label: str = '', path_to_yaml_config: str = None):
+        """
+        :param path_to_script: path to the psm python script
+        :param label: label of the PLC running the script
+        :param path_to_yaml_config: config of the simulation, replaces the `CONFIG` of the script
+        """
+        self.path_to_script = path_to_script
+        self.label = label
+        self.path_to_yaml_config = path_to_yaml_config
+        self.psm = PsmModule()
+        self.module = None
+        self.client_class = None
+
+    def set_data_bank(self, data_bank: DataBank) -> None:
+        """Bind the modbus client of the script to `data_bank`"""
+        self.client_class = loopback_client_class(data_bank)
+
+    @contextmanager
+    def stand_ins(self):
+        """Replace the psm and pymodbus modules while the script code is running"""
+        pymodbus_modules = [types.ModuleType(name) for name in _PYMODBUS_MODULES]
+        pymodbus_modules[-1].ModbusTcpClient = self.client_class
+        replaced = {name: sys.modules.get(name) for name in ['psm'] + _PYMODBUS_MODULES}
+        sys.modules['psm'] = self.psm
+        sys.modules.update(zip(_PYMODBUS_MODULES, pymodbus_modules))
+        sys.path.insert(0, os.path.dirname(os.path.abspath(self.path_to_script)))
+        try:
+            yield
+        finally:
+            sys.path.pop(0)
+            for name, module in replaced.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+    def load(self) -> None:
+        """Import the script and call its `hardware_init`"""
+        module_name = f"psm_{self.label or os.path.splitext(os.path.basename(self.path_to_script))[0]}"
+        spec = importlib.util.spec_from_file_location(module_name, self.path_to_script)
+        self.module = importlib.util.module_from_spec(spec)
+        # script prints every reading, send them to the debug log instead of stdout
+        self.module.print = lambda *args, **kwargs: log.debug(f"{self.label}: {' '.join(map(str, args))}")
+        with self.stand_ins():
+            spec.loader.exec_module(self.module)
+            if self.path_to_yaml_config is not None:
+                # the register map of the script is built from the config the simulator runs
+                self.module.CONFIG = self.path_to_yaml_config
+            if hasattr(self.module, 'hardware_init'):
+                self.module.hardware_init()
+        log.info(f"{self.label}: psm script {self.path_to_script} loaded")
+
+    def step(self) -> None:
+        """Run one psm cycle of the script"""
+        if self.module is None:
+            self.load()
+        if hasattr(self.module, 'update_inputs'):
+            self.module.update_inputs()
+        if hasattr(self.module, 'update_outputs'):
+            self.module.update_outputs()
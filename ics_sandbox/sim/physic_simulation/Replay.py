@@ -0,0 +1,98 @@
+import logging
+import mmap
+import time
+
+from ChunkedLog import ChunkedLogReader, chunked_log_prefix
+from Plc import encode_register
+
+log = logging.getLogger('phy_sim')
+
+
+class CsvReplay(object):
+    """Stream a recorded simulation_log.csv or chunked log into the data banks of the PLCs, without running the physics"""
+
+    def __init__(self, path_to_csv: str, plcs: dict):
+        """
+        :param path_to_csv: path to the simulation log, csv file or chunked log
+        :param plcs: dict of PLCs, key is label, value is the PLC object, their data bank must be set
+        """
+        self.path_to_csv = path_to_csv
+        # sensor label -> (data bank, sensor) for each sensor written by a PLC
+        self.targets = {}
+        for plc in plcs.values():
+            for sensor in plc.controlled_sensors.values():
+                self.targets[sensor.label] = (plc.data_bank, sensor)
+        self.row_count = 0
+
+    def encoders(self, header: list[str]) -> list:
+        """Return, for each column of the csv, the (data bank, area, address, label, multiplier) it is written to,
+        None for columns which are not written in a data bank"""
+        encoders = []
+        for label in header:
+            if label not in self.targets:
+                encoders.append(None)
+                continue
+            data_bank, sensor = self.targets[label]
+            area, address = sensor.location_tuple
+            encoders.append((data_bank, area, address, label, getattr(sensor, 'multiplier', 1)))
+        return encoders
+
+    def write_row(self, encoders: list, row: list[str]) -> None:
+        """Encode a csv row like `PLC.worker` and write it in the data banks, empty or None values are skipped"""
+        for encoder, value in zip(encoders, row):
+            if encoder is None or value in ['', 'None']:
+                continue
+            data_bank, area, address, label, multiplier = encoder
+            if area == 'X':
+                data_bank.set_coils(address, [value == 'True'])
+            else:
+                data_bank.set_holding_registers(address, [encode_register(label, float(value), multiplier)])
+
+    def run(self, speed: float = 1.0, start_ns: int = None, end_ns: int = None) -> None:
+        """
+        Replay the file, or the rows of a range of timestamps
+        :param speed: replay speed relative to the recorded `timestamp_ns`, 1 is real time, 0 is as fast as possible
+        :param start_ns, end_ns: range of `timestamp_ns` replayed, bounds included, the whole log by default
+        """
+        start = time.monotonic()
+        if chunked_log_prefix(self.path_to_csv) is not None:
+            # only the chunks of the range are read, found in the index
+            reader = ChunkedLogReader(self.path_to_csv)
+            self.replay_rows(reader.header, reader.rows(start_ns, end_ns), speed)
+        else:
+            with open(self.path_to_csv, 'rb') as csv_file, \
+                    mmap.mmap(csv_file.fileno(), 0, access=mmap.ACCESS_READ) as csv_map:
+                header = csv_map.readline().decode().rstrip('\r\n').split(',')
+                rows = (line.decode().rstrip('\r\n').split(',') for line in iter(csv_map.readline, b''))
+                if start_ns is not None or end_ns is not None:
+                    rows = self.rows_in_range(rows, header.index('timestamp_ns'), start_ns, end_ns)
+                self.replay_rows(header, rows, speed)
+        log.info(f"Replayed {self.row_count} rows of {self.path_to_csv} in {time.monotonic() - start:.3f} s")
+
+    @staticmethod
+    def rows_in_range(rows, timestamp_index: int, start_ns: int = None, end_ns: int = None):
+        """Generate the `rows` of a csv log between `start_ns` and `end_ns`"""
+        for row in rows:
+            timestamp = int(row[timestamp_index])
+            if start_ns is not None and timestamp < start_ns:
+                continue
+            if end_ns is not None and timestamp > end_ns:
+                return
+            yield row
+
+    def replay_rows(self, header: list[str], rows, speed: float) -> None:
+        """Write the `rows` in the data banks, at the pace of their `timestamp_ns`"""
+        encoders = self.encoders(header)
+        timestamp_index = header.index('timestamp_ns')
+        first_timestamp = None
+        start = time.monotonic()
+        for row in rows:
+            if speed > 0:
+                timestamp = int(row[timestamp_index])
+                if first_timestamp is None:
+                    first_timestamp = timestamp
+                delay = start + (timestamp - first_timestamp) / 1e9 / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.write_row(encoders, row)
+            self.row_count += 1
@@ -0,0 +1,162 @@
+import copy
+import json
+import logging
+import re
+
+from ModbusFrontend import plc_modbus_address
+
+log = logging.getLogger('phy_sim')
+# largest read of one modbus request, in coils and in registers
+MAX_READ = {'X': 2000, 'W': 125}
+# fields of the ScadaBR / SCADA-LTS json import, as exported from the HMI
+DATA_SOURCE_TEMPLATE = {
+    "type": "MODBUS_IP",
+    "alarmLevels": {
+        "POINT_WRITE_EXCEPTION": "URGENT",
+        "DATA_SOURCE_EXCEPTION": "URGENT",
+        "POINT_READ_EXCEPTION": "URGENT"
+    },
+    "transportType": "TCP_KEEP_ALIVE",
+    "createSlaveMonitorPoints": False,
+    "enabled": True,
+    "encapsulated": False,
+    "quantize": False,
+    "retries": 2,
+    "timeout": 500,
+}
+DATA_POINT_TEMPLATE = {
+    "loggingType": "ON_CHANGE",
+    "intervalLoggingPeriodType": "MINUTES",
+    "intervalLoggingType": "INSTANT",
+    "purgeType": "YEARS",
+    "pointLocator": {
+        "additive": 0.0,
+        "bit": 0,
+        "charset": "ASCII",
+        "registerCount": 0,
+        "settableOverride": True,
+        "slaveMonitor": False
+    },
+    "eventDetectors": [],
+    "engineeringUnits": "",
+    "chartRenderer": None,
+    "defaultCacheSize": 1,
+    "discardExtremeValues": False,
+    "discardHighLimit": 1.7976931348623157e+308,
+    "discardLowLimit": -1.7976931348623157e+308,
+    "enabled": True,
+    "intervalLoggingPeriod": 15,
+    "purgePeriod": 1,
+    "textRenderer": {
+        "type": "PLAIN",
+        "suffix": ""
+    },
+    "tolerance": 0.0
+}
+
+
+def register_runs(addresses: list[int], max_gap: int = 0, max_read: int = 125) -> list[tuple[int, int]]:
+    """
+    Group addresses into the ranges read by one modbus request each
+    :param addresses: coil or register addresses
+    :param max_gap: number of unused addresses a range may contain, reading them is cheaper than another request
+    :param max_read: largest number of addresses of a range
+    :return: list of (first address, last address), sorted
+    """
+    runs = []
+    for address in sorted(set(addresses)):
+        if runs and address - runs[-1][1] - 1 <= max_gap and address - runs[-1][0] < max_read:
+            runs[-1] = (runs[-1][0], address)
+        else:
+            runs.append((address, address))
+    return runs
+
+
+def poll_period(settings: dict, plc) -> int:
+    """Return the time in milliseconds between two polls of the sensors of `plc`, its `update_period` or a cycle"""
+    if plc.update_period:
+        return int(plc.update_period)
+    return int(settings.get('sim_speed') or 1000)
+
+
+def xid(prefix: str, name: str) -> str:
+    return prefix + re.sub(r'\W', '_', name)
+
+
+def data_point(sensor, data_source_xid: str, unit_id: int) -> dict:
+    """Return the data point reading `sensor` in the data source `data_source_xid`"""
+    area, address = sensor.location_tuple
+    point = copy.deepcopy(DATA_POINT_TEMPLATE)
+    point.update({"xid": xid('DP_', sensor.label), "name": sensor.label, "dataSourceXid": data_source_xid})
+    multiplier = getattr(sensor, 'multiplier', 1) or 1
+    point["pointLocator"].update({
+        "range": "COIL_STATUS" if area == 'X' else "HOLDING_REGISTER",
+        # registers hold value * multiplier clamped to 16 bits unsigned, see `encode_register`
+        "modbusDataType": "BINARY" if area == 'X' else "TWO_BYTE_INT_UNSIGNED",
+        "multiplier": 1.0 if area == 'X' else 1 / multiplier,
+        "offset": address,
+        "slaveId": unit_id,
+    })
+    return point
+
+
+def scada_config(settings: dict, plcs: dict, max_gap: int = 0) -> dict:
+    """
+    Build the ScadaBR / SCADA-LTS json import polling the sensors of the PLCs on the modbus servers of the simulator.
+    The sensors served at the same port and unit id and polled with the same period are split in ranges of coils and
+    of registers, each range is one data source read in one request per poll, instead of one request per sensor.
+    The xids are derived from the labels, so that importing it again updates the points
+    :param settings: settings of the yaml config file, `host_address`, `port`, `modbus_mode` and `sim_speed` are used
+    :param plcs: dict of PLCs, key is label, value is the PLC object with its controlled sensors
+    :param max_gap: number of unused addresses a batched read may contain
+    :return: dict with the dataSources, dataPoints and pointHierarchy of the import
+    """
+    # (port, unit id, poll period) -> {'plcs': labels, 'sensors': {label: sensor}}
+    groups = {}
+    hierarchy = []
+    for index, plc in enumerate(plcs.values()):
+        port, unit_id = plc_modbus_address(settings, plc, index)
+        group = groups.setdefault((port, unit_id, poll_period(settings, plc)), {'plcs': [], 'sensors': {}})
+        group['plcs'].append(plc.label)
+        for sensor in plc.controlled_sensors.values():
+            if sensor.location_tuple is None:
+                log.warning(f"Sensor {sensor.label} of {plc.label} has no location, not polled by the HMI")
+                continue
+            group['sensors'][sensor.label] = sensor
+        hierarchy.append({"points": [xid('DP_', label) for label in plc.controlled_sensors_label or []
+                                     if label in group['sensors']],
+                          "name": plc.label, "subfolders": []})
+
+    data_sources, data_points = [], []
+    for (port, unit_id, period), group in groups.items():
+        for area in ('X', 'W'):
+            sensors = sorted((sensor for sensor in group['sensors'].values() if sensor.location_tuple[0] == area),
+                             key=lambda sensor: sensor.location_tuple[1])
+            addresses = [sensor.location_tuple[1] for sensor in sensors]
+            # one data source per range, so that each poll is one modbus request
+            for first, last in register_runs(addresses, max_gap, MAX_READ[area]):
+                name = f"{'_'.join(group['plcs'])}_{period}ms_{area}{first}-{last}"
+                data_source = copy.deepcopy(DATA_SOURCE_TEMPLATE)
+                data_source.update({
+                    "xid": xid('DS_', name),
+                    "name": name,
+                    "host": settings['host_address'],
+                    "port": port,
+                    # the range is read in one request, the unused addresses of its gaps included
+                    "contiguousBatches": False,
+                    "updatePeriodType": "SECONDS" if period % 1000 == 0 else "MILLISECONDS",
+                    "updatePeriods": period // 1000 if period % 1000 == 0 else period,
+                })
+                data_sources.append(data_source)
+                for sensor in sensors:
+                    if first <= sensor.location_tuple[1] <= last:
+                        data_points.append(data_point(sensor, data_source["xid"], unit_id))
+    log.info(f"SCADA config: {len(data_points)} points in {len(data_sources)} data sources of one modbus request "
+             f"per poll")
+    return {"dataSources": data_sources, "dataPoints": data_points, "pointHierarchy": hierarchy}
+
+
+def write_scada_config(path: str, settings: dict, plcs: dict, max_gap: int = 0) -> None:
+    """Write the json import built by `scada_config` to `path`"""
+    with open(path, 'w') as f:
+        json.dump(scada_config(settings, plcs, max_gap), f, indent=2)
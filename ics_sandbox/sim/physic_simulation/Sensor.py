@@ -1,17 +1,22 @@
+import itertools
 import logging
-import uuid
 from abc import abstractmethod
 from typing import Union
 
+import numpy as np
 import sympy.core.evalf as sp_evalf
 import yaml
 from numpy import random
 
-from ics_sandbox.sim.physic_simulation.Device import Device
+from Device import Device
 
 log = logging.getLogger('phy_sim')
 # TODO: describe more the different label for each device in the readme
-allowed_device_types = ['flowrate', 'state', 'volume']
+allowed_device_types = ['flowrate', 'state', 'volume', 'ph', 'chlorine']
+# number of noise values drawn at once for each sensor of a sensor bank
+NOISE_BLOCK_SIZE = 1024
+# unique ids given at creation, `build_simulation` replaces them by dense ids
+_sensor_ids = itertools.count()
 
 
 class InvalidSensor(Exception):
@@ -24,17 +29,26 @@ class InvalidSensor(Exception):
 
 class Sensor(yaml.YAMLObject):
     """Abstract Sensor"""
+    __slots__ = ('uid', 'sensor_type', 'label', 'device_to_monitor_label', 'device_to_monitor', 'location',
+                 'location_tuple', 'active', 'state', 'sample_period', 'sensor_bank', 'precision', 'aggregation',
+                 'window', 'deadband')
 
     def __init__(self, label='', sensor_type: str = None, location: str = None, state: bool = None,
-                 connected_to: str = None) -> None:
+                 connected_to: str = None, sample_period: int = None, aggregation: str = None, window: int = 10,
+                 deadband: float = 0) -> None:
         """
-        :param sensor_type: Type of sensor (flowrate, state, volume)
+        :param sensor_type: Type of sensor (flowrate, state, volume, ph, chlorine)
         :param label: Label of sensor
         :param location: Location of sensor (i.e X1, X10, W2, W25)
         :param state: State of sensor
         :param connected_to: Device label to monitor
+        :param sample_period: Time in milliseconds between two readings, default is every cycle
+        :param aggregation: reduction of the logged readings: 'min', 'max', 'mean' or 'last' of each `window` log
+        rows, 'deadband' (readings moving by more than `deadband`) or 'change', default logs every reading
+        :param window: number of log rows aggregated in one value
+        :param deadband: minimal variation of a logged reading with the 'deadband' aggregation
         """
-        self.uid = str(uuid.uuid4())[:8]
+        self.uid = next(_sensor_ids)
         self.sensor_type = sensor_type
         self.label = label
         self.device_to_monitor_label = connected_to
@@ -43,6 +57,12 @@ class Sensor(yaml.YAMLObject):
         self.location_tuple = None
         self.active = False
         self.state = state
+        self.sample_period = sample_period
+        self.aggregation = aggregation
+        self.window = window
+        self.deadband = deadband
+        # sensor bank updating this sensor, None if the sensor updates itself in `worker`
+        self.sensor_bank = None
 
         if (not self.sensor_type) or (self.sensor_type not in allowed_device_types):
             raise InvalidSensor(f"{self.sensor_type} in not a valid device type")
@@ -116,11 +136,15 @@ class Sensor(yaml.YAMLObject):
 
 class AnalogSensor(Sensor):
     """Abstract class for analog sensors"""
+    __slots__ = ('multiplier', 'seed', '_random_generator', 'standard_deviation', 'bank_index')
+    # attribute of the monitored device which is measured, and attribute of the sensor holding the reading
+    monitored_attribute = None
+    reading_attribute = None
 
     def __init__(self, sensor_type: str = None, precision: int = 5, multiplier: Union[int, float] = 1, seed: int = 123,
                  standard_deviation: int = 0, **kwargs) -> None:
         """
-        :param sensor_type: Type of sensor (flowrate, volume)
+        :param sensor_type: Type of sensor (flowrate, volume, ph, chlorine)
         :param precision: Number of digits to round the number
         :param multiplier: Multiplier of the sensor value
         :param seed: Seed for the random number generator
@@ -128,10 +152,19 @@ class AnalogSensor(Sensor):
         """
         self.precision = precision
         self.multiplier = multiplier
-        self.random_generator = random.default_rng(seed)
+        self.seed = seed
+        self._random_generator = None
         self.standard_deviation = standard_deviation
+        self.bank_index = None
         super().__init__(sensor_type=sensor_type, **kwargs)
 
+    @property
+    def random_generator(self) -> random.Generator:
+        """Random generator of the sensor noise, created when the first noise value is drawn"""
+        if self._random_generator is None:
+            self._random_generator = random.default_rng(self.seed)
+        return self._random_generator
+
     @abstractmethod
     def worker(self):
         """Do something at `worker_frequency` rate"""
@@ -154,8 +187,11 @@ class AnalogSensor(Sensor):
 
 class FlowRateSensor(AnalogSensor):
     """Flow rate sensor"""
+    __slots__ = ('flowrate',)
     yaml_tag = u'!flowrate'
     yaml_loader = yaml.Loader
+    monitored_attribute = 'current_flow_rate'
+    reading_attribute = 'flowrate'
 
     def __init__(self, sensor_type: str = 'flowrate', **kwargs):
         """
@@ -167,6 +203,9 @@ class FlowRateSensor(AnalogSensor):
     def worker(self) -> None:
         """Get the flow rate of the monitored device
         """
+        if self.sensor_bank is not None:
+            self.sensor_bank.worker(self.sensor_bank.indexes([self]))
+            return
         self.flowrate = sp_evalf.N(
             self.device_to_monitor.current_flow_rate + self.random_generator.normal(0, self.standard_deviation),
             self.precision)
@@ -184,8 +223,11 @@ class FlowRateSensor(AnalogSensor):
 
 class VolumeSensor(AnalogSensor):
     """Volume sensor"""
+    __slots__ = ('volume',)
     yaml_tag = u'!volume'
     yaml_loader = yaml.Loader
+    monitored_attribute = 'volume'
+    reading_attribute = 'volume'
 
     def __init__(self, sensor_type='volume', **kwargs):
         """
@@ -196,6 +238,9 @@ class VolumeSensor(AnalogSensor):
 
     def worker(self) -> None:
         """Get the volume of fluid of the monitored device"""
+        if self.sensor_bank is not None:
+            self.sensor_bank.worker(self.sensor_bank.indexes([self]))
+            return
         self.volume = sp_evalf.N(
             self.device_to_monitor.volume + self.random_generator.normal(0, self.standard_deviation), self.precision)
 
@@ -208,7 +253,176 @@ class VolumeSensor(AnalogSensor):
         return
 
 
+class PhSensor(AnalogSensor):
+    """pH sensor"""
+    __slots__ = ('ph',)
+    yaml_tag = u'!ph'
+    yaml_loader = yaml.Loader
+    monitored_attribute = 'ph'
+    reading_attribute = 'ph'
+
+    def __init__(self, sensor_type='ph', **kwargs):
+        """
+        :param sensor_type: Type of sensor: ph
+        """
+        self.ph = 0
+        super().__init__(sensor_type=sensor_type, **kwargs)
+
+    def worker(self) -> None:
+        """Get the pH of the fluid of the monitored device"""
+        if self.sensor_bank is not None:
+            self.sensor_bank.worker(self.sensor_bank.indexes([self]))
+            return
+        self.ph = sp_evalf.N(
+            self.device_to_monitor.ph + self.random_generator.normal(0, self.standard_deviation), self.precision)
+
+    def read_sensor(self) -> None:
+        """Report sensor value"""
+        return sp_evalf.N(self.ph, self.precision)
+
+    def write_sensor(self, state: bool = None) -> None:
+        """Empty function"""
+        return
+
+
+class ChlorineSensor(AnalogSensor):
+    """Free chlorine concentration sensor"""
+    __slots__ = ('chlorine',)
+    # !chlorine is the chlorine fluid
+    yaml_tag = u'!free_chlorine'
+    yaml_loader = yaml.Loader
+    monitored_attribute = 'chlorine'
+    reading_attribute = 'chlorine'
+
+    def __init__(self, sensor_type='chlorine', **kwargs):
+        """
+        :param sensor_type: Type of sensor: chlorine
+        """
+        self.chlorine = 0
+        super().__init__(sensor_type=sensor_type, **kwargs)
+
+    def worker(self) -> None:
+        """Get the free chlorine concentration of the fluid of the monitored device"""
+        if self.sensor_bank is not None:
+            self.sensor_bank.worker(self.sensor_bank.indexes([self]))
+            return
+        self.chlorine = sp_evalf.N(
+            self.device_to_monitor.chlorine + self.random_generator.normal(0, self.standard_deviation), self.precision)
+
+    def read_sensor(self) -> None:
+        """Report sensor value"""
+        return sp_evalf.N(self.chlorine, self.precision)
+
+    def write_sensor(self, state: bool = None) -> None:
+        """Empty function"""
+        return
+
+
+def round_significant(values: np.ndarray, precisions: np.ndarray) -> np.ndarray:
+    """Vectorized `sp_evalf.N(value, precision)`: round the binary mantissa of each value to the number of bits
+    sympy uses for `precision` significant digits, precisions must be greater than 1"""
+    bits = np.maximum(1, np.round((precisions + 1) * 3.3219280948873626)).astype(int)
+    mantissas, exponents = np.frexp(values)
+    return np.ldexp(np.round(np.ldexp(mantissas, bits)), exponents - bits)
+
+
+class AnalogSensorBank(object):
+    """Update all analog sensors in one vectorized step per cycle.
+    Each monitored device attribute is read once per cycle even if several sensors monitor it, and the noise of
+    each sensor is drawn by blocks from its own random generator, so readings are identical to updating the
+    sensors one by one"""
+
+    def __init__(self, sensors: list[AnalogSensor], block_size: int = NOISE_BLOCK_SIZE):
+        """
+        :param sensors: analog sensors of the simulation, their monitored device must be set
+        :param block_size: number of noise values drawn at once for each sensor
+        """
+        self.sensors = list(sensors)
+        self.block_size = block_size
+        # (device, attribute) read each cycle, and index of the read value for each sensor
+        self.readings = []
+        reading_indexes = {}
+        device_indexes = []
+        for index, sensor in enumerate(self.sensors):
+            key = (id(sensor.device_to_monitor), sensor.monitored_attribute)
+            if key not in reading_indexes:
+                reading_indexes[key] = len(self.readings)
+                self.readings.append((sensor.device_to_monitor, sensor.monitored_attribute))
+            device_indexes.append(reading_indexes[key])
+            sensor.sensor_bank = self
+            sensor.bank_index = index
+        self.device_indexes = np.array(device_indexes, dtype=int)
+        self.standard_deviations = np.array([sensor.standard_deviation for sensor in self.sensors], dtype=float)
+        self.precisions = np.array([sensor.precision for sensor in self.sensors], dtype=int)
+        # factor applied to the monitored values, flow rates are reported per `sim_speed` cycle whatever `dt` is
+        self.scales = np.ones(len(self.sensors))
+        # volume of one unit of the device volumes, with the fixed point volumes
+        self.volume_unit = 1
+        self.noise = np.zeros((len(self.sensors), block_size))
+        # next unused noise value of each sensor, a full block is drawn when it reaches `block_size`
+        self.noise_cursors = np.full(len(self.sensors), block_size, dtype=int)
+
+    def set_precision(self, precision: int) -> None:
+        """Set the number of significant digits of all sensors of the bank"""
+        for sensor in self.sensors:
+            sensor.precision = precision
+        self.precisions[:] = precision
+
+    def set_flow_scale(self, scale: float) -> None:
+        """Set the factor applied to the flow rates, which are volumes moved during one simulation step"""
+        for index, sensor in enumerate(self.sensors):
+            if sensor.monitored_attribute == 'current_flow_rate':
+                self.scales[index] = scale * self.volume_unit
+
+    def set_volume_unit(self, volume_unit: float) -> None:
+        """Convert the volumes and flow rates stored as integer numbers of `volume_unit`, call it before
+        `set_flow_scale`"""
+        self.volume_unit = volume_unit
+        for index, sensor in enumerate(self.sensors):
+            if sensor.monitored_attribute in ('volume', 'current_flow_rate'):
+                self.scales[index] = volume_unit
+
+    def draw_noise(self, indexes: np.ndarray) -> np.ndarray:
+        """Return the next noise value of the sensors at `indexes`, drawing new blocks when exhausted"""
+        for index in indexes[self.noise_cursors[indexes] >= self.block_size]:
+            sensor = self.sensors[index]
+            self.noise[index] = sensor.random_generator.normal(0, self.standard_deviations[index], self.block_size)
+            self.noise_cursors[index] = 0
+        noise = self.noise[indexes, self.noise_cursors[indexes]]
+        self.noise_cursors[indexes] += 1
+        return noise
+
+    def indexes(self, sensors: list[AnalogSensor]) -> np.ndarray:
+        """Return the bank indexes of `sensors`"""
+        return np.array([sensor.bank_index for sensor in sensors], dtype=int)
+
+    def worker(self, indexes: np.ndarray = None) -> None:
+        """
+        Update the readings of the sensors
+        :param indexes: bank indexes of the sensors to update, default is all sensors of the bank
+        """
+        if indexes is None:
+            indexes = np.arange(len(self.sensors))
+            device_values = np.array([getattr(device, attribute) for device, attribute in self.readings],
+                                     dtype=float)
+            values = device_values[self.device_indexes] * self.scales
+        else:
+            values = np.array([getattr(*self.readings[self.device_indexes[index]]) for index in indexes],
+                              dtype=float) * self.scales[indexes]
+        values = values + self.draw_noise(indexes)
+        precisions = self.precisions[indexes]
+        rounded = round_significant(values, np.maximum(precisions, 2))
+        for position, index in enumerate(indexes):
+            sensor = self.sensors[index]
+            if precisions[position] > 1:
+                setattr(sensor, sensor.reading_attribute, float(rounded[position]))
+            else:
+                # sympy rounds 1 significant digit in decimal
+                setattr(sensor, sensor.reading_attribute, sp_evalf.N(values[position], precisions[position]))
+
+
 class StateSensor(Sensor):
+    __slots__ = ('recorded_state',)
     yaml_tag = u'!state'
     yaml_loader = yaml.Loader
 
@@ -1,16 +1,31 @@
 import csv
+import os
 import signal
 import sys
+import threading
 import time
 import traceback
 
-from pyModbusTCP.server import ModbusServer
+import sympy.core.evalf as sp_evalf
 
 from Device import *
 from Fluid import *
+from History import HistoryBuffer, HistoryServer
+from Hydraulics import HydraulicNetwork
+from ChunkedLog import open_log
+from ConfigReload import ConfigWatcher, missing_references
+from ModbusFrontend import build_modbus_servers
+from ModbusTraffic import TrafficRecorder, TrafficReplay
 from Plc import *
+from Plc import _16BITS
+from PsmHarness import PsmScript
+from Replay import CsvReplay
+from Scada import write_scada_config
 from Sensor import *
-from utils import parse_yml, build_simulation
+from StRuntime import load_st_file
+from Telemetry import TelemetryWriter, telemetry_writer
+from utils import parse_yml, build_simulation, build_quality_store, connect_devices, Allowed_engine, \
+    Allowed_physics, Allowed_math_type
 
 logging.basicConfig()
 log = logging.getLogger('phy_sim')
@@ -33,7 +48,7 @@ def check_reservoir_volume(devices: {}, last_volume: float, precision: int):
         if isinstance(device, Tank):
             current_volume += device.volume
         if isinstance(device, Reservoir):
-            last_volume += device.input_per_cycle
+            last_volume += device.input_per_step
     if current_volume - last_volume > 1 ** - precision:
         log.debug(f"Current volume: {current_volume}")
         log.debug(f"Last volume: {last_volume}")
@@ -41,6 +56,12 @@ def check_reservoir_volume(devices: {}, last_volume: float, precision: int):
     return current_volume
 
 
+def same_rates(rates: list[float], last_rates: list[float]) -> bool:
+    """Check that the tank level variations of two cycles are equal, up to rounding errors"""
+    return last_rates is not None and all(abs(rate - last_rate) <= 1e-9 * max(abs(rate), 1)
+                                          for rate, last_rate in zip(rates, last_rates))
+
+
 def set_logging():
     # TODO: being adaptable (logger)
     log_formatter = logging.Formatter("%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s")
@@ -54,18 +75,37 @@ def set_logging():
 class Simulator(object):
     """Main class which control all the simulation"""
 
-    def __init__(self, debug=0, math_parser='proportional'):
+    def __init__(self, debug=0, math_parser='proportional', headless=False):
         signal.signal(signal.SIGINT, self.sig_handler)
 
         self.path_to_yaml_config = None
         self.config = None
         self.settings = None
         self.devices = None
+        self.device_graph = None
         self.sensors = None
+        self.sensor_bank = None
+        self.quality_store = None
+        self.hydraulics = None
         self.plcs = None
         self.math_parser = math_parser
         self.max_cycle = None
         self.current_tanks_volume = 0
+        self.headless = headless
+        self.cycle = 0
+        self.sim_time_ms = 0
+        self.dt_ms = 0
+        self.lockstep = False
+        self.data_bank_condition = threading.Condition()
+        self.pending_plcs = set()
+        self.start_time = None
+        self.schedule = {}
+        self.engine = Allowed_engine.cycle.value
+        self.data_bank_writes = 0
+        self.steady_count = 0
+        self.steady_rates = None
+        self.config_watcher = None
+        self.history = None
 
         if debug == 1:
             log.setLevel(logging.INFO)
@@ -76,6 +116,7 @@ class Simulator(object):
     constructor
     :param debug: 0: level warning, 1: level info, 2:level debug
     :param math_parser: 'proportional', 'sympy' or 'wolfram'
+    :param headless: run without modbus server and without sleeping between cycles
     """
 
     def sig_handler(self) -> None:
@@ -91,84 +132,343 @@ class Simulator(object):
         simulation = build_simulation(self.config, self.math_parser)
         self.settings = simulation['settings']
         self.devices: dict[str, Device] = simulation['devices']
+        self.device_graph: DeviceGraph = simulation['device_graph']
         self.sensors: dict[str, Sensor] = simulation['sensors']
+        self.sensor_bank: AnalogSensorBank = simulation['sensor_bank']
         self.plcs: dict[str, PLC] = simulation['plcs']
 
         self.set_precision(self.settings['precision'])
         self.max_cycle = self.settings['max_cycle']
+        self.headless = self.headless or self.settings.get('headless', False)
+        self.lockstep = self.settings.get('lockstep', False)
+        self.engine = self.settings.get('engine', Allowed_engine.cycle.value)
+        if self.engine not in [e.value for e in Allowed_engine]:
+            raise ValueError(f'Engine {self.engine} is not allowed.')
+        if self.engine == Allowed_engine.event.value:
+            # jumps in simulated time can't be followed by external PLCs
+            self.headless = True
+        if self.settings.get('quality_model'):
+            self.quality_store = build_quality_store(self.devices)
+        physics = self.settings.get('physics', Allowed_physics.volume.value)
+        if physics not in [e.value for e in Allowed_physics]:
+            raise ValueError(f'Physics {physics} is not allowed.')
+        if physics == Allowed_physics.hydraulic.value:
+            if self.quality_store is not None:
+                log.warning("The quality model is not mixed by the hydraulic physics")
+            self.hydraulics = HydraulicNetwork(self.devices, self.settings.get('pipe_resistance', 1e-4))
+        self.set_ack_registers()
+        self.set_volume_unit(self.settings.get('fixed_point_resolution'))
+        self.set_time_step()
+        self.build_schedule()
         self.set_current_tanks_volume()
+        self.load_st_programs()
+        self.load_psm_scripts()
+        if self.settings.get('hot_reload'):
+            self.config_watcher = ConfigWatcher(path_to_yaml_config, self.settings.get('hot_reload_period', 1))
 
     def start(self) -> None:
         """Start the simulation"""
         set_logging()
 
-        # Create data bank and modbus server
-        my_data_bank = DataBank()
-        server = ModbusServer(self.settings['host_address'], self.settings['port'], data_bank=my_data_bank,
-                              no_block=True)
+        # Create data banks and modbus servers
+        recorder = None
+        if self.settings.get('record_traffic'):
+            recorder = TrafficRecorder(self.settings['record_traffic'], lambda: self.cycle)
+        servers = build_modbus_servers(self.settings, self.plcs, recorder)
+        for data_bank in self.data_banks():
+            data_bank.add_listener(self.on_data_bank_write)
 
-        self.set_inner_state(my_data_bank)
+        self.set_inner_state()
         self.set_initial_state()
+        history_server = self.start_history()
 
         try:
-            log.info("Start Modbus TCP server...")
-            server.start()
-            log.info("Server is online")
+            if not self.headless:
+                log.info("Start Modbus TCP server...")
+                for server in servers:
+                    server.start()
+                log.info("Server is online")
 
             csv_field_names = ['timestamp_ns']
+            if self.engine == Allowed_engine.event.value or self.settings.get('steady_state_cycles'):
+                csv_field_names.append('sim_time_ms')
             for sensor in self.sensors.values():
                 csv_field_names.append(sensor.label)
 
-            with open('simulation_log.csv', 'w', newline='') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=csv_field_names)
-                writer.writeheader()
+            with open_log(self.settings, csv_field_names, lambda: self.cycle) as writer:
+                # sensors with an `aggregation` are reduced before being written
+                writer = telemetry_writer(writer, [self.sensors[label] for label in csv_field_names
+                                                   if label in self.sensors])
 
                 # wait all PLCs are connected
-                self.wait_PLCs_connection()
-                if self.max_cycle == 0:
-                    while True:
-                        self.main_loop(writer, csv_field_names)
+                self.start_time = time.monotonic()
+                if not self.headless:
+                    self.wait_PLCs_connection()
+                if self.engine == Allowed_engine.event.value:
+                    self.event_loop(writer, csv_field_names)
                 else:
-                    for i in range(self.max_cycle):
-                        self.main_loop(writer, csv_field_names)
-            server.stop()
+                    while self.max_cycle == 0 or self.cycle < self.max_cycle:
+                        self.run_cycle(writer, csv_field_names)
+                if isinstance(writer, TelemetryWriter):
+                    last_row = {'timestamp_ns': time.time_ns()}
+                    if 'sim_time_ms' in csv_field_names:
+                        last_row['sim_time_ms'] = self.sim_time_ms
+                    writer.flush(last_row)
+            for server in servers:
+                server.stop()
         except Exception as error:
             # TODO: implement proper signal handling
             log.info("Shutdown server ...")
-            server.stop()
+            for server in servers:
+                server.stop()
             log.info("Server is offline")
             traceback.print_exc()
         finally:
             log.info("Shutdown server ...")
-            server.stop()
+            for server in servers:
+                server.stop()
+            log.info("Server is offline")
+            if recorder is not None:
+                recorder.close()
+            if history_server is not None:
+                history_server.stop()
+
+    def start_history(self):
+        """Create the history buffer of the last `history_cycles` cycles, and its server if `history_port` is set
+        :return: the HistoryServer, None if the history isn't served
+        """
+        if not self.settings.get('history_cycles'):
+            return None
+        self.history = HistoryBuffer(self.sensors.keys(), self.devices.keys(), self.settings['history_cycles'])
+        if self.settings.get('history_port') is None:
+            return None
+        history_server = HistoryServer(self.history, self.settings['history_port'],
+                                       self.settings.get('history_host', '127.0.0.1'))
+        history_server.start()
+        return history_server
+
+    def replay(self, path_to_csv: str, speed: float = 1.0, start_ns: int = None, end_ns: int = None) -> None:
+        """
+        Serve a recorded simulation log on the modbus servers instead of simulating the physics
+        :param path_to_csv: path to a simulation_log.csv or to a chunked log
+        :param speed: replay speed relative to the recorded timestamps, 1 is real time, 0 is as fast as possible
+        :param start_ns, end_ns: range of timestamp_ns replayed, the whole log by default
+        """
+        set_logging()
+        servers = build_modbus_servers(self.settings, self.plcs)
+        try:
+            if not self.headless:
+                log.info("Start Modbus TCP server...")
+                for server in servers:
+                    server.start()
+                log.info("Server is online")
+            CsvReplay(path_to_csv, self.plcs).run(speed, start_ns, end_ns)
+        finally:
+            log.info("Shutdown server ...")
+            for server in servers:
+                server.stop()
             log.info("Server is offline")
 
-    def wait_PLCs_connection(self):
-        """Wait until all PLCs are connected before starting the simulation"""
-        for i in range(1200):
-            count = 0
-            for plc in self.plcs.values():
-                if plc.check_connected():
-                    count += 1
-                else:
-                    log.info(f"PLC {plc.label} not connected")
-            if count == len(self.plcs):
-                log.info(f"All PLCs are connected")
-                break
-            else:
-                log.info(f"Waiting 3 s")
-                time.sleep(3)
+    def replay_traffic(self, path_to_traffic: str) -> None:
+        """
+        Run the simulation headless, feeding the recorded modbus requests to the servers at the cycle they were
+        processed and comparing the responses with the recorded ones. The log is written to simulation_log_replay.csv
+        :param path_to_traffic: path to a file recorded with the `record_traffic` setting
+        """
+        set_logging()
+        servers = build_modbus_servers(self.settings, self.plcs)
+        self.headless = True
+        self.set_inner_state()
+        self.set_initial_state()
+        replay = TrafficReplay(path_to_traffic, servers)
+
+        csv_field_names = ['timestamp_ns'] + [sensor.label for sensor in self.sensors.values()]
+        with open('simulation_log_replay.csv', 'w', newline='') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=csv_field_names)
+            writer.writeheader()
+            self.start_time = time.monotonic()
+            if self.settings.get('partial_start', False):
+                self.pending_plcs = {plc.label for plc in self.plcs.values()}
+            while not replay.finished() and (self.max_cycle == 0 or self.cycle < self.max_cycle):
+                if self.lockstep:
+                    self.publish_cycle()
+                replay.apply(self.cycle)
+                self.main_loop(writer, csv_field_names)
+        log.info(f"Replayed {self.cycle} cycles in {time.monotonic() - self.start_time:.3f} s")
+        replay.report()
+
+    def wait_PLCs_connection(self) -> bool:
+        """Wait until all PLCs are connected before starting the simulation,
+        woken up by the modbus writes of the connection established coils.
+        With `partial_start`, start as soon as one PLC is connected, the others join when they connect
+        :return: True if all PLCs are connected
+        """
+        start = time.monotonic()
+        deadline = start + self.settings.get('connection_timeout', 3600)
+        report_period = self.settings.get('connection_report_period', 3)
+        next_report = start + report_period
+        self.pending_plcs = {plc.label for plc in self.plcs.values()}
+        with self.data_bank_condition:
+            while True:
+                self.check_pending_plcs(start)
+                if not self.pending_plcs:
+                    log.info(f"All PLCs are connected after {time.monotonic() - start:.3f} s")
+                    return True
+                if self.settings.get('partial_start', False) and len(self.pending_plcs) < len(self.plcs):
+                    log.info(f"Start without PLCs {sorted(self.pending_plcs)}, they join when connected")
+                    return False
+                now = time.monotonic()
+                if now >= deadline:
+                    log.warning(f"PLCs {sorted(self.pending_plcs)} not connected after "
+                                f"{self.settings.get('connection_timeout', 3600)} s, start anyway")
+                    self.pending_plcs = set()
+                    return False
+                if now >= next_report:
+                    log.info(f"Waiting PLCs {sorted(self.pending_plcs)} since {now - start:.1f} s")
+                    next_report += report_period
+                self.data_bank_condition.wait(timeout=min(deadline, next_report) - now)
+
+    def check_pending_plcs(self, start: float) -> None:
+        """Remove newly connected PLCs from the pending PLCs
+        :param start: time.monotonic() value at which the simulator started waiting the PLCs
+        """
+        for label in sorted(self.pending_plcs):
+            if self.plcs[label].check_connected():
+                self.pending_plcs.discard(label)
+                log.info(f"PLC {label} connected after {time.monotonic() - start:.3f} s")
+
+    def data_banks(self) -> list[DataBank]:
+        """Return the distinct data banks of the PLCs"""
+        return list({id(plc.data_bank): plc.data_bank for plc in self.plcs.values()}.values())
+
+    def on_data_bank_write(self, area: str, address: int, from_value, to_value) -> None:
+        """Called by the modbus server threads when a client changes the data bank, wake up the waiting loop"""
+        with self.data_bank_condition:
+            # lockstep acknowledgements don't drive the plant
+            if area != 'W' or all(plc.ack_register != address for plc in self.plcs.values()):
+                self.data_bank_writes += 1
+            self.data_bank_condition.notify_all()
+
+    def set_ack_registers(self) -> None:
+        """Give each PLC without `ack_register` the register following the lockstep cycle register"""
+        lockstep_register = self.settings.get('lockstep_register', 65000)
+        for index, plc in enumerate(self.plcs.values()):
+            if plc.ack_register is None:
+                plc.ack_register = lockstep_register + index + 1
+
+    def publish_cycle(self) -> None:
+        """Write the simulation cycle counter (16 bits) in the lockstep register of every data bank"""
+        for data_bank in self.data_banks():
+            data_bank.set_holding_registers(self.settings.get('lockstep_register', 65000), [self.cycle & _16BITS])
+
+    def wait_acknowledgements(self, deadline: float) -> None:
+        """
+        Wait until every PLC acknowledged the published cycle, or until the wall clock deadline
+        :param deadline: time.monotonic() value at which the simulation continues anyway
+        """
+        with self.data_bank_condition:
+            acknowledged = self.data_bank_condition.wait_for(
+                lambda: all(plc.check_acknowledged(self.cycle) for plc in self.plcs.values()
+                            if plc.label not in self.pending_plcs),
+                timeout=max(deadline - time.monotonic(), 0))
+        if not acknowledged:
+            log.debug(f"Cycle {self.cycle} not acknowledged by all PLCs before the deadline")
+
+    def set_time_step(self) -> None:
+        """Set the simulated time of a cycle, `dt` milliseconds (default `sim_speed`), and convert the device rates
+        and the flow rate readings, per cycle quantities are given for cycles of `sim_speed` milliseconds"""
+        sim_speed = int(self.settings['sim_speed'])
+        self.dt_ms = self.settings.get('dt', sim_speed)
+        cycle_time = sim_speed / 1000 if sim_speed > 0 else self.dt_ms / 1000
+        for device in self.devices.values():
+            device.set_time_step(self.dt_ms / 1000, cycle_time)
+        self.sensor_bank.set_flow_scale(cycle_time * 1000 / self.dt_ms if self.dt_ms > 0 else 1)
+
+    def set_volume_unit(self, volume_unit: float = None) -> None:
+        """Store the device volumes as integer numbers of `volume_unit` (`fixed_point_resolution`), so that the
+        fluid is split and moved exactly, the sensors still report volumes in the configuration unit"""
+        if not volume_unit:
+            return
+        if self.math_parser != Allowed_math_type.proportional.value or self.hydraulics is not None:
+            raise ValueError('fixed_point_resolution requires the proportional math parser and the volume physics')
+        for device in self.devices.values():
+            device.set_volume_unit(volume_unit)
+        self.sensor_bank.set_volume_unit(volume_unit)
+
+    def period_cycles(self, period) -> int:
+        """Convert a period in milliseconds of simulated time to a number of simulation cycles, at least 1"""
+        if period is None or self.dt_ms <= 0:
+            return 1
+        return max(1, round(period / self.dt_ms))
+
+    def build_schedule(self) -> None:
+        """Group the sensors by `sample_period` and the PLCs by `update_period`, converted in cycles,
+        each group runs on the cycles which reach a multiple of its period in simulated time"""
+        self.schedule = {}
+        for sensor in self.sensors.values():
+            group = self.schedule.setdefault(self.period_cycles(sensor.sample_period),
+                                             {'sensors': [], 'banked_sensors': [], 'plcs': []})
+            group['banked_sensors' if sensor.sensor_bank is not None else 'sensors'].append(sensor)
+        for plc in self.plcs.values():
+            group = self.schedule.setdefault(self.period_cycles(plc.update_period),
+                                             {'sensors': [], 'banked_sensors': [], 'plcs': []})
+            group['plcs'].append(plc)
+        for period, group in sorted(self.schedule.items()):
+            group['bank_indexes'] = self.sensor_bank.indexes(group.pop('banked_sensors'))
+            log.info(f"Every {period} cycles: {len(group['bank_indexes']) + len(group['sensors'])} sensors, "
+                     f"{len(group['plcs'])} PLCs")
+
+    def due_groups(self, elapsed_ms: int = None) -> list[dict]:
+        """Return the schedule groups which run in the current cycle, the ones whose period boundary falls in the
+        simulated time it covers, so that a jump of the event engine or of the steady state doesn't skip them
+        :param elapsed_ms: simulated time covered by the cycle, default is `dt`
+        """
+        if self.dt_ms <= 0:
+            return list(self.schedule.values())
+        start = self.sim_time_ms
+        end = start + (elapsed_ms or self.dt_ms)
+        return [group for period, group in self.schedule.items()
+                if -(-start // (period * self.dt_ms)) * period * self.dt_ms < end]
+
+    def load_st_programs(self) -> None:
+        """Compile the Structured Text program of PLCs which have one, path is relative to the yaml config file"""
+        config_directory = os.path.dirname(os.path.abspath(self.path_to_yaml_config))
+        for plc in self.plcs.values():
+            if plc.program is not None:
+                plc.st_programs = load_st_file(os.path.join(config_directory, plc.program),
+                                               self.settings.get('plc_speed', self.settings['sim_speed']))
+
+    def run_st_programs(self, time_ms: int = None, max_scans: int = None) -> None:
+        """Scan the in-simulator Structured Text programs for every task interval elapsed in the simulated time
+        :param time_ms: simulated time to reach, default is the current simulated time
+        :param max_scans: maximal number of scans of each program
+        """
+        for plc in self.plcs.values():
+            for st_program in plc.st_programs:
+                st_program.run_until(self.sim_time_ms if time_ms is None else time_ms, max_scans)
+
+    def load_psm_scripts(self) -> None:
+        """Prepare the in-process harness of PLCs which have a psm script, path is relative to the yaml config file"""
+        config_directory = os.path.dirname(os.path.abspath(self.path_to_yaml_config))
+        for plc in self.plcs.values():
+            if plc.psm_script is not None:
+                plc.psm_harness = PsmScript(os.path.join(config_directory, plc.psm_script), plc.label,
+                                            os.path.abspath(self.path_to_yaml_config))
+
+    def run_psm_scripts(self) -> None:
+        """Run one cycle of every in-process psm script, in lockstep with the simulation"""
+        for plc in self.plcs.values():
+            if plc.psm_harness is not None:
+                plc.psm_harness.step()
 
-    def set_inner_state(self, my_data_bank: DataBank) -> None:
-        """Set initial state of the modbus data bank with initial state given by the yaml config file"""
+    def set_inner_state(self) -> None:
+        """Set initial state of devices and sensors with initial state given by the yaml config file"""
         for device in self.devices.values():
             if device.read_state():
                 device.activate()
         for sensor in self.sensors.values():
             if sensor.read_state():
                 sensor.activate()
-        for plc in self.plcs.values():
-            plc.set_data_bank(my_data_bank)
 
     def set_initial_state(self) -> None:
         """Set initial state of sensors and PLCs"""
@@ -177,6 +477,9 @@ class Simulator(object):
                 sensor.worker()
         for plc in self.plcs.values():
             plc.worker()
+        for plc in self.plcs.values():
+            if plc.psm_harness is not None:
+                plc.psm_harness.load()
 
     def pause(self) -> None:
         # TODO: handle sigint to pause the simulation
@@ -201,6 +504,113 @@ class Simulator(object):
         self.load_yml(self.path_to_yaml_config)
         self.start()
 
+    def reload_config(self, csv_field_names: list[str]) -> None:
+        """Apply the changes of the yaml config file, called at a cycle boundary. The modbus servers, the PLC
+        connections and the device states and volumes are kept, changes needing a restart are not applied"""
+        change = self.config_watcher.poll()
+        if change is None:
+            return
+        diff, config, raw_config = change
+        if diff.empty():
+            self.config_watcher.accept(raw_config)
+            return
+        reasons = diff.restart_reasons() + [f"unknown {label}" for label in missing_references(config)]
+        if self.quality_store is not None and (diff.devices['added'] or diff.devices['removed']):
+            reasons.append("devices added or removed with the quality model")
+        if reasons:
+            log.warning(f"Config change not applied, it needs a restart: {', '.join(reasons)}")
+            return
+        log.warning(f"Cycle {self.cycle}: config reloaded, {diff}")
+        self.apply_config(diff, config)
+        self.config_watcher.accept(raw_config)
+        for label in diff.sensors['added']:
+            if label not in csv_field_names:
+                log.info(f"Sensor {label} is logged from the next start")
+
+    def apply_config(self, diff, config: dict) -> None:
+        """
+        Rebuild the parts of the plant changed by a new version of the config
+        :param diff: ConfigDiff between the running config and `config`
+        :param config: new config, parsed with the simulation loader
+        """
+        for key, value in diff.settings.items():
+            if value is None:
+                self.settings.pop(key, None)
+            else:
+                self.settings[key] = value
+        self.max_cycle = self.settings['max_cycle']
+        volume_unit = self.settings.get('fixed_point_resolution')
+
+        # devices keep their state, volume and fluid, new ones are taken from the new config
+        devices = {}
+        for new_device in config['devices']:
+            device = self.devices.get(new_device.label)
+            if device is None or new_device.label in diff.devices['added']:
+                device = new_device
+                device.math_parser = self.math_parser
+                if volume_unit:
+                    device.set_volume_unit(volume_unit)
+                if device.read_state():
+                    device.activate()
+            elif new_device.label in diff.devices['changed']:
+                device.update_parameters(new_device, diff.devices['changed'][new_device.label])
+            devices[device.label] = device
+        self.devices = devices
+        if diff.topology_changed():
+            for device in devices.values():
+                device.disconnect()
+            connect_devices(config, devices, self.math_parser)
+            self.device_graph = build_device_graph(list(devices.values()))
+        elif diff.devices['changed'] and self.math_parser != Allowed_math_type.proportional.value:
+            # the cached constant expressions may depend on the changed parameters
+            for device in devices.values():
+                device.bind_expressions()
+        if self.hydraulics is not None and (diff.topology_changed() or diff.devices['changed']):
+            self.hydraulics = HydraulicNetwork(self.devices, self.settings.get('pipe_resistance', 1e-4))
+
+        # sensors keep their reading unless they changed, the bank is rebuilt when a sensor or a device changed
+        sensors = {}
+        rebuild_bank = diff.sensors_changed()
+        for new_sensor in config['sensors']:
+            sensor = self.sensors.get(new_sensor.label)
+            if sensor is None or new_sensor.label in diff.sensors['added'] \
+                    or new_sensor.label in diff.sensors['changed']:
+                sensor = new_sensor
+                sensor.set_location_tuple()
+                if sensor.read_state():
+                    sensor.activate()
+            if sensor.device_to_monitor is not devices[sensor.device_to_monitor_label]:
+                sensor.monitor_device(devices[sensor.device_to_monitor_label])
+                rebuild_bank = True
+            sensors[sensor.label] = sensor
+        self.sensors = sensors
+        if rebuild_bank:
+            self.sensor_bank = AnalogSensorBank([sensor for sensor in sensors.values()
+                                                 if isinstance(sensor, AnalogSensor)])
+            if volume_unit:
+                self.sensor_bank.set_volume_unit(volume_unit)
+            for uid, sensor in enumerate(sensors.values()):
+                sensor.uid = uid
+
+        # register maps of the PLCs
+        new_plcs = {plc.label: plc for plc in config['plcs']}
+        for label in diff.plcs['changed']:
+            self.plcs[label].controlled_sensors_label = new_plcs[label].controlled_sensors_label
+            self.plcs[label].update_period = new_plcs[label].update_period
+        if rebuild_bank or diff.plcs['changed']:
+            for plc in self.plcs.values():
+                plc.controlled_sensors = {label: sensors[label] for label in plc.controlled_sensors_label}
+
+        self.config = config
+        self.set_precision(self.settings['precision'])
+        self.set_time_step()
+        self.build_schedule()
+        self.current_tanks_volume = 0
+        self.set_current_tanks_volume()
+        # the flows may have changed
+        self.steady_count = 0
+        self.steady_rates = None
+
     def set_precision(self, precision: int) -> None:
         """
         Set the number of output digits of devices, sensors, plc
@@ -209,6 +619,7 @@ class Simulator(object):
         for device in self.devices.values():
             device.precision = precision
 
+        self.sensor_bank.set_precision(precision)
         for sensor in self.sensors.values():
             sensor.precision = precision
 
@@ -221,33 +632,251 @@ class Simulator(object):
             if isinstance(device, Tank):
                 self.current_tanks_volume += device.volume
 
-    def main_loop(self, writer: csv.DictWriter, csv_field_names: list[str]) -> None:
+    def run_plc_workers(self, due_groups: list[dict]) -> None:
+        """Exchange data between the devices and the data bank for the PLCs of `due_groups`"""
+        for group in due_groups:
+            for plc in group['plcs']:
+                # PLCs not connected yet don't drive their devices
+                if plc.label not in self.pending_plcs:
+                    plc.worker()
+
+    def actuation_pending(self) -> bool:
+        """Return True if a connected PLC has outputs its next worker call will apply to the devices"""
+        return any(plc.actuation_pending() for plc in self.plcs.values() if plc.label not in self.pending_plcs)
+
+    def tanks(self) -> list[Tank]:
+        """Return the devices storing fluid (tanks, reservoirs, vessels)"""
+        return [device for device in self.devices.values() if isinstance(device, Tank)]
+
+    def device_states(self) -> list[tuple]:
+        """Return the (active, state) of all devices"""
+        return [(device.active, device.state) for device in self.devices.values()]
+
+    def next_event(self, tanks: list[Tank], rates: list[float]) -> float:
+        """
+        Return the simulated time until the first tank gets full, empty or crosses one of its `event_thresholds`
+        :param tanks: tanks of the simulation
+        :param rates: volume variation of each tank per millisecond
+        :return: time in milliseconds, infinite if no tank level changes
+        """
+        thresholds = self.settings.get('event_thresholds') or {}
+        next_event = float('inf')
+        for tank, rate in zip(tanks, rates):
+            volume = float(tank.volume)
+            limits = [0, tank.max_volume] + [to_units(threshold, tank.volume_unit)
+                                             for threshold in thresholds.get(tank.label, [])]
+            if rate > 0:
+                next_event = min([next_event] + [(limit - volume) / rate for limit in limits if limit > volume])
+            elif rate < 0:
+                next_event = min([next_event] + [(limit - volume) / rate for limit in limits if limit < volume])
+        return next_event
+
+    def write_interpolated_samples(self, writer: csv.DictWriter, csv_field_names: list[str], tanks: list[Tank],
+                                   rates: list[float], jump: float, sample_period: int) -> None:
+        """Write a log row every `sample_period` milliseconds of a jump, volumes are interpolated linearly
+        (without noise), the other sensors keep their reading"""
+        tank_rates = {id(tank): rate for tank, rate in zip(tanks, rates)}
+        sample_time = (self.sim_time_ms // sample_period + 1) * sample_period
+        while sample_time < self.sim_time_ms + jump:
+            row = {'timestamp_ns': time.time_ns()}
+            if 'sim_time_ms' in csv_field_names:
+                row['sim_time_ms'] = sample_time
+            for sensor in self.sensors.values():
+                if sensor.label not in csv_field_names:
+                    continue
+                if isinstance(sensor, VolumeSensor) and id(sensor.device_to_monitor) in tank_rates:
+                    volume = sensor.device_to_monitor.volume + \
+                             tank_rates[id(sensor.device_to_monitor)] * (sample_time - self.sim_time_ms)
+                    volume *= sensor.device_to_monitor.volume_unit or 1
+                    row[sensor.label] = sp_evalf.N(volume, sensor.precision)
+                else:
+                    row[sensor.label] = sensor.read_sensor()
+            writer.writerow(row)
+            sample_time += sample_period
+
+    def fast_forward(self, writer: csv.DictWriter, csv_field_names: list[str], tanks: list[Tank], rates: list[float],
+                     jump: int, sample_period: int = None) -> None:
+        """
+        Advance the tank volumes analytically by `jump` milliseconds at constant `rates`, then run the sensors and
+        PLCs once in a cycle of `jump` milliseconds
+        :param sample_period: if given, time in milliseconds between two interpolated log rows during the jump
+        """
+        if sample_period:
+            self.write_interpolated_samples(writer, csv_field_names, tanks, rates, jump, sample_period)
+        if self.quality_store is not None:
+            held_volumes = self.quality_store.held_volumes()
+        for tank, rate in zip(tanks, rates):
+            # the jump stops at the first limit, only rounding errors are clamped
+            volume = max(tank.volume + rate * jump, 0)
+            if tank.volume_unit is not None:
+                volume = round(volume)
+            tank.volume = min(volume, tank.max_volume) if tank.volume <= tank.max_volume else volume
+        self.current_tanks_volume = sum(tank.volume for tank in tanks)
+        if self.quality_store is not None:
+            # the flows of the last cycle go on during the jump
+            self.quality_store.advance(int(jump // self.dt_ms), held_volumes, self.quality_store.held_volumes())
+        self.main_loop(writer, csv_field_names, elapsed_ms=jump)
+
+    def run_cycle(self, writer: csv.DictWriter, csv_field_names: list[str]) -> None:
+        """Run one simulation cycle. With `steady_state_cycles`, once the tank level variations stayed the same during
+        this number of cycles without device state change nor modbus write, the flows are not propagated anymore and
+        the tank volumes are advanced analytically: cycle by cycle in live mode, and in bulk until the next tank
+        limit when headless, with one log row per skipped cycle"""
+        steady_state_cycles = self.settings.get('steady_state_cycles')
+        if not steady_state_cycles:
+            self.main_loop(writer, csv_field_names)
+            return
+        tanks = self.tanks()
+        states = self.device_states()
+        writes = self.data_bank_writes
+        if self.steady_count >= steady_state_cycles:
+            next_event = self.next_event(tanks, self.steady_rates)
+            jump = min(next_event, self.settings.get('event_max_step', 3600000))
+            cycles = int(jump // self.dt_ms) if self.dt_ms > 0 else 0
+            if not self.headless:
+                cycles = min(cycles, 1)
+            elif self.max_cycle:
+                cycles = min(cycles, self.max_cycle - self.cycle)
+            # the cycles around a tank getting full or empty are run regularly, the flows are cut during them
+            reaches_limit = (cycles + 1) * self.dt_ms >= next_event
+            if reaches_limit:
+                cycles -= 1
+            # outputs the PLC programs computed in the last cycle are applied in the next one, as without jump
+            if cycles > 0 and self.device_states() == states and not (self.headless and self.actuation_pending()):
+                self.cycle += cycles - 1
+                self.fast_forward(writer, csv_field_names, tanks, self.steady_rates, cycles * self.dt_ms,
+                                  self.dt_ms)
+                if reaches_limit or self.device_states() != states or self.data_bank_writes != writes:
+                    log.info(f"Cycle {self.cycle}: steady state left")
+                    self.steady_count = 0
+                    self.steady_rates = None
+                return
+            self.steady_count = 0
+            states = self.device_states()
+
+        volumes = [tank.volume for tank in tanks]
+        self.main_loop(writer, csv_field_names)
+        rates = [float(tank.volume - volume) / self.dt_ms if self.dt_ms > 0 else 0
+                 for tank, volume in zip(tanks, volumes)]
+        if self.device_states() == states and self.data_bank_writes == writes and same_rates(rates, self.steady_rates):
+            self.steady_count += 1
+            if self.steady_count == steady_state_cycles:
+                log.info(f"Cycle {self.cycle}: steady state detected")
+        else:
+            self.steady_count = 0
+        self.steady_rates = rates
+
+    def event_loop(self, writer: csv.DictWriter, csv_field_names: list[str]) -> None:
+        """Run the simulation by events until `max_cycle` * `dt` of simulated time (infinitely if `max_cycle` is 0).
+        After two regular cycles with the same tank level variations, if no device changed state, the flows stay the
+        same and the tank levels are linear until the next tank full, empty or threshold crossing, so the levels are
+        advanced directly to it in one cycle"""
+        horizon = self.max_cycle * self.dt_ms if self.max_cycle else float('inf')
+        max_jump = self.settings.get('event_max_step', 3600000)
+        tanks = self.tanks()
+        jumps = 0
+        rates = None
+        while self.sim_time_ms < horizon:
+            volumes = [tank.volume for tank in tanks]
+            states = self.device_states()
+            self.main_loop(writer, csv_field_names)
+            last_rates = rates
+            rates = [float(tank.volume - volume) / self.dt_ms for tank, volume in zip(tanks, volumes)]
+            # outputs the PLC programs computed in this cycle are applied in the next one, as with the cycle engine,
+            # so they are only checked here
+            if self.device_states() != states or self.actuation_pending():
+                rates = None
+                continue
+            # flows limited by a tank which just stopped being empty or full are not steady yet
+            if not same_rates(rates, last_rates):
+                continue
+            jump = min(self.next_event(tanks, rates), max_jump, horizon - self.sim_time_ms)
+            if jump <= self.dt_ms:
+                continue
+            # the last cycle moves the levels by one dt, the jump starts after it
+            jump = int(jump // self.dt_ms * self.dt_ms)
+            self.fast_forward(writer, csv_field_names, tanks, rates, jump, self.settings.get('event_sample_period'))
+            jumps += 1
+            rates = None
+        log.info(f"{self.sim_time_ms / 1000} s simulated in {self.cycle} cycles ({jumps} jumps)")
+
+    def main_loop(self, writer: csv.DictWriter, csv_field_names: list[str], elapsed_ms: int = None) -> None:
         """Main loop of the simulation, reset flow rate to 0, make all active device worker work,
         check simulation volume is correct, sensors update read data,PLC get data from sensors and put them in data bank
-         and also update sensor state(which will in their turn update device state)"""
-        for device in self.devices.values():
-            device.reset_current_flow_rate()
-        for device in self.devices.values():
-            if device.active:
-                device.worker()
-
-        # check all reservoir
-        self.current_tanks_volume = check_reservoir_volume(self.devices, self.current_tanks_volume,
-                                                           self.settings['precision'])
+         and also update sensor state(which will in their turn update device state)
+        :param elapsed_ms: simulated time already advanced by the event engine, the devices are then not stepped
+        and the Structured Text programs are scanned once
+        """
+        cycle_start = time.monotonic()
+        if self.config_watcher is not None:
+            self.reload_config(csv_field_names)
+        if elapsed_ms is None:
+            for device in self.devices.values():
+                device.reset_current_flow_rate()
+            if self.hydraulics is not None:
+                # the flows are solved by the hydraulic network, only the reservoirs refill themselves
+                self.hydraulics.step(self.dt_ms / 1000)
+            for device in self.devices.values():
+                if device.active and (self.hydraulics is None or isinstance(device, Reservoir)):
+                    device.worker()
+
+            # check all reservoir
+            self.current_tanks_volume = check_reservoir_volume(self.devices, self.current_tanks_volume,
+                                                               self.settings['precision'])
+            if self.quality_store is not None:
+                self.quality_store.mix()
         to_write_to_csv = {'timestamp_ns': time.time_ns()}
+        due_groups = self.due_groups(elapsed_ms)
+        for group in due_groups:
+            if len(group['bank_indexes']) == len(self.sensor_bank.sensors):
+                self.sensor_bank.worker()
+            elif len(group['bank_indexes']) > 0:
+                self.sensor_bank.worker(group['bank_indexes'])
+            for sensor in group['sensors']:
+                sensor.worker()
+        # sensors which are not due keep their last reading
         for sensor in self.sensors.values():
-            sensor.worker()
             if sensor.label in csv_field_names:
                 to_write_to_csv[sensor.label] = sensor.read_sensor()
 
-        for plc in self.plcs.values():
-            plc.worker()
-
+        if self.pending_plcs:
+            self.check_pending_plcs(self.start_time)
+        self.run_plc_workers(due_groups)
+        if elapsed_ms is None:
+            self.run_st_programs()
+        else:
+            # inputs don't change during a jump, one scan is enough, up to the start of its last cycle as when the
+            # cycles are run one by one
+            self.run_st_programs(self.sim_time_ms + elapsed_ms - self.dt_ms, max_scans=1)
+        self.run_psm_scripts()
+
+        if 'sim_time_ms' in csv_field_names:
+            to_write_to_csv['sim_time_ms'] = self.sim_time_ms + (elapsed_ms or self.dt_ms)
         writer.writerow(to_write_to_csv)
+        if self.history is not None:
+            self.history.record(to_write_to_csv['timestamp_ns'], self.cycle, to_write_to_csv, self.devices)
+        self.cycle += 1
+        self.sim_time_ms += elapsed_ms or self.dt_ms
+        if self.headless:
+            return
+        if self.lockstep:
+            # continue as soon as all PLCs consumed this cycle, at the latest after sim_speed
+            self.publish_cycle()
+            self.wait_acknowledgements(cycle_start + int(self.settings['sim_speed']) / 1000)
+            return
         # improvement? -> measure time consumed for previous task
         # then to sleep = sim_speed/1000 - time_consumed (in ms)
         time.sleep(int(self.settings['sim_speed']) / 1000)
 
+    def generate_scada_config(self, path: str, max_gap: int = 0) -> None:
+        """
+        Write the ScadaBR / SCADA-LTS json import of the sensors of the PLCs, polled on the modbus servers of the
+        simulator with one data source per range of addresses of a server, unit id and poll period
+        :param path: path of the json file
+        :param max_gap: number of unused addresses a range may contain
+        """
+        write_scada_config(path, self.settings, self.plcs, max_gap)
+
     def generate_st_files(self) -> None:
         """Function to generate basic ladder logic which just move input to output,
         only support Boolean and Word (IX/QX,IW/QW)"""
@@ -0,0 +1,526 @@
+import logging
+import re
+
+from pyModbusTCP.server import DataBank
+
+log = logging.getLogger('phy_sim')
+
+_16BITS = 65535
+# maximal gap between two addresses read with the same data bank request
+_MAX_BLOCK_GAP = 16
+
+_TOKEN_REGEX = re.compile(r"""
+    (?P<comment>\(\*.*?\*\)|//[^\n]*)
+    |(?P<time>T\#[0-9a-z_.]+)
+    |(?P<number>\d+\#[0-9a-f_]+|\d[\d_]*\.\d[\d_]*(?:e[+-]?\d+)?|\d[\d_]*(?:e[+-]?\d+)?)
+    |(?P<location>%[IQM][XWDB]?[\d.]+)
+    |(?P<name>[a-z_][a-z0-9_]*)
+    |(?P<operator>:=|<>|<=|>=|\*\*|[-+*/=<>();:,&])
+    |(?P<space>\s+)
+    """, re.IGNORECASE | re.VERBOSE | re.DOTALL)
+
+_TIME_UNITS = {'d': 86400000, 'h': 3600000, 'm': 60000, 's': 1000, 'ms': 1}
+_BOOL_TYPES = ['BOOL']
+_REAL_TYPES = ['REAL', 'LREAL']
+_SIGNED_TYPES = ['SINT', 'INT', 'DINT', 'LINT']
+
+
+class InvalidStProgram(Exception):
+    """Exception thrown for Structured Text programs which can't be parsed
+    """
+
+    def __init__(self, message):
+        super(InvalidStProgram, self).__init__(message)
+
+
+def parse_time(literal: str) -> int:
+    """
+    Convert a Structured Text time literal to milliseconds
+    :param literal: time literal (i.e T#20ms, T#1s500ms)
+    :return: duration in milliseconds
+    """
+    duration = 0
+    for value, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|d|h|m|s)", literal[2:].lower().replace('_', '')):
+        duration += float(value) * _TIME_UNITS[unit]
+    return int(duration)
+
+
+def parse_number(literal: str):
+    """Convert a Structured Text numeric literal (i.e 10, 1.5, 16#FF, 2#1010) to a python number"""
+    literal = literal.replace('_', '')
+    if '#' in literal:
+        base, digits = literal.split('#')
+        return int(digits, int(base))
+    if '.' in literal or 'e' in literal.lower():
+        return float(literal)
+    return int(literal)
+
+
+def tokenize(source: str) -> list[tuple[str, str]]:
+    """Split a Structured Text source in a list of (kind, value) tokens, without comments and spaces"""
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = _TOKEN_REGEX.match(source, position)
+        if match is None:
+            raise InvalidStProgram(f"Unexpected character {source[position]!r} at position {position}")
+        position = match.end()
+        if match.lastgroup in ['comment', 'space']:
+            continue
+        value = match.group()
+        if match.lastgroup == 'name':
+            value = value.upper()
+        tokens.append((match.lastgroup, value))
+    return tokens
+
+
+def location_address(location: str) -> tuple[str, int]:
+    """
+    Convert a located variable to a data bank address, following the mapping used by `generate_st_files`
+    %IX1.2/%QX1.2 -> coil 10, %IW3/%QW3 -> holding register 3
+    :param location: location of the variable (i.e %IX0.1, %QW2)
+    :return: tuple ('X', coil address) or ('W', holding register address)
+    """
+    size = location[2]
+    address = location[3:]
+    if size == 'X':
+        byte, bit = address.split('.')
+        return 'X', int(byte) * 8 + int(bit)
+    return 'W', int(address)
+
+
+def address_blocks(addresses: list[int]) -> list[tuple[int, int]]:
+    """Group sorted addresses into (start, count) blocks, so close addresses are read with one request"""
+    blocks = []
+    for address in sorted(set(addresses)):
+        if blocks and address - (blocks[-1][0] + blocks[-1][1]) <= _MAX_BLOCK_GAP:
+            blocks[-1] = (blocks[-1][0], address - blocks[-1][0] + 1)
+        else:
+            blocks.append((address, 1))
+    return blocks
+
+
+class StVariable(object):
+    """Variable declared in a VAR block"""
+
+    def __init__(self, name: str, data_type: str, location: str = None, initial_value=None):
+        """
+        :param name: name of the variable
+        :param data_type: IEC type of the variable (BOOL, INT, REAL...)
+        :param location: location of the variable (i.e %IX0.0), None for internal variables
+        :param initial_value: initial value of the variable
+        """
+        self.name = name
+        self.data_type = data_type
+        self.location = location
+        if initial_value is None:
+            initial_value = False if data_type in _BOOL_TYPES else 0.0 if data_type in _REAL_TYPES else 0
+        self.initial_value = initial_value
+
+    @property
+    def kind(self) -> str:
+        """Return the python kind of the variable: 'BOOL', 'REAL' or 'INT'"""
+        if self.data_type in _BOOL_TYPES:
+            return 'BOOL'
+        if self.data_type in _REAL_TYPES:
+            return 'REAL'
+        return 'INT'
+
+    @property
+    def python_name(self) -> str:
+        return f"v_{self.name}"
+
+
+class StParser(object):
+    """Recursive descent parser translating the supported Structured Text subset into python source code
+    Supported: PROGRAM, VAR blocks with %IX/%QX/%IW/%QW locations, assignments, IF/ELSIF/ELSE,
+    arithmetic, comparison and boolean expressions, CONFIGURATION with TASK INTERVAL"""
+
+    def __init__(self, source: str):
+        self.tokens = tokenize(source)
+        self.position = 0
+        self.programs = {}
+        self.tasks = {}
+        self.instances = {}
+
+    def peek(self, offset: int = 0) -> tuple[str, str]:
+        if self.position + offset < len(self.tokens):
+            return self.tokens[self.position + offset]
+        return 'eof', ''
+
+    def next(self) -> tuple[str, str]:
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def accept(self, value: str) -> bool:
+        if self.peek()[1] == value:
+            self.position += 1
+            return True
+        return False
+
+    def expect(self, value: str) -> tuple[str, str]:
+        token = self.next()
+        if token[1] != value:
+            raise InvalidStProgram(f"Expected {value} but got {token[1]!r} (token {self.position})")
+        return token
+
+    def skip_until(self, value: str) -> None:
+        while self.peek()[1] != value:
+            if self.next()[0] == 'eof':
+                raise InvalidStProgram(f"Expected {value} before the end of the program")
+        self.next()
+
+    def parse(self) -> 'StParser':
+        """Parse the whole source"""
+        while self.peek()[0] != 'eof':
+            keyword = self.next()[1]
+            if keyword == 'PROGRAM':
+                self.parse_program()
+            elif keyword == 'CONFIGURATION':
+                self.parse_configuration()
+            else:
+                raise InvalidStProgram(f"Unexpected {keyword!r}, only PROGRAM and CONFIGURATION are supported")
+        return self
+
+    def parse_program(self) -> None:
+        name = self.next()[1]
+        variables = {}
+        while self.peek()[1] in ['VAR', 'VAR_INPUT', 'VAR_OUTPUT', 'VAR_GLOBAL']:
+            self.next()
+            while self.peek()[1] in ['CONSTANT', 'RETAIN', 'NON_RETAIN']:
+                self.next()
+            while not self.accept('END_VAR'):
+                for variable in self.parse_declaration():
+                    variables[variable.name] = variable
+        self.variables = variables
+        body = self.parse_statements(['END_PROGRAM'], 1)
+        self.expect('END_PROGRAM')
+        self.programs[name] = (variables, body)
+
+    def parse_declaration(self) -> list[StVariable]:
+        names = [self.next()[1]]
+        while self.accept(','):
+            names.append(self.next()[1])
+        location = None
+        if self.accept('AT'):
+            location = self.next()[1].upper()
+        self.expect(':')
+        data_type = self.next()[1]
+        initial_value = None
+        if self.accept(':='):
+            kind, value = self.next()
+            negative = False
+            if value == '-':
+                negative = True
+                kind, value = self.next()
+            if value in ['TRUE', 'FALSE']:
+                initial_value = value == 'TRUE'
+            elif kind == 'time':
+                initial_value = parse_time(value)
+            else:
+                initial_value = -parse_number(value) if negative else parse_number(value)
+        self.expect(';')
+        if len(names) > 1 and location is not None:
+            raise InvalidStProgram(f"Only one variable can be declared at {location}")
+        return [StVariable(name, data_type, location, initial_value) for name in names]
+
+    def parse_statements(self, end_keywords: list[str], depth: int) -> list[str]:
+        lines = []
+        while self.peek()[1] not in end_keywords:
+            if self.peek()[0] == 'eof':
+                raise InvalidStProgram(f"Expected {' or '.join(end_keywords)} before the end of the program")
+            lines.extend(self.parse_statement(depth))
+        return lines
+
+    def parse_statement(self, depth: int) -> list[str]:
+        indent = '    ' * depth
+        if self.accept(';'):
+            return []
+        if self.accept('IF'):
+            lines = []
+            condition, _ = self.parse_expression()
+            self.expect('THEN')
+            lines.append(f"{indent}if {condition}:")
+            lines.extend(self.parse_statements(['ELSIF', 'ELSE', 'END_IF'], depth + 1) or [f"{indent}    pass"])
+            while self.accept('ELSIF'):
+                condition, _ = self.parse_expression()
+                self.expect('THEN')
+                lines.append(f"{indent}elif {condition}:")
+                lines.extend(self.parse_statements(['ELSIF', 'ELSE', 'END_IF'], depth + 1) or [f"{indent}    pass"])
+            if self.accept('ELSE'):
+                lines.append(f"{indent}else:")
+                lines.extend(self.parse_statements(['END_IF'], depth + 1) or [f"{indent}    pass"])
+            self.expect('END_IF')
+            self.accept(';')
+            return lines
+        kind, name = self.next()
+        if kind != 'name' or name not in self.variables:
+            raise InvalidStProgram(f"Unknown variable {name!r} in assignment")
+        variable = self.variables[name]
+        self.expect(':=')
+        expression, expression_kind = self.parse_expression()
+        self.expect(';')
+        if variable.kind == 'BOOL':
+            expression = f"bool({expression})"
+        elif variable.kind == 'INT' and expression_kind != 'INT':
+            expression = f"int({expression})"
+        return [f"{indent}{variable.python_name} = {expression}"]
+
+    def parse_expression(self) -> tuple[str, str]:
+        left, kind = self.parse_xor()
+        while self.accept('OR'):
+            right, _ = self.parse_xor()
+            left, kind = f"({left} or {right})", 'BOOL'
+        return left, kind
+
+    def parse_xor(self) -> tuple[str, str]:
+        left, kind = self.parse_and()
+        while self.accept('XOR'):
+            right, _ = self.parse_and()
+            left, kind = f"(bool({left}) != bool({right}))", 'BOOL'
+        return left, kind
+
+    def parse_and(self) -> tuple[str, str]:
+        left, kind = self.parse_comparison()
+        while self.peek()[1] in ['AND', '&']:
+            self.next()
+            right, _ = self.parse_comparison()
+            left, kind = f"({left} and {right})", 'BOOL'
+        return left, kind
+
+    def parse_comparison(self) -> tuple[str, str]:
+        operators = {'=': '==', '<>': '!=', '<': '<', '>': '>', '<=': '<=', '>=': '>='}
+        left, kind = self.parse_additive()
+        while self.peek()[1] in operators:
+            operator = operators[self.next()[1]]
+            right, _ = self.parse_additive()
+            left, kind = f"({left} {operator} {right})", 'BOOL'
+        return left, kind
+
+    def parse_additive(self) -> tuple[str, str]:
+        left, kind = self.parse_multiplicative()
+        while self.peek()[1] in ['+', '-']:
+            operator = self.next()[1]
+            right, right_kind = self.parse_multiplicative()
+            left = f"({left} {operator} {right})"
+            kind = 'REAL' if 'REAL' in [kind, right_kind] else 'INT'
+        return left, kind
+
+    def parse_multiplicative(self) -> tuple[str, str]:
+        left, kind = self.parse_unary()
+        while self.peek()[1] in ['*', '/', 'MOD']:
+            operator = self.next()[1]
+            right, right_kind = self.parse_unary()
+            kind = 'REAL' if 'REAL' in [kind, right_kind] else 'INT'
+            if operator == '*':
+                left = f"({left} * {right})"
+            elif operator == 'MOD':
+                left = f"_mod({left}, {right})"
+            elif kind == 'INT':
+                left = f"_int_div({left}, {right})"
+            else:
+                left = f"({left} / {right})"
+        return left, kind
+
+    def parse_unary(self) -> tuple[str, str]:
+        if self.accept('NOT'):
+            operand, _ = self.parse_unary()
+            return f"(not {operand})", 'BOOL'
+        if self.accept('-'):
+            operand, kind = self.parse_unary()
+            return f"(-{operand})", kind
+        return self.parse_power()
+
+    def parse_power(self) -> tuple[str, str]:
+        left, kind = self.parse_primary()
+        if self.accept('**'):
+            right, _ = self.parse_unary()
+            return f"({left} ** {right})", 'REAL'
+        return left, kind
+
+    def parse_primary(self) -> tuple[str, str]:
+        kind, value = self.next()
+        if value == '(':
+            expression, expression_kind = self.parse_expression()
+            self.expect(')')
+            return expression, expression_kind
+        if value in ['TRUE', 'FALSE']:
+            return str(value == 'TRUE'), 'BOOL'
+        if kind == 'time':
+            return str(parse_time(value)), 'INT'
+        if kind == 'number':
+            number = parse_number(value)
+            return repr(number), 'REAL' if isinstance(number, float) else 'INT'
+        if kind == 'name' and value in self.variables:
+            return self.variables[value].python_name, self.variables[value].kind
+        raise InvalidStProgram(f"Unexpected {value!r} in expression")
+
+    def parse_configuration(self) -> None:
+        self.next()
+        while not self.accept('END_CONFIGURATION'):
+            keyword = self.next()[1]
+            if keyword == 'RESOURCE':
+                self.next()
+                self.expect('ON')
+                self.next()
+            elif keyword == 'TASK':
+                task_name = self.next()[1]
+                self.expect('(')
+                interval = None
+                while not self.accept(')'):
+                    parameter = self.next()[1]
+                    self.expect(':=')
+                    kind, value = self.next()
+                    if parameter == 'INTERVAL':
+                        interval = parse_time(value)
+                    self.accept(',')
+                self.expect(';')
+                self.tasks[task_name] = interval
+            elif keyword == 'PROGRAM':
+                instance_name = self.next()[1]
+                task_name = None
+                if self.accept('WITH'):
+                    task_name = self.next()[1]
+                self.expect(':')
+                self.instances[instance_name] = (task_name, self.next()[1])
+                self.skip_until(';')
+            elif keyword == 'END_RESOURCE':
+                self.accept(';')
+            elif keyword == 'eof':
+                raise InvalidStProgram("Expected END_CONFIGURATION before the end of the program")
+
+
+def _int_div(a, b):
+    """IEC integer division, truncated toward zero"""
+    if b == 0:
+        return 0
+    quotient = abs(a) // abs(b)
+    return quotient if (a >= 0) == (b >= 0) else -quotient
+
+
+def _mod(a, b):
+    """IEC modulo, with the sign of the dividend"""
+    if b == 0:
+        return 0
+    return a - _int_div(a, b) * b
+
+
+class StProgram(object):
+    """Structured Text program compiled into a python function, scanned against a modbus data bank"""
+
+    def __init__(self, name: str, variables: dict[str, StVariable], body: list[str], interval: int = None):
+        """
+        :param name: name of the program
+        :param variables: dict of declared variables, key is the variable name
+        :param body: python source lines of the program body
+        :param interval: task interval in milliseconds, None if the program has no task
+        """
+        self.name = name
+        self.variables = variables
+        self.interval = interval
+        self.data_bank = None
+        self.scan_count = 0
+        self.next_scan_time = 0
+        self.memory = {variable.python_name: variable.initial_value for variable in variables.values()}
+        self.inputs = {'X': [], 'W': []}
+        self.outputs = {'X': [], 'W': []}
+        for variable in variables.values():
+            if variable.location is None or variable.location[1] == 'M':
+                continue
+            area, address = location_address(variable.location)
+            located = self.inputs if variable.location[1] == 'I' else self.outputs
+            located[area].append((variable.python_name, address, variable.data_type))
+        self.input_blocks = {area: address_blocks([address for _, address, _ in located])
+                             for area, located in self.inputs.items()}
+        self.output_blocks = {area: address_blocks([address for _, address, _ in located])
+                              for area, located in self.outputs.items()}
+
+        names = [variable.python_name for variable in variables.values()]
+        source = ["def scan(memory):"]
+        source.extend(f"    {name} = memory['{name}']" for name in names)
+        source.extend(body)
+        source.extend(f"    memory['{name}'] = {name}" for name in names)
+        namespace = {'_int_div': _int_div, '_mod': _mod}
+        exec(compile("\n".join(source), f"<{name}>", 'exec'), namespace)
+        self.scan_function = namespace['scan']
+
+    def set_data_bank(self, data_bank: DataBank) -> None:
+        """Set the data bank the program reads its inputs from and writes its outputs to"""
+        self.data_bank = data_bank
+
+    def read_area(self, area: str, located: list, blocks: list[tuple[int, int]]) -> None:
+        """Copy the data bank values of `area` ('X' coils, 'W' holding registers) into the located variables"""
+        values = {}
+        for start, count in blocks:
+            if area == 'X':
+                block = self.data_bank.get_coils(start, count)
+            else:
+                block = self.data_bank.get_holding_registers(start, count)
+            if block is None:
+                log.error(f"{self.name}: Error reading {area}{start} to {area}{start + count - 1}")
+                continue
+            for offset, value in enumerate(block):
+                values[start + offset] = value
+        for python_name, address, data_type in located:
+            if address not in values:
+                continue
+            value = values[address]
+            if data_type in _BOOL_TYPES:
+                value = bool(value)
+            elif data_type in _SIGNED_TYPES and value > _16BITS // 2:
+                # holding registers are unsigned words
+                value -= _16BITS + 1
+            self.memory[python_name] = value
+
+    def scan(self) -> None:
+        """Run one PLC scan: read inputs, execute the program, write outputs"""
+        if self.scan_count == 0:
+            # outputs keep the current data bank value until the program writes them
+            self.read_area('X', self.outputs['X'], self.output_blocks['X'])
+            self.read_area('W', self.outputs['W'], self.output_blocks['W'])
+        self.read_area('X', self.inputs['X'], self.input_blocks['X'])
+        self.read_area('W', self.inputs['W'], self.input_blocks['W'])
+        self.scan_function(self.memory)
+        for python_name, address, _ in self.outputs['X']:
+            self.data_bank.set_coils(address, [self.memory[python_name]])
+        for python_name, address, _ in self.outputs['W']:
+            self.data_bank.set_holding_registers(address, [int(self.memory[python_name]) & _16BITS])
+        self.scan_count += 1
+
+    def run_until(self, time_ms: int, max_scans: int = None) -> None:
+        """
+        Scan the program once for each task interval elapsed until the simulated time `time_ms`
+        :param max_scans: maximal number of scans, the other elapsed intervals are skipped (inputs didn't change)
+        """
+        scans = 0
+        while self.next_scan_time <= time_ms:
+            if max_scans is not None and scans >= max_scans:
+                skipped = (time_ms - self.next_scan_time) // self.interval + 1
+                self.next_scan_time += skipped * self.interval
+                break
+            self.scan()
+            scans += 1
+            self.next_scan_time += self.interval
+
+
+def load_st_file(path_to_st_file: str, default_interval: int = None) -> list[StProgram]:
+    """
+    Parse and compile a Structured Text file
+    :param path_to_st_file: path to the .st file
+    :param default_interval: interval in milliseconds of programs which are not bound to a task
+    :return: list of compiled programs, one per program instance of the configuration
+    (or one per program if there is no configuration)
+    """
+    with open(path_to_st_file, 'r') as st_file:
+        parser = StParser(st_file.read()).parse()
+    instances = parser.instances or {name: (None, name) for name in parser.programs}
+    programs = []
+    for instance_name, (task_name, program_name) in instances.items():
+        if program_name not in parser.programs:
+            raise InvalidStProgram(f"Program {program_name} of instance {instance_name} is not defined")
+        variables, body = parser.programs[program_name]
+        interval = parser.tasks.get(task_name) or default_interval
+        programs.append(StProgram(program_name, variables, body, interval))
+        log.info(f"{program_name}: compiled from {path_to_st_file}, task interval {interval} ms")
+    return programs
@@ -0,0 +1,155 @@
+import csv
+import logging
+from enum import Enum
+
+import sympy.core.evalf as sp_evalf
+
+log = logging.getLogger('phy_sim')
+
+
+class Allowed_aggregation(Enum):
+    min = 'min'
+    max = 'max'
+    mean = 'mean'
+    last = 'last'
+    deadband = 'deadband'
+    change = 'change'
+
+
+class WindowAggregator(object):
+    """Reduce the readings of a sensor to one value per window of `window` log rows, without keeping them"""
+    __slots__ = ('aggregation', 'window', 'precision', 'count', 'value')
+
+    def __init__(self, aggregation: str, window: int, precision: int):
+        """
+        :param aggregation: 'min', 'max', 'mean' or 'last'
+        :param window: number of readings of a window
+        :param precision: number of digits of the mean
+        """
+        self.aggregation = aggregation
+        self.window = max(1, int(window))
+        self.precision = precision
+        self.count = 0
+        self.value = None
+
+    def add(self, value):
+        """Add a reading, return the aggregate when the window is complete, None otherwise"""
+        if self.count == 0 or self.aggregation == Allowed_aggregation.last.value:
+            self.value = float(value) if self.aggregation == Allowed_aggregation.mean.value else value
+        elif self.aggregation == Allowed_aggregation.mean.value:
+            self.value += float(value)
+        elif self.aggregation == Allowed_aggregation.min.value:
+            if float(value) < float(self.value):
+                self.value = value
+        elif float(value) > float(self.value):
+            self.value = value
+        self.count += 1
+        if self.count < self.window:
+            return None
+        return self.flush()
+
+    def flush(self):
+        """Return the aggregate of the current window, even incomplete, None if it is empty"""
+        if self.count == 0:
+            return None
+        value = self.value
+        if self.aggregation == Allowed_aggregation.mean.value:
+            value = sp_evalf.N(value / self.count, self.precision)
+        self.count = 0
+        self.value = None
+        return value
+
+
+class DeadbandAggregator(object):
+    """Emit the readings of a sensor which moved by more than `deadband` from the last emitted one,
+    with a deadband of 0 every change is emitted"""
+    __slots__ = ('deadband', 'value')
+
+    def __init__(self, deadband: float = 0):
+        self.deadband = deadband or 0
+        self.value = None
+
+    def add(self, value):
+        """Add a reading, return it if it is emitted, None otherwise"""
+        if self.value is not None:
+            if self.deadband:
+                if abs(float(value) - float(self.value)) <= self.deadband:
+                    return None
+            elif value == self.value:
+                return None
+        self.value = value
+        return value
+
+    def flush(self):
+        return None
+
+
+def build_aggregator(sensor):
+    """Return the aggregator of the `aggregation` of the sensor, None if its readings are all logged"""
+    aggregation = getattr(sensor, 'aggregation', None)
+    if aggregation is None:
+        return None
+    if aggregation not in [e.value for e in Allowed_aggregation]:
+        raise ValueError(f'Aggregation {aggregation} of sensor {sensor.label} is not allowed.')
+    if aggregation == Allowed_aggregation.deadband.value:
+        return DeadbandAggregator(sensor.deadband)
+    if aggregation == Allowed_aggregation.change.value:
+        return DeadbandAggregator()
+    return WindowAggregator(aggregation, sensor.window, sensor.precision)
+
+
+class TelemetryWriter(object):
+    """Csv writer of the simulation log passing the sensor readings through their aggregator. A row is written when
+    at least one sensor column has a value to emit, the other sensor columns are then left empty"""
+
+    def __init__(self, writer: csv.DictWriter, aggregators: dict):
+        """
+        :param writer: csv writer of the log, header already written
+        :param aggregators: dict of aggregators, key is the sensor label, None for the sensors logged every row
+        """
+        self.writer = writer
+        self.aggregators = aggregators
+        self.rows = 0
+        self.written_rows = 0
+
+    def writerow(self, row: dict) -> None:
+        emitted = False
+        out = {}
+        for key, value in row.items():
+            if key not in self.aggregators:
+                # timestamps
+                out[key] = value
+                continue
+            aggregator = self.aggregators[key]
+            if aggregator is not None:
+                value = aggregator.add(value)
+                if value is None:
+                    continue
+            out[key] = value
+            emitted = True
+        self.rows += 1
+        if emitted:
+            self.writer.writerow(out)
+            self.written_rows += 1
+
+    def flush(self, row: dict) -> None:
+        """Write the incomplete windows in a last row
+        :param row: timestamps of the row
+        """
+        out = dict(row)
+        for label, aggregator in self.aggregators.items():
+            value = aggregator.flush() if aggregator is not None else None
+            if value is not None:
+                out[label] = value
+        if len(out) > len(row):
+            self.writer.writerow(out)
+            self.written_rows += 1
+        log.info(f"Telemetry: {self.written_rows} rows written for {self.rows} cycles")
+
+
+def telemetry_writer(writer: csv.DictWriter, sensors: list):
+    """Wrap `writer` in a TelemetryWriter if some of the logged `sensors` have an aggregation"""
+    aggregators = {sensor.label: build_aggregator(sensor) for sensor in sensors}
+    if all(aggregator is None for aggregator in aggregators.values()):
+        return writer
+    return TelemetryWriter(writer, aggregators)
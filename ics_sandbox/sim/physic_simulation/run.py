@@ -12,12 +12,34 @@ if __name__ == '__main__':
     parser.add_argument('-m', '--math_parser', help='Type of math expression parser',
                         default='proportional', choices=['proportional', 'sympy', 'wolfram'], action='store')
     parser.add_argument('-g', '--generate', help='Generate openPLC ladder logic files', action='store_true')
+    parser.add_argument('--scada_config', help='Generate the ScadaBR/SCADA-LTS json import of the PLC sensors',
+                        action='store')
+    parser.add_argument('--scada_max_gap', help='Number of unused addresses a SCADA polled range may contain',
+                        type=int, default=0, action='store')
+    parser.add_argument('-r', '--replay', help='Serve a recorded simulation log instead of simulating',
+                        action='store')
+    parser.add_argument('--replay_speed', help='Replay speed, 1 is real time, 0 is as fast as possible',
+                        type=float, default=1.0, action='store')
+    parser.add_argument('--replay_from', help='First timestamp_ns of the log to replay',
+                        type=int, default=None, action='store')
+    parser.add_argument('--replay_to', help='Last timestamp_ns of the log to replay',
+                        type=int, default=None, action='store')
+    parser.add_argument('--replay_traffic', help='Replay a recorded modbus traffic and compare the responses',
+                        action='store')
+    parser.add_argument('--headless', help='Run without modbus server and without sleeping between cycles',
+                        action='store_true')
 
     args = parser.parse_args()
 
-    sim = Simulator(debug=args.verbose, math_parser=args.math_parser)
+    sim = Simulator(debug=args.verbose, math_parser=args.math_parser, headless=args.headless)
     sim.load_yml(args.config)
     if args.generate:
         sim.generate_st_files()
+    elif args.scada_config:
+        sim.generate_scada_config(args.scada_config, args.scada_max_gap)
+    elif args.replay_traffic:
+        sim.replay_traffic(args.replay_traffic)
+    elif args.replay:
+        sim.replay(args.replay, args.replay_speed, args.replay_from, args.replay_to)
     else:
         sim.start()
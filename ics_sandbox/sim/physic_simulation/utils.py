@@ -1,8 +1,11 @@
+import copy
 import logging
 from enum import Enum
 
 import yaml
 
+from Fluid import FluidQualityStore, Water
+
 logging.basicConfig()
 log = logging.getLogger('phy_sim')
 
@@ -13,6 +16,16 @@ class Allowed_math_type(Enum):
     wolfram = 'wolfram'
 
 
+class Allowed_engine(Enum):
+    cycle = 'cycle'
+    event = 'event'
+
+
+class Allowed_physics(Enum):
+    volume = 'volume'
+    hydraulic = 'hydraulic'
+
+
 def parse_yml(path_to_yml_file):
     with open(path_to_yml_file, 'r') as stream:
         config = yaml.load(stream, Loader=yaml.Loader)
@@ -21,6 +34,9 @@ def parse_yml(path_to_yml_file):
 
 def build_simulation(config, math_parser):
     """Build simulation from config file"""
+    # Device imports this module
+    from Device import build_device_graph
+
     settings = config['settings']
     devices = {}
     sensors = {}
@@ -28,11 +44,19 @@ def build_simulation(config, math_parser):
 
     build_devices(config, devices, math_parser)
 
-    build_sensors(config, devices, sensors)
+    sensor_bank = build_sensors(config, devices, sensors)
 
     build_plc(config, plcs, sensors)
 
-    return {'settings': settings, 'devices': devices, 'sensors': sensors, 'plcs': plcs}
+    # dense ids, the connections become arrays indexed by device id
+    device_graph = build_device_graph(list(devices.values()))
+    for uid, sensor in enumerate(sensors.values()):
+        sensor.uid = uid
+    for uid, plc in enumerate(plcs.values()):
+        plc.uid = uid
+
+    return {'settings': settings, 'devices': devices, 'device_graph': device_graph, 'sensors': sensors,
+            'sensor_bank': sensor_bank, 'plcs': plcs}
 
 
 def build_devices(config, devices, math_parser):
@@ -44,7 +68,11 @@ def build_devices(config, devices, math_parser):
         raise ValueError(f'Math type {math_parser} is not allowed.')
     for device in devices.values():
         device.math_parser = math_parser
+    connect_devices(config, devices, math_parser)
 
+
+def connect_devices(config, devices, math_parser):
+    """Build the connections, the expressions and the symbol table of the devices"""
     build_connection_between_device(config, devices, math_parser)
     # debug purpose log
     for device in devices.values():
@@ -54,9 +82,11 @@ def build_devices(config, devices, math_parser):
         log.debug(f"output devices expr:  {device.output_devices_expr}")
     # add symbols to each device
     if math_parser != Allowed_math_type.proportional.value and math_parser in [e.value for e in Allowed_math_type]:
+        # one table for the plant, each device only stores its own symbols
+        symbol_table = dict(config['symbols'])
+        symbol_table.update(devices)
         for device in devices.values():
-            device.symbol_dict.update(config['symbols'])
-            device.symbol_dict.update(devices)
+            device.set_symbol_table(symbol_table)
             log.debug(f"devices symbols:  {device.symbol_dict}")
 
 
@@ -82,18 +112,48 @@ def build_connection_between_device(config, devices, math_parser):
 
 
 def build_sensors(config, devices, sensors):
+    # Sensor imports Device which imports this module
+    from Sensor import AnalogSensor, AnalogSensorBank
+
     # process sensors
     for sensor in config['sensors']:
         device_to_monitor = devices[sensor.device_to_monitor_label]
         sensor.set_location_tuple()
         sensor.monitor_device(device_to_monitor)
         sensors[sensor.label] = sensor
+    # analog sensors are updated together
+    sensor_bank = AnalogSensorBank([sensor for sensor in sensors.values() if isinstance(sensor, AnalogSensor)])
     # debug purpose log
     for sensor in sensors.values():
         log.debug(f"{sensor.label}")
         log.debug(f"location:  {sensor.location}")
         log.debug(f"location tuple:  {sensor.location_tuple}")
         log.debug(f"device to monitor:  {sensor.device_to_monitor_label}")
+    return sensor_bank
+
+
+def build_quality_store(devices):
+    """Give each tank, and each filter with a `removal`, its own fluid in a quality store"""
+    # Device imports this module
+    from Device import Tank, Reservoir, Filter
+
+    quality_store = FluidQualityStore()
+    for device in devices.values():
+        if not isinstance(device, Tank) and not (isinstance(device, Filter) and device.removal):
+            continue
+        if device.fluid is None:
+            device.fluid = Water(ph=7)
+        elif device.fluid.quality_store is not None:
+            # fluid shared with another device through a yaml anchor
+            device.fluid = copy.copy(device.fluid)
+        if isinstance(device, Tank):
+            quality_store.add(device.fluid, holder=device)
+        else:
+            quality_store.add(device.fluid, removal=device.removal)
+        if isinstance(device, Reservoir):
+            device.input_fluid_source = copy.copy(device.fluid)
+            quality_store.add(device.input_fluid_source)
+    return quality_store
 
 
 def build_plc(config, plcs, sensors):